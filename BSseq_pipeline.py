@@ -18,7 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
+import os, time
 
 #--- DEFINE OUTPUT DIRECTORIES TO BE PRODUCED 
 OUTDIR = config['locations']['output-dir']                      #--- current work dir (important for rmarkdown)
@@ -37,13 +37,29 @@ DIR_trimmed     =  os.path.join(OUTDIR, '02_trimming/' )
 DIR_rawqc       =  os.path.join(OUTDIR, '01_raw_QC/' )
 
 DIR_final       = os.path.join(OUTDIR, "Final_Reports/")
+DIR_benchmarks  = os.path.join(OUTDIR, 'pigx_work/benchmarks/')
+DIR_reportdata  = os.path.join(OUTDIR, 'pigx_work/report_data/')
+DIR_annotation  = os.path.join(OUTDIR, 'pigx_work/annotation/')
+LEDGER          = os.path.join(OUTDIR, 'pigx_work/ledger.jsonl')    # resources used by every job
 
 
 #--- DEFINE PATHS AND FILE NAMES:
 
 PATHIN     = "pigx_work/input/"           # location of the data files to be imported (script creates symbolic link)
 GENOMEPATH = "pigx_work/refGenome/"       # where the reference genome being mapped to is stored
+REDUCEDPATH = "pigx_work/reducedGenome/"  # where the reduced reference of RRBS samples is stored
 ASSEMBLY   = config['general']['assembly'] # version of the genome being mapped to
+ANNOTATION = config['general']['differential-methylation']['annotation']
+ANNOTATION_INDEX = os.path.join(DIR_annotation, ASSEMBLY + "_annotation.RDS") # genes and CpG islands of all reports
+ANNOTATION_FEATURES = os.path.join(DIR_annotation, ASSEMBLY + "_features.tsv") # the same as a sorted table
+DIFFMETH_BATCHED = config['general']['differential-methylation']['batched'] # test all treatment groups in one job
+SHARDS     = int(config['execution']['shards']) # number of chromosome groups per sample (1 = no sharding)
+
+bismark_cores = str(config['tools']['bismark']['cores'])
+ALIGN_CHUNKS  = int(config['tools']['bismark']['chunks'])  # number of read chunks aligned per sample
+
+COMPRESSION = config['execution']['intermediate-compression']   # how the trimmed reads are stored
+TRIMMED_EXT = ".fq" if COMPRESSION in ['none', 'pipe'] else ".fq.gz"
 
 # include function definitions and extra rules
 include   : os.path.join(config['locations']['pkglibexecdir'], 'scripts/func_defs.py')
@@ -74,31 +90,31 @@ targets = {
 
     'raw-qc': {
         'description': "Perform raw quality control.",
-        'files': files_for_sample(list_files_rawQC)
+        'files': files_for_sample(list_files_rawQC, bam=False)
     },
 
     # This rule is always executed, as trimming is a prerequisite for
     # subsequent rules
     'trimgalore': {
         'description': "Trim the reads.",
-        'files': files_for_sample(list_files_TG)
+        'files': files_for_sample(list_files_TG, bam=False)
     },
 
     # fastQC output files are not needed downstream and need to be
     # called explicitly.
     'posttrim-qc': {
         'description': "Perform quality control after trimming.",
-        'files': files_for_sample(list_files_posttrim_QC)
+        'files': files_for_sample(list_files_posttrim_QC, bam=False)
     },
 
     'mapping': {
         'description': "Align and map reads with Bismark.",
-        'files': files_for_sample(list_files_bismark)
+        'files': files_for_sample(list_files_bismark, bam=False)
     },
 
     'sorting': {
         'description': "Sort bam files.",
-        'files': files_for_sample(list_files_sortbam)
+        'files': files_for_sample(list_files_sortbam, bam=False)
     },
 
     'deduplication': {
@@ -124,8 +140,7 @@ targets = {
 
     'diffmeth': {
         'description': "Perform differential methylation calling.",
-        'files': [ [DIR_diffmeth+"_".join(x)+
-                    dedupe_tag(config["SAMPLES"][get_sampleids_from_treatment(x[0])[0]]['Protocol']) + "_diffmeth.RDS"] for x in config["general"]["differential-methylation"]["treatment-groups"] if x ]
+        'files': [ [diffmeth_path(DIR_diffmeth, "_diffmeth.RDS", "vs".join(x))] for x in config["general"]["differential-methylation"]["treatment-groups"] if x ]
     },
 
     'diffmeth-report': {
@@ -154,6 +169,17 @@ from itertools import chain
 OUTPUT_FILES = list(chain.from_iterable(chain.from_iterable([targets[name]['files'] for name in selected_targets])))
 
 
+# Sample names and prefixes never contain a directory; this keeps the
+# per-shard and per-chunk files in "shards/" and "chunks/"
+# sub-directories from matching the per-sample rules.
+wildcard_constraints:
+    sample        = "[^/]+",
+    prefix        = "[^/]+",
+    bigwig_prefix = "[^/]+",
+    shard         = "[0-9]+",
+    chunk         = "[0-9]+"
+
+
 # ==============================================================================================================
 #
 #                                         BEGIN RULES
@@ -173,15 +199,17 @@ rule help:
             print('{}:\n  {}'.format(key, targets[key]['description']))
 
 # Record any existing output files, so that we can detect if they have
-# changed.
+# changed.  Jobs in the ledger that started before this run are left
+# out of its summary.
 expected_files = {}
+run_started = time.time()
 onstart:
     if OUTPUT_FILES:
         for name in OUTPUT_FILES:
             if os.path.exists(name):
                 expected_files[name] = os.path.getmtime(name)
 
-# Print generated target files.
+# Print generated target files and where the time of the run went.
 onsuccess:
     if OUTPUT_FILES:
         # check if any existing files have been modified
@@ -193,6 +221,10 @@ onsuccess:
             print("The following files have been generated:")
             for name in generated:
                 print("  - {}".format(name))
+    print_ledger_summary(run_started)
+
+onerror:
+    print_ledger_summary(run_started)
 
 
 # ==========================================================================================
@@ -200,12 +232,9 @@ onsuccess:
 
 rule final_report:
     input:
-        rdsfile     = os.path.join(DIR_methcall,"{prefix}_methylRaw.RDS"),
+        reportData  = os.path.join(DIR_reportdata,"{prefix}_report_data.RDS"),
         callFile    = os.path.join(DIR_methcall,"{prefix}_CpG.txt"),
-        grfile      = os.path.join(DIR_seg,"{prefix}_meth_segments_gr.RDS"),
-        bedfile     = os.path.join(DIR_seg,"{prefix}_meth_segments.bed"),
         template            = os.path.join(DIR_templates,"index.Rmd"),
-        bigwigFile          = os.path.join(DIR_bigwig,   "{prefix}.bw"),
         chrom_seqlengths    = os.path.join(DIR_mapped,"Refgen_"+ASSEMBLY+"_chromlengths.csv")
     output:
         report        = os.path.join(DIR_final, "{prefix}_{assembly}_final.html")
@@ -226,15 +255,125 @@ rule final_report:
         methSegGR       = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments_gr.RDS"),
         methSegBed      = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.bed"),
         methSegPng      = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.png"),
+        reportData      = os.path.join(OUTDIR,DIR_reportdata,"{prefix}_report_data.RDS"),
         genome_dir  = config['locations']['genome-dir'],
         scripts_dir = DIR_scripts,
         refGenes_bedfile  = config['general']['differential-methylation']['annotation']['refGenes_bedfile'],
         webfetch    = config['general']['differential-methylation']['annotation']['webfetch']
     log:
         os.path.join(DIR_final,"{prefix}_{assembly}_final.log")
+    benchmark: benchmark_file('final_report', "{prefix}_{assembly}")
+    threads: rule_threads('final_report')
+    resources: **memory_resources(rule_memory('final_report'))
     message: fmt("Compiling final report.")
     run:
-        generateReport(input, output, params, log, "")
+        generateReport(input, output, params, log, "", rule)
+
+#-----------------------
+# The reference genes and CpG islands are read, or fetched, once per
+# assembly.  Annotation files that are missing are not inputs, so that
+# they can be fetched with webfetch.
+rule annotation_index:
+    input:
+        [os.path.join(OUTDIR, f) for f in [ANNOTATION['refGenes_bedfile'], ANNOTATION['cpgIsland_bedfile']]
+         if f and os.path.exists(os.path.join(OUTDIR, f))]
+    output:
+        index    = ANNOTATION_INDEX,
+        features = ANNOTATION_FEATURES
+    params:
+        assembly          = ASSEMBLY,
+        refGenes_bedfile  = os.path.join(OUTDIR, ANNOTATION['refGenes_bedfile']),
+        cpgIsland_bedfile = os.path.join(OUTDIR, ANNOTATION['cpgIsland_bedfile']),
+        webfetch          = ANNOTATION['webfetch']
+    log:
+        os.path.join(DIR_annotation, ASSEMBLY + "_annotation.log")
+    benchmark: benchmark_file('annotation_index', ASSEMBLY)
+    threads: rule_threads('annotation_index')
+    resources: **memory_resources(rule_memory('annotation_index'))
+    message: fmt("Building the annotation index of " + ASSEMBLY)
+    shell:
+        nice('Rscript', ["{DIR_scripts}/annotationIndex.R",
+                         "--assembly={params.assembly}",
+                         "--refGenes_bedfile={params.refGenes_bedfile}",
+                         "--cpgIsland_bedfile={params.cpgIsland_bedfile}",
+                         "--webfetch={params.webfetch}",
+                         "--scriptsDir=" + DIR_scripts,
+                         "--output={output.index}",
+                         "--features={output.features}",
+                         "--logFile={log}"])
+
+#-----------------------
+# Segments and differentially methylated cytosines are annotated with
+# gene parts, CpG islands and the nearest TSS in batches, which are
+# processed in parallel.
+rule annotate_segments:
+    input:
+        bedfile     = os.path.join(DIR_seg,"{prefix}_meth_segments.bed"),
+        features    = ANNOTATION_FEATURES
+    output:
+        os.path.join(DIR_seg,"{prefix}_meth_segments_annotated.tsv")
+    log:
+        os.path.join(DIR_seg,"{prefix}_meth_segments_annotated.log")
+    benchmark: benchmark_file('annotate_segments', "{prefix}")
+    threads: rule_threads('annotate_segments')
+    resources: **memory_resources(rule_memory('annotate_segments'))
+    message: fmt("Annotating the segments of {wildcards.prefix}.")
+    shell:
+        nice('python', ["{DIR_scripts}/annotateRegions.py",
+                        "--features={input.features}",
+                        "--bed={input.bedfile}",
+                        "--output={output}",
+                        "--cores={threads}"], "{log}")
+
+rule annotate_diffmeth:
+    input:
+        bedfile     = os.path.join(DIR_diffmeth, "{treatment}_diffmeth.bed"),
+        features    = ANNOTATION_FEATURES
+    output:
+        os.path.join(DIR_diffmeth, "{treatment}_diffmeth_annotated.tsv")
+    log:
+        os.path.join(DIR_diffmeth, "{treatment}_diffmeth_annotated.log")
+    benchmark: benchmark_file('annotate_diffmeth', "{treatment}")
+    threads: rule_threads('annotate_diffmeth')
+    resources: **memory_resources(rule_memory('annotate_diffmeth'))
+    message: fmt("Annotating the differentially methylated cytosines of {wildcards.treatment}.")
+    shell:
+        nice('python', ["{DIR_scripts}/annotateRegions.py",
+                        "--features={input.features}",
+                        "--bed={input.bedfile}",
+                        "--output={output}",
+                        "--cores={threads}"], "{log}")
+
+#-----------------------
+# The statistics shown in a report are computed ahead of rendering,
+# so that rendering only reads a small file.
+rule report_data:
+    input:
+        rdsfile     = os.path.join(DIR_methcall,"{prefix}_methylRaw.RDS"),
+        grfile      = os.path.join(DIR_seg,"{prefix}_meth_segments_gr.RDS"),
+        bigwigFile  = os.path.join(DIR_bigwig,   "{prefix}.bw"),
+        segments    = os.path.join(DIR_seg,"{prefix}_meth_segments_annotated.tsv"),
+        annotation  = ANNOTATION_INDEX
+    output:
+        os.path.join(DIR_reportdata,"{prefix}_report_data.RDS")
+    params:
+        TSS_plotlength   = int(config['general']['reports']['TSS_plotlength'])
+    log:
+        os.path.join(DIR_reportdata,"{prefix}_report_data.log")
+    benchmark: benchmark_file('report_data', "{prefix}")
+    threads: rule_threads('report_data')
+    resources: **memory_resources(rule_memory('report_data'))
+    message: fmt("Computing report data of {wildcards.prefix}.")
+    shell:
+        nice('Rscript', ["{DIR_scripts}/reportData.R",
+                         "--mode=sample",
+                         "--methCallRDS={input.rdsfile}",
+                         "--bigwigFile={input.bigwigFile}",
+                         "--segmentAnnotation={input.segments}",
+                         "--annotationIndex={input.annotation}",
+                         "--TSS_plotlength={params.TSS_plotlength}",
+                         "--output={output}",
+                         "--logFile={log}"])
 
 
 
@@ -244,12 +383,8 @@ rule final_report:
 
 rule diffmeth_report:
     input:
-        bedfile            = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmeth.bed',   wc),
-        RDSdiffFile        = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmeth.RDS',   wc),
-        RDSdiffFile_hyper  = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmethhyper.RDS',  wc),
-        RDSdiffFile_hypo   = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmethhypo.RDS',   wc),
-        RDSdiffFile_nonsig = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmethnonsig.RDS', wc),
-        template           = os.path.join(DIR_templates,"diffmeth.Rmd"),
+        reportData         = os.path.join(DIR_reportdata, "diffmeth.{treatment}_report_data.RDS"),
+        template          = os.path.join(DIR_templates,"diffmeth.Rmd"),
         chrom_seqlengths   = os.path.join(DIR_mapped,"Refgen_"+ASSEMBLY+"_chromlengths.csv")
     output:
         report        = os.path.join(DIR_final, "diffmeth-report.{treatment}.html")
@@ -271,61 +406,193 @@ rule diffmeth_report:
         methylDiff_file         = lambda wc: makeDiffMethPath(DIR_diffmeth,  '_diffmeth.RDS', wc),
         methylDiff_hyper_file   = lambda wc: makeDiffMethPath(DIR_diffmeth,  '_diffmethhyper.RDS', wc),
         methylDiff_hypo_file    = lambda wc: makeDiffMethPath(DIR_diffmeth,  '_diffmethhypo.RDS', wc),
-        methylDiff_nonsig_file  = lambda wc: makeDiffMethPath(DIR_diffmeth,  '_diffmethnonsig.RDS', wc)
+        methylDiff_nonsig_file  = lambda wc: makeDiffMethPath(DIR_diffmeth,  '_diffmethnonsig.RDS', wc),
+        reportData              = os.path.join(DIR_reportdata, "diffmeth.{treatment}_report_data.RDS")
     log:
         os.path.join(DIR_final,"diffmeth-report.{treatment}.log")
+    benchmark: benchmark_file('diffmeth_report', "{treatment}")
+    threads: rule_threads('diffmeth_report')
+    resources: **memory_resources(rule_memory('diffmeth_report'))
     message: fmt("Compiling differential methylation report " + "for treatment " + "{wildcards.treatment}")
     run:
-        generateReport(input, output, params, log, "")
+        generateReport(input, output, params, log, "", rule)
+
+#-----------------------
+rule diffmeth_report_data:
+    input:
+        RDSdiffFile        = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmeth.RDS',   wc),
+        RDSdiffFile_hyper  = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmethhyper.RDS',  wc),
+        RDSdiffFile_hypo   = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmethhypo.RDS',   wc),
+        RDSdiffFile_nonsig = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmethnonsig.RDS', wc),
+        diffmethAnnotation = lambda wc: makeDiffMethPath(DIR_diffmeth, '_diffmeth_annotated.tsv', wc),
+        annotation         = ANNOTATION_INDEX
+    output:
+        os.path.join(DIR_reportdata, "diffmeth.{treatment}_report_data.RDS")
+    log:
+        os.path.join(DIR_reportdata, "diffmeth.{treatment}_report_data.log")
+    benchmark: benchmark_file('diffmeth_report_data', "{treatment}")
+    threads: rule_threads('diffmeth_report_data')
+    resources: **memory_resources(rule_memory('diffmeth_report_data'))
+    message: fmt("Computing report data of the differential methylation of treatment {wildcards.treatment}")
+    shell:
+        nice('Rscript', ["{DIR_scripts}/reportData.R",
+                         "--mode=diffmeth",
+                         "--methylDiff_file={input.RDSdiffFile}",
+                         "--methylDiff_hyper_file={input.RDSdiffFile_hyper}",
+                         "--methylDiff_hypo_file={input.RDSdiffFile_hypo}",
+                         "--methylDiff_nonsig_file={input.RDSdiffFile_nonsig}",
+                         "--diffmethAnnotation={input.diffmethAnnotation}",
+                         "--annotationIndex={input.annotation}",
+                         "--output={output}",
+                         "--logFile={log}"])
 
 
 # ==========================================================================================
 # Perform differential methylation analysis:
 
-rule diffmeth:
-    ## paths inside input and output should be relative
+if DIFFMETH_BATCHED:
+    # All treatment groups are tested in one job, which reads every
+    # tile of the methylation matrix once for all of them.
+    DIFFMETH_CONTRASTS = ["vs".join(group) for group in TREAT_GROUPS or [] if group]
+
+    rule diffmeth:
+        input:
+            matrix      = diffmeth_input_function
+        output:
+            [diffmeth_path(DIR_diffmeth, suffix, contrast)
+             for contrast in DIFFMETH_CONTRASTS
+             for suffix in ['_diffmeth.RDS', '_diffmethhyper.RDS', '_diffmethhypo.RDS',
+                            '_diffmethnonsig.RDS', '_diffmeth.bed']]
+        params:
+            workdir     = OUTDIR,
+            scripts_dir = DIR_scripts,
+            matrix      = os.path.join(OUTDIR, DIR_diffmeth, "united_methylMatrix"),
+            contrasts   = DIFFMETH_CONTRASTS,
+            sampleids   = united_sampleids(),
+            treatment   = [config["SAMPLES"][sampleid]['Treatment'] for sampleid in united_sampleids()],
+            prefixes    = [os.path.join(OUTDIR, diffmeth_path(DIR_diffmeth, '', contrast))
+                           for contrast in DIFFMETH_CONTRASTS],
+            assembly    = ASSEMBLY,
+            qvalue      = float(config['general']['differential-methylation']['qvalue']),
+            difference  = float(config['general']['differential-methylation']['difference']),
+            mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
+            cores       = int(config['general']['differential-methylation']['cores']),
+            tileSize    = int(config['general']['differential-methylation']['tile-size'])
+        log:
+            os.path.join(DIR_diffmeth, "diffmeth_batched.log")
+        benchmark: benchmark_file('diffmeth', "batched")
+        threads: rule_threads('diffmeth', config['general']['differential-methylation']['cores'])
+        resources: **memory_resources(rule_memory('diffmeth'))
+        message: fmt("Calculating differential methylation of all treatment groups.")
+        shell:
+            nice('Rscript', ['{DIR_scripts}/methDiff.R',
+                             '--matrix={params.matrix}',
+                             '--scriptsDir={params.scripts_dir}',
+                             '--contrasts="{params.contrasts}"',
+                             '--sampleids="{params.sampleids}"',
+                             '--treatment="{params.treatment}"',
+                             '--outputPrefixes="{params.prefixes}"',
+                             '--assembly={params.assembly}',
+                             '--qvalue={params.qvalue}',
+                             '--difference={params.difference}',
+                             '--mincov={params.mincov}',
+                             '--cores={params.cores}',
+                             '--tileSize={params.tileSize}',
+                             '--logFile={log}'])
+
+else:
+    rule diffmeth:
+        ## paths inside input and output should be relative
+        input:
+            matrix      = diffmeth_input_function
+        output:
+            methylDiff_file        = os.path.join(DIR_diffmeth, "{treatment}_diffmeth.RDS"),
+            methylDiff_hyper_file  = os.path.join(DIR_diffmeth, "{treatment}_diffmethhyper.RDS"),
+            methylDiff_hypo_file   = os.path.join(DIR_diffmeth, "{treatment}_diffmethhypo.RDS"),
+            methylDiff_nonsig_file = os.path.join(DIR_diffmeth, "{treatment}_diffmethnonsig.RDS"),
+            bedfile                = os.path.join(DIR_diffmeth, '{treatment}_diffmeth.bed')
+        params:
+            workdir     = OUTDIR,
+            scripts_dir = DIR_scripts,
+            matrix      = os.path.join(OUTDIR, DIR_diffmeth, "united_methylMatrix"),
+            sampleids   = lambda wc: get_sampleids_from_treatment(wc.treatment),
+            treatment   = lambda wc: [config["SAMPLES"][sampleid]['Treatment'] for sampleid in get_sampleids_from_treatment(wc.treatment)],
+            assembly    = ASSEMBLY,
+            qvalue      = float(config['general']['differential-methylation']['qvalue']),
+            difference  = float(config['general']['differential-methylation']['difference']),
+            mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
+            cores       = int(config['general']['differential-methylation']['cores']),
+            tileSize    = int(config['general']['differential-methylation']['tile-size']),
+            methylDiff_file        = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmeth.RDS"),
+            methylDiff_hyper_file  = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmethhyper.RDS"),
+            methylDiff_hypo_file   = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmethhypo.RDS"),
+            methylDiff_nonsig_file = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmethnonsig.RDS"),
+            outBed      = os.path.join(OUTDIR,DIR_diffmeth,"{treatment}_diffmeth.bed")
+        log:
+            os.path.join(DIR_diffmeth+"{treatment}_diffmeth.log")
+        benchmark: benchmark_file('diffmeth', "{treatment}")
+        threads: rule_threads('diffmeth', config['general']['differential-methylation']['cores'])
+        resources: **memory_resources(rule_memory('diffmeth'))
+        message: fmt("Calculating differential methylation.")
+        shell:
+            nice('Rscript', ['{DIR_scripts}/methDiff.R',
+                             '--matrix={params.matrix}',
+                             '--scriptsDir={params.scripts_dir}',
+                             '--sampleids="{params.sampleids}"',
+                             '--treatment="{params.treatment}"',
+                             '--assembly={params.assembly}',
+                             '--qvalue={params.qvalue}',
+                             '--difference={params.difference}',
+                             '--mincov={params.mincov}',
+                             '--cores={params.cores}',
+                             '--tileSize={params.tileSize}',
+                             '--methylDiff_file={params.methylDiff_file}',
+                             '--methylDiff_hyper_file={params.methylDiff_hyper_file}',
+                             '--methylDiff_hypo_file={params.methylDiff_hypo_file}',
+                             '--methylDiff_nonsig_file={params.methylDiff_nonsig_file}',
+                             '--outBed={params.outBed}',
+                             '--logFile={log}'])
+
+
+
+
+# ==========================================================================================
+# Collect the methylation calls of all compared samples in one matrix:
+
+# Snakemake deletes the matrix before the rule runs, so uniteSamples.R
+# keeps a copy of the last matrix it wrote ("united_methylMatrix.previous",
+# a hard link where possible) and reuses the unchanged samples of that
+# copy; only the stores of new or changed samples are read.
+rule unite_samples:
     input:
-        inputfiles  = diffmeth_input_function
+        stores      = [os.path.join(DIR_methcall, sample_prefix(sampleid) + "_methylStore" + ext)
+                       for sampleid in united_sampleids() for ext in [".bin", ".idx"]]
     output:
-        methylDiff_file        = os.path.join(DIR_diffmeth, "{treatment}_diffmeth.RDS"),
-        methylDiff_hyper_file  = os.path.join(DIR_diffmeth, "{treatment}_diffmethhyper.RDS"),
-        methylDiff_hypo_file   = os.path.join(DIR_diffmeth, "{treatment}_diffmethhypo.RDS"),
-        methylDiff_nonsig_file = os.path.join(DIR_diffmeth, "{treatment}_diffmethnonsig.RDS"),
-        bedfile                = os.path.join(DIR_diffmeth, '{treatment}_diffmeth.bed')
+        matrix      = united_matrix_files(),
+        manifest    = os.path.join(DIR_diffmeth, "united_samples.txt")
     params:
-        workdir     = OUTDIR,
         scripts_dir = DIR_scripts,
-        inputfiles  = diffmeth_input_function,
-        sampleids   = lambda wc: get_sampleids_from_treatment(wc.treatment),
-        treatment   = lambda wc: [config["SAMPLES"][sampleid]['Treatment'] for sampleid in get_sampleids_from_treatment(wc.treatment)],
-        assembly    = ASSEMBLY,
-        qvalue      = float(config['general']['differential-methylation']['qvalue']),
-        difference  = float(config['general']['differential-methylation']['difference']),
-        mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
-        cores       = int(config['general']['differential-methylation']['cores']),
-        methylDiff_file        = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmeth.RDS"),
-        methylDiff_hyper_file  = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmethhyper.RDS"),
-        methylDiff_hypo_file   = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmethhypo.RDS"),
-        methylDiff_nonsig_file = os.path.join(OUTDIR, DIR_diffmeth, "{treatment}_diffmethnonsig.RDS"),
-        outBed      = os.path.join(OUTDIR,DIR_diffmeth,"{treatment}_diffmeth.bed")
+        stores      = [os.path.join(OUTDIR, DIR_methcall, sample_prefix(sampleid) + "_methylStore")
+                       for sampleid in united_sampleids()],
+        sampleids   = united_sampleids(),
+        matrix      = os.path.join(OUTDIR, DIR_diffmeth, "united_methylMatrix"),
+        previous    = os.path.join(OUTDIR, DIR_diffmeth, "united_methylMatrix.previous"),
+        mincov      = int(config['general']['methylation-calling']['minimum-coverage'])
     log:
-        os.path.join(DIR_diffmeth+"{treatment}_diffmeth.log")
-    message: fmt("Calculating differential methylation.")
+        os.path.join(DIR_diffmeth, "united_samples.log")
+    benchmark: benchmark_file('unite_samples')
+    threads: rule_threads('unite_samples')
+    resources: **memory_resources(rule_memory('unite_samples'))
+    message: fmt("Collecting the methylation calls of all compared samples.")
     shell:
-        nice('Rscript', ['{DIR_scripts}/methDiff.R',
-                         '--inputfiles="{params.inputfiles}"',
+        nice('Rscript', ['{DIR_scripts}/uniteSamples.R',
+                         '--stores="{params.stores}"',
                          '--sampleids="{params.sampleids}"',
-                         '--treatment="{params.treatment}"',
-                         '--assembly={params.assembly}',
-                         '--qvalue={params.qvalue}',
-                         '--difference={params.difference}',
+                         '--matrix={params.matrix}',
+                         '--previous={params.previous}',
+                         '--manifest={output.manifest}',
                          '--mincov={params.mincov}',
-                         '--cores={params.cores}',
-                         '--methylDiff_file={params.methylDiff_file}',
-                         '--methylDiff_hyper_file={params.methylDiff_hyper_file}',
-                         '--methylDiff_hypo_file={params.methylDiff_hypo_file}',
-                         '--methylDiff_nonsig_file={params.methylDiff_nonsig_file}',
-                         '--outBed={params.outBed}',
+                         '--scriptsDir={params.scripts_dir}',
                          '--logFile={log}'])
 
 
@@ -334,79 +601,326 @@ rule diffmeth:
 # ==========================================================================================
 # Perform segmentation on the methylome:
 
-rule methseg:
-    ## paths inside input and output should be relative
-    input:
-        rdsfile      = os.path.join(DIR_methcall,"{prefix}_methylRaw.RDS")
-    output:
-        grfile       = os.path.join(DIR_seg,"{prefix}_meth_segments_gr.RDS"),
-        bedfile      = os.path.join(DIR_seg,"{prefix}_meth_segments.bed")
-    params:
-        methCallRDS  = os.path.join(OUTDIR,DIR_methcall,"{prefix}_methylRaw.RDS"),
-        methSegGR    = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments_gr.RDS"),
-        methSegBed   = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.bed"),
-        methSegPng   = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.png")
-    log:
-        os.path.join(DIR_seg,"{prefix}_meth_segments.log")
-    message: fmt("Segmenting methylation profile for {input.rdsfile}.")
-    shell:
-        nice('Rscript', ["{DIR_scripts}/methSeg.R",
-                         "--rds={params.methCallRDS}",
-                         "--grds={params.methSegGR}",
-                         "--outBed={params.methSegBed}",
-                         "--png={params.methSegPng}",
-                         "--logFile={log}"])
+if SHARDS > 1:
+    rule methseg:
+        input:
+            shards       = lambda wc: shard_files(DIR_seg, wc.prefix, "_meth_segments_gr.RDS")
+        output:
+            grfile       = os.path.join(DIR_seg,"{prefix}_meth_segments_gr.RDS"),
+            bedfile      = os.path.join(DIR_seg,"{prefix}_meth_segments.bed")
+        params:
+            sampleid     = "{prefix}",
+            assembly     = ASSEMBLY,
+            methSegGR    = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments_gr.RDS"),
+            methSegBed   = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.bed")
+        log:
+            os.path.join(DIR_seg,"{prefix}_meth_segments.log")
+        benchmark: benchmark_file('methseg', "{prefix}")
+        threads: rule_threads('methseg')
+        resources: **memory_resources(rule_memory('methseg'))
+        message: fmt("Merging methylation segments for {wildcards.prefix}.")
+        shell:
+            nice('Rscript', ["{DIR_scripts}/methSeg.R",
+                             "--segments=\"{input.shards}\"",
+                             "--sampleid={params.sampleid}",
+                             "--assembly={params.assembly}",
+                             "--grds={params.methSegGR}",
+                             "--outBed={params.methSegBed}",
+                             "--logFile={log}"])
+
+    #-----------------------
+    rule methseg_shard:
+        input:
+            rdsfile      = os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_methylRaw.RDS")
+        output:
+            grfile       = os.path.join(DIR_seg,"shards","{prefix}.shard{shard}_meth_segments_gr.RDS"),
+            bedfile      = os.path.join(DIR_seg,"shards","{prefix}.shard{shard}_meth_segments.bed")
+        params:
+            methSegPng   = os.path.join(DIR_seg,"shards","{prefix}.shard{shard}_meth_segments.png")
+        log:
+            os.path.join(DIR_seg,"shards","{prefix}.shard{shard}_meth_segments.log")
+        benchmark: benchmark_file('methseg_shard', "{prefix}.shard{shard}")
+        threads: rule_threads('methseg_shard')
+        resources: **memory_resources(rule_memory('methseg_shard'))
+        message: fmt("Segmenting methylation profile for {input.rdsfile}.")
+        shell:
+            nice('Rscript', ["{DIR_scripts}/methSeg.R",
+                             "--rds={input.rdsfile}",
+                             "--grds={output.grfile}",
+                             "--outBed={output.bedfile}",
+                             "--png={params.methSegPng}",
+                             "--logFile={log}"])
+
+else:
+    # The chromosomes are read from the methylation store and segmented
+    # in parallel worker processes; the time each took is written to
+    # the "_meth_segments_chromosomes.tsv" table.
+    rule methseg:
+        ## paths inside input and output should be relative
+        input:
+            store        = [os.path.join(DIR_methcall,"{prefix}_methylStore.bin"),
+                            os.path.join(DIR_methcall,"{prefix}_methylStore.idx")]
+        output:
+            grfile       = os.path.join(DIR_seg,"{prefix}_meth_segments_gr.RDS"),
+            bedfile      = os.path.join(DIR_seg,"{prefix}_meth_segments.bed"),
+            timings      = os.path.join(DIR_seg,"{prefix}_meth_segments_chromosomes.tsv")
+        params:
+            store        = os.path.join(DIR_methcall,"{prefix}_methylStore"),
+            sampleid     = "{prefix}",
+            assembly     = ASSEMBLY,
+            workerMemory = memory_mb(rule_settings('methseg').get('worker-memory', 0)),
+            minSites     = int(config['general']['segmentation']['min-sites']),
+            methSegGR    = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments_gr.RDS"),
+            methSegBed   = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.bed"),
+            methSegPng   = os.path.join(OUTDIR,DIR_seg,"{prefix}_meth_segments.png")
+        log:
+            os.path.join(DIR_seg,"{prefix}_meth_segments.log")
+        benchmark: benchmark_file('methseg', "{prefix}")
+        threads: rule_threads('methseg')
+        resources: **memory_resources(worker_memory('methseg'))
+        message: fmt("Segmenting methylation profile for {wildcards.prefix}.")
+        shell:
+            nice('Rscript', ["{DIR_scripts}/methSeg.R",
+                             "--store={params.store}",
+                             "--cores={threads}",
+                             "--workerMemory={params.workerMemory}",
+                             "--minSites={params.minSites}",
+                             "--sampleid={params.sampleid}",
+                             "--assembly={params.assembly}",
+                             "--timings={output.timings}",
+                             "--grds={params.methSegGR}",
+                             "--outBed={params.methSegBed}",
+                             "--png={params.methSegPng}",
+                             "--logFile={log}"])
+
 
 
 
-
 # ==========================================================================================
-# Export a bigwig file:
+# Export bigwig files of the methylation levels and the read coverage:
 
+# The calls are streamed from the methylation store one chromosome at a
+# time, so this does not need to be split into chromosome shards.
 rule export_bigwig:
     input:
         seqlengths = os.path.join(DIR_mapped,   "Refgen_"+ASSEMBLY+"_chromlengths.csv"),
-        rdsfile    = os.path.join(DIR_methcall, "{bigwig_prefix}_methylRaw.RDS")
+        store      = [os.path.join(DIR_methcall, "{bigwig_prefix}_methylStore.bin"),
+                      os.path.join(DIR_methcall, "{bigwig_prefix}_methylStore.idx")]
     output:
-        bw         = os.path.join(DIR_bigwig,   "{bigwig_prefix}.bw")
+        bw         = os.path.join(DIR_bigwig,   "{bigwig_prefix}.bw"),
+        coverage   = os.path.join(DIR_bigwig,   "{bigwig_prefix}_coverage.bw")
+    wildcard_constraints:
+        bigwig_prefix = "[^/]+(?<!_coverage)"
+    params:
+        store      = os.path.join(DIR_methcall, "{bigwig_prefix}_methylStore")
+    benchmark: benchmark_file('export_bigwig', "{bigwig_prefix}")
+    threads: rule_threads('export_bigwig')
+    resources: **memory_resources(rule_memory('export_bigwig'))
     message: fmt("exporting bigwig files.")
     shell:
-        nice('Rscript', ["{DIR_scripts}/export_bw.R",
-                         "{input.rdsfile}",
-                         "{input.seqlengths}",
-                         ASSEMBLY,
-                         "{output}"])
-
+        nice('python', ["{DIR_scripts}/export_bw.py",
+                        "--store={params.store}",
+                        "--seqlengths={input.seqlengths}",
+                        "--methylation={output.bw}",
+                        "--coverage={output.coverage}"])
+
 # ==========================================================================================
 # Process bam files into methyl-called formats:
 
-rule bam_methCall:
-    input:
-        bamfile     = os.path.join(DIR_sorted,"{prefix}.bam")
-    output:
-        rdsfile     = os.path.join(DIR_methcall,"{prefix}_methylRaw.RDS"),
-        callFile    = os.path.join(DIR_methcall,"{prefix}_CpG.txt")
-    params:
-        ## absolute path to bamfiles
-        inBam       = os.path.join(OUTDIR,DIR_sorted,"{prefix}.bam"),
-        assembly    = ASSEMBLY,
-        mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
-        minqual     = int(config['general']['methylation-calling']['minimum-quality']),
-        ## absolute path to output folder in working dir
-        rds         = os.path.join(OUTDIR,DIR_methcall,"{prefix}_methylRaw.RDS")
-    log:
-        os.path.join(DIR_methcall,"{prefix}_meth_calls.log")
-    message: fmt("Extract methylation calls from bam file.")
-    shell:
+# The "methylKit" engine lets processBismarkAln() read the whole bam
+# file in R; the "native" engine streams the bam file through
+# scripts/methCall.py chromosome by chromosome and only hands the
+# resulting table to R for conversion into a methylRaw object.  The
+# native engine also writes the methylation store with the read counts.
+METHCALL_ENGINE = config['general']['methylation-calling']['engine'].lower()
+
+if METHCALL_ENGINE == "native":
+    methCall_cmd = " && ".join([
+        nice('python', ["{DIR_scripts}/methCall.py",
+                        "--inBam={params.inBam}",
+                        "--callFile={params.callFile}",
+                        "--store={params.store}",
+                        "--mincov={params.mincov}",
+                        "--minqual={params.minqual}",
+                        "--cores={params.cores}",
+                        "--batch-size={params.batchsize}",
+                        "{params.chroms}",
+                        "--samtools=" + tool('samtools')], "{log}"),
         nice('Rscript', ["{DIR_scripts}/methCall.R",
                          "--inBam={params.inBam}",
+                         "--callFile={params.callFile}",
                          "--assembly={params.assembly}",
                          "--mincov={params.mincov}",
                          "--minqual={params.minqual}",
                          "--rds={params.rds}",
-                         "--logFile={log}"])
+                         "--logFile={log}"])])
+else:
+    methCall_cmd = nice('Rscript', ["{DIR_scripts}/methCall.R",
+                                    "--inBam={params.inBam}",
+                                    "--assembly={params.assembly}",
+                                    "--mincov={params.mincov}",
+                                    "--minqual={params.minqual}",
+                                    "--rds={params.rds}",
+                                    "--logFile={log}"])
+
+if SHARDS > 1:
+    # Gather the per-shard tables and convert them into a single
+    # methylRaw object.
+    rule bam_methCall:
+        input:
+            shards      = lambda wc: shard_files(DIR_methcall, wc.prefix, "_CpG.txt")
+        output:
+            rdsfile     = os.path.join(DIR_methcall,"{prefix}_methylRaw.RDS"),
+            callFile    = os.path.join(DIR_methcall,"{prefix}_CpG.txt")
+        params:
+            inBam       = os.path.join(OUTDIR,DIR_sorted,"{prefix}.bam"),
+            assembly    = ASSEMBLY,
+            mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
+            minqual     = int(config['general']['methylation-calling']['minimum-quality']),
+            rds         = os.path.join(OUTDIR,DIR_methcall,"{prefix}_methylRaw.RDS"),
+            callFile    = os.path.join(OUTDIR,DIR_methcall,"{prefix}_CpG.txt")
+        log:
+            os.path.join(DIR_methcall,"{prefix}_meth_calls.log")
+        benchmark: benchmark_file('bam_methCall', "{prefix}")
+        threads: rule_threads('bam_methCall', config['general']['methylation-calling']['cores'])
+        resources: **memory_resources(rule_memory('bam_methCall'))
+        message: fmt("Merging methylation calls for {wildcards.prefix}.")
+        shell:
+            " && ".join([
+                nice('python', ["{DIR_scripts}/chromShards.py", "gather",
+                                "--header=1",
+                                "--output={params.callFile}",
+                                "{input.shards}"], "{log}"),
+                nice('Rscript', ["{DIR_scripts}/methCall.R",
+                                 "--inBam={params.inBam}",
+                                 "--callFile={params.callFile}",
+                                 "--assembly={params.assembly}",
+                                 "--mincov={params.mincov}",
+                                 "--minqual={params.minqual}",
+                                 "--rds={params.rds}",
+                                 "--logFile={log}"])])
+
+    #-----------------------
+    rule bam_methCall_shard:
+        input:
+            bamfile     = os.path.join(DIR_sorted,"{prefix}.bam"),
+            index       = os.path.join(DIR_sorted,"{prefix}.bam.bai"),
+            seqlengths  = os.path.join(DIR_mapped,"Refgen_"+ASSEMBLY+"_chromlengths.csv")
+        output:
+            rdsfile     = os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_methylRaw.RDS"),
+            callFile    = os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_CpG.txt"),
+            store       = [os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_methylStore.bin"),
+                           os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_methylStore.idx")]
+        params:
+            inBam       = os.path.join(OUTDIR,DIR_sorted,"{prefix}.bam"),
+            assembly    = ASSEMBLY,
+            mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
+            minqual     = int(config['general']['methylation-calling']['minimum-quality']),
+            cores       = int(config['general']['methylation-calling']['cores']),
+            batchsize   = int(config['general']['methylation-calling']['batch-size']),
+            chroms      = "--chroms=$(" + " ".join([tool('python'), DIR_scripts + "chromShards.py", "assign",
+                                                     "--seqlengths=" + os.path.join(DIR_mapped,"Refgen_"+ASSEMBLY+"_chromlengths.csv"),
+                                                     "--shards=" + str(SHARDS),
+                                                     "--shard={shard}"]) + ")",
+            rds         = os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_methylRaw.RDS"),
+            callFile    = os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_CpG.txt"),
+            store       = os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_methylStore")
+        log:
+            os.path.join(DIR_methcall,"shards","{prefix}.shard{shard}_meth_calls.log")
+        benchmark: benchmark_file('bam_methCall_shard', "{prefix}.shard{shard}")
+        threads: rule_threads('bam_methCall', config['general']['methylation-calling']['cores'])
+        resources: **memory_resources(rule_memory('bam_methCall'))
+        message: fmt("Extract methylation calls for shard {wildcards.shard} from bam file.")
+        shell:
+            methCall_cmd
+
+else:
+    rule bam_methCall:
+        input:
+            bamfile     = os.path.join(DIR_sorted,"{prefix}.bam"),
+            index       = [ os.path.join(DIR_sorted,"{prefix}.bam.bai") ] if METHCALL_ENGINE == "native" else []
+        output:
+            rdsfile     = os.path.join(DIR_methcall,"{prefix}_methylRaw.RDS"),
+            callFile    = os.path.join(DIR_methcall,"{prefix}_CpG.txt"),
+            store       = [os.path.join(DIR_methcall,"{prefix}_methylStore.bin"),
+                           os.path.join(DIR_methcall,"{prefix}_methylStore.idx")] if METHCALL_ENGINE == "native" else []
+        params:
+            ## absolute path to bamfiles
+            inBam       = os.path.join(OUTDIR,DIR_sorted,"{prefix}.bam"),
+            assembly    = ASSEMBLY,
+            mincov      = int(config['general']['methylation-calling']['minimum-coverage']),
+            minqual     = int(config['general']['methylation-calling']['minimum-quality']),
+            cores       = int(config['general']['methylation-calling']['cores']),
+            batchsize   = int(config['general']['methylation-calling']['batch-size']),
+            chroms      = "",
+            ## absolute path to output folder in working dir
+            rds         = os.path.join(OUTDIR,DIR_methcall,"{prefix}_methylRaw.RDS"),
+            callFile    = os.path.join(OUTDIR,DIR_methcall,"{prefix}_CpG.txt"),
+            store       = os.path.join(OUTDIR,DIR_methcall,"{prefix}_methylStore")
+        log:
+            os.path.join(DIR_methcall,"{prefix}_meth_calls.log")
+        benchmark: benchmark_file('bam_methCall', "{prefix}")
+        threads: rule_threads('bam_methCall', config['general']['methylation-calling']['cores'])
+        resources: **memory_resources(rule_memory('bam_methCall'))
+        message: fmt("Extract methylation calls from bam file.")
+        shell:
+            staged(methCall_cmd, inputs=["{input.bamfile:q}", "{input.index:q}"])
+
+#-----------------------
+# Write the methylation calls to a columnar store, from which single
+# chromosomes or regions can be read without loading the whole sample.
+# The native engine writes the store of a sample, or of its shards,
+# from the read counts; the table of the methylKit engine is converted.
+if SHARDS > 1:
+    rule methyl_store:
+        input:
+            binfiles    = lambda wc: shard_files(DIR_methcall, wc.prefix, "_methylStore.bin"),
+            idxfiles    = lambda wc: shard_files(DIR_methcall, wc.prefix, "_methylStore.idx")
+        output:
+            binfile     = os.path.join(DIR_methcall,"{prefix}_methylStore.bin"),
+            idxfile     = os.path.join(DIR_methcall,"{prefix}_methylStore.idx")
+        params:
+            store       = os.path.join(DIR_methcall,"{prefix}_methylStore"),
+            shards      = lambda wc: shard_files(DIR_methcall, wc.prefix, "_methylStore")
+        benchmark: benchmark_file('methyl_store', "{prefix}")
+        threads: rule_threads('methyl_store')
+        resources: **memory_resources(rule_memory('methyl_store'))
+        message: fmt("Merging methylation stores for {wildcards.prefix}.")
+        shell:
+            nice('python', ["{DIR_scripts}/methylStore.py", "merge",
+                            "--store={params.store}", "{params.shards}"])
+
+elif METHCALL_ENGINE != "native":
+    rule methyl_store:
+        input:
+            callFile    = os.path.join(DIR_methcall,"{prefix}_CpG.txt")
+        output:
+            binfile     = os.path.join(DIR_methcall,"{prefix}_methylStore.bin"),
+            idxfile     = os.path.join(DIR_methcall,"{prefix}_methylStore.idx")
+        params:
+            store       = os.path.join(DIR_methcall,"{prefix}_methylStore")
+        benchmark: benchmark_file('methyl_store', "{prefix}")
+        threads: rule_threads('methyl_store')
+        resources: **memory_resources(rule_memory('methyl_store'))
+        message: fmt("Writing methylation store for {wildcards.prefix}.")
+        shell:
+            nice('python', ["{DIR_scripts}/methylStore.py", "write",
+                            "--callFile={input.callFile}", "--store={params.store}"])
+
+#-----------------------
+rule index_bam:
+    input:
+        os.path.join(DIR_sorted,"{prefix}.bam")
+    output:
+        os.path.join(DIR_sorted,"{prefix}.bam.bai")
+    benchmark: benchmark_file('index_bam', "{prefix}")
+    threads: rule_threads('index_bam')
+    resources: **memory_resources(rule_memory('index_bam'))
+    message: fmt("Indexing bam file {input}")
+    shell:
+        nice('samtools', ["index", "{input}", "{output}"])
+
 
-
 # ==========================================================================================
 # Deduplicate aligned reads from the bam file:
 
@@ -420,9 +934,12 @@ rule deduplication_se:
         sampath="--samtools_path " + tool('samtools')
     log:
         DIR_sorted+"{sample}_deduplication.log"
+    benchmark: benchmark_file('deduplication_se', "{sample}")
+    threads: rule_threads('deduplication_se')
+    resources: **memory_resources(rule_memory('deduplication_se'))
     message: fmt("Deduplicating single-end aligned reads from {input}")
     shell:
-        nice('samtools', [" markdup -rs ", "{input}", "{output}"], "{log}")
+        staged(nice('samtools', [" markdup -rs ", "{input}", "{output}"], "{log}"))
 
 #-----------------------
 rule deduplication_pe:
@@ -432,131 +949,515 @@ rule deduplication_pe:
         DIR_sorted+"{sample}_1_val_1_bt2.sorted.deduped.bam"
     log:
         DIR_sorted+"{sample}_deduplication.log"
+    benchmark: benchmark_file('deduplication_pe', "{sample}")
+    threads: rule_threads('deduplication_pe')
+    resources: **memory_resources(rule_memory('deduplication_pe'))
     message: fmt("Deduplicating paired-end aligned reads from {input}")
     shell:
-        nice('samtools', [" markdup -r ", "{input}", "{output}"], "{log}")
+        staged(nice('samtools', [" markdup -r ", "{input}", "{output}"], "{log}"))
 
 
 
+# ==========================================================================================
+# Optionally align, sort and deduplicate in a single job without writing
+# the intermediate bam files to disk:
+
+if config['execution']['fused-alignment']:
+    ruleorder: bismark_dedup_fused_se > deduplication_se
+    ruleorder: bismark_dedup_fused_pe > deduplication_pe
+    ruleorder: bismark_dedup_fused_se > bismark_align_and_map_se
+    ruleorder: bismark_dedup_fused_pe > bismark_align_and_map_pe
+
+    samtools_threads     = str(config['tools']['samtools']['threads'])
+    samtools_sort_memory = str(config['tools']['samtools']['sort-memory'])
+
+    rule bismark_dedup_fused_se:
+        input:
+            refconvert_CT = bisulfite_index("CT"),
+            refconvert_GA = bisulfite_index("GA"),
+            fqfile = DIR_trimmed+"{sample}_trimmed"+TRIMMED_EXT,
+            qc     = posttrim_qc('se')
+        output:
+            bam    = DIR_sorted+"{sample}_se_bt2.sorted.deduped.bam",
+            report = DIR_mapped+"{sample}_trimmed_bismark_bt2_SE_report.txt"
+        params:
+            bismark_args = config['tools']['bismark']['args'],
+            genomeFolder = lambda wc: "--genome_folder " + genome_path(wc.sample),
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            samtools     = "--samtools_path "+ os.path.dirname(tool('samtools')),
+            cores        = "--multicore " + bismark_cores
+        log:
+            DIR_mapped+"{sample}_bismark_se_mapping.log"
+        benchmark: benchmark_file('bismark_dedup_fused_se', "{sample}")
+        threads: rule_threads('bismark_align_and_map_se')
+        resources: **memory_resources(rule_memory('bismark_align_and_map_se'))
+        message: fmt("Mapping and deduplicating single-end reads to genome {ASSEMBLY}")
+        shell:
+            staged(nice('python', ["{DIR_scripts}/alignDedup.py",
+                                   "--samtools=" + tool('samtools'),
+                                   "--threads=" + samtools_threads,
+                                   "--sort-memory=" + samtools_sort_memory,
+                                   "--bam-name={wildcards.sample}_trimmed_bismark_bt2.bam",
+                                   "--output={output.bam}",
+                                   "--report-dir=" + DIR_mapped,
+                                   "--tmpdir=" + scratch_or(DIR_sorted),
+                                   "--", tool('bismark'), "{params}", "{input.fqfile}"], "{log}"),
+                   inputs=["{input.fqfile:q}"])
+
+    rule bismark_dedup_fused_pe:
+        input:
+            refconvert_CT = bisulfite_index("CT"),
+            refconvert_GA = bisulfite_index("GA"),
+            fin1 = DIR_trimmed+"{sample}_1_val_1"+TRIMMED_EXT,
+            fin2 = DIR_trimmed+"{sample}_2_val_2"+TRIMMED_EXT,
+            qc   = posttrim_qc('pe')
+        output:
+            bam    = DIR_sorted+"{sample}_1_val_1_bt2.sorted.deduped.bam",
+            report = DIR_mapped+"{sample}_1_val_1_bismark_bt2_PE_report.txt"
+        params:
+            bismark_args = config['tools']['bismark']['args'],
+            genomeFolder = lambda wc: "--genome_folder " + genome_path(wc.sample),
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            samtools     = "--samtools_path "+ os.path.dirname(tool('samtools')),
+            cores        = "--multicore " + bismark_cores
+        log:
+            DIR_mapped+"{sample}_bismark_pe_mapping.log"
+        benchmark: benchmark_file('bismark_dedup_fused_pe', "{sample}")
+        threads: rule_threads('bismark_align_and_map_pe')
+        resources: **memory_resources(rule_memory('bismark_align_and_map_pe'))
+        message: fmt("Mapping and deduplicating paired-end reads to genome {ASSEMBLY}.")
+        shell:
+            staged(nice('python', ["{DIR_scripts}/alignDedup.py",
+                                   "--samtools=" + tool('samtools'),
+                                   "--threads=" + samtools_threads,
+                                   "--sort-memory=" + samtools_sort_memory,
+                                   "--paired",
+                                   "--bam-name={wildcards.sample}_1_val_1_bismark_bt2_pe.bam",
+                                   "--output={output.bam}",
+                                   "--report-dir=" + DIR_mapped,
+                                   "--tmpdir=" + scratch_or(DIR_sorted),
+                                   "--", tool('bismark'), "{params}", "-1 {input.fin1}", "-2 {input.fin2}"], "{log}"),
+                   inputs=["{input.fin1:q}", "{input.fin2:q}"])
+
+
+
 # ==========================================================================================
 # Sort the bam file by position (and carry out mate-flagging in paired-end case):
 
 rule sortbam_se:
     input:
-        DIR_mapped+"{sample}_trimmed_bismark_bt2.bam"
+        bam     = DIR_mapped+"{sample}_trimmed_bismark_bt2.bam",
+        regions = reduced_regions
     output:
         DIR_sorted+"{sample}_se_bt2.sorted.bam"
-    message: fmt("Sorting bam file {input}")
-    shell:
-        nice('samtools', ["sort", "{input}", "-o {output}"])
+    benchmark: benchmark_file('sortbam_se', "{sample}")
+    threads: rule_threads('sortbam_se')
+    resources: **memory_resources(rule_memory('sortbam_se'))
+    message: fmt("Sorting bam file {input.bam}")
+    run:
+        if reduced_reference(wildcards.sample):
+            shell(staged(nice('samtools', ["view -h", "{input.bam}", "|"] + lift_to_genome() + ["|", tool('samtools'), "sort", sort_tmp('csort'), "-o {output} -"])))
+        else:
+            shell(staged(nice('samtools', ["sort", sort_tmp('csort'), "{input.bam}", "-o {output}"])))
 
 #-----------------------
 rule sortbam_pe:
     input:
-        DIR_mapped+"{sample}_1_val_1_bismark_bt2_pe.bam"
+        bam     = DIR_mapped+"{sample}_1_val_1_bismark_bt2_pe.bam",
+        regions = reduced_regions
     output:
         DIR_sorted+"{sample}_1_val_1_bt2.sorted.bam"
+    benchmark: benchmark_file('sortbam_pe', "{sample}")
+    threads: rule_threads('sortbam_pe')
+    resources: **memory_resources(rule_memory('sortbam_pe'))
+    message: fmt("Sorting bam file {input.bam}")
+    run:
+        if reduced_reference(wildcards.sample):
+            shell(staged(nice('samtools', ["view -h", "{input.bam}", "|"] + lift_to_genome() + ["|", tool('samtools'), "sort -n", sort_tmp('nsort'), "-", " | ", tool('samtools'), " fixmate -m  - - ", " | ", tool('samtools'), " sort", sort_tmp('csort'), "-o {output} " ])))
+        else:
+            shell(staged(nice('samtools', ["sort -n ", sort_tmp('nsort'), " {input.bam} ", " | ", tool('samtools'), " fixmate -m  - - ", " | ", tool('samtools'), " sort", sort_tmp('csort'), "-o {output} " ])))
+
+#-----------------------
+# Samples given as aligned bam files are named like single-end samples.
+# The launcher links a bam file that is sorted already directly into
+# DIR_sorted; paired reads are sorted again to add the mate tags.
+ruleorder: sortbam_input > sortbam_se
+
+rule sortbam_input:
+    input:
+        PATHIN+"{sample}.bam"
+    output:
+        DIR_sorted+"{sample}_se_bt2.sorted.bam"
+    benchmark: benchmark_file('sortbam_input', "{sample}")
+    threads: rule_threads('sortbam_input')
+    resources: **memory_resources(rule_memory('sortbam_input'))
     message: fmt("Sorting bam file {input}")
-    shell:
-        nice('samtools', ["sort -n ", " {input} ", " | ", tool('samtools'), " fixmate -m  - - ", " | ", tool('samtools'), " sort -o {output} " ])
+    run:
+        if bam_input(wildcards.sample)['paired']:
+            shell(staged(nice('samtools', ["sort -n ", sort_tmp('nsort'), " {input} ", " | ", tool('samtools'), " fixmate -m  - - ", " | ", tool('samtools'), " sort", sort_tmp('csort'), "-o {output} " ])))
+        else:
+            shell(staged(nice('samtools', ["sort", sort_tmp('csort'), "{input}", "-o {output}"])))
 
 
 # ==========================================================================================
 # Align and map reads to the reference genome:
 
-bismark_cores = str(config['tools']['bismark']['cores'])
-
 rule bismark_align_and_map_se:
     input:
-        refconvert_CT = GENOMEPATH+"Bisulfite_Genome/CT_conversion/genome_mfa.CT_conversion.fa",
-	refconvert_GA = GENOMEPATH+"Bisulfite_Genome/GA_conversion/genome_mfa.GA_conversion.fa",
-        fqfile = DIR_trimmed+"{sample}_trimmed.fq.gz",
-        qc     = DIR_posttrim_QC+"{sample}_trimmed_fastqc.html"
+        refconvert_CT = bisulfite_index("CT"),
+	refconvert_GA = bisulfite_index("GA"),
+        fqfile = DIR_trimmed+"{sample}_trimmed"+TRIMMED_EXT,
+        qc     = posttrim_qc('se')
     output:
         DIR_mapped+"{sample}_trimmed_bismark_bt2.bam",
         DIR_mapped+"{sample}_trimmed_bismark_bt2_SE_report.txt"
     params:
         bismark_args = config['tools']['bismark']['args'],
-        genomeFolder = "--genome_folder " + GENOMEPATH,
-        outdir = "--output_dir  "+DIR_mapped,
+        genomeFolder = lambda wc: "--genome_folder " + genome_path(wc.sample),
+        outdir = "--output_dir  "+scratch_or(DIR_mapped, "PIGX_SCRATCH"),
         nucCov = "--nucleotide_coverage",
         pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
         useBowtie2   = "--bowtie2 ",
         samtools     = "--samtools_path "+ os.path.dirname(tool('samtools')),
-        tempdir      = "--temp_dir " + DIR_mapped,
+        tempdir      = "--temp_dir " + scratch_or(DIR_mapped),
         cores = "--multicore " + bismark_cores
     log:
         DIR_mapped+"{sample}_bismark_se_mapping.log"
+    benchmark: benchmark_file('bismark_align_and_map_se', "{sample}")
+    threads: rule_threads('bismark_align_and_map_se')
+    resources: **memory_resources(rule_memory('bismark_align_and_map_se'))
     message: fmt("Mapping single-end reads to genome {ASSEMBLY}")
     shell:
-        nice('bismark', ["{params}", "{input.fqfile}"], "{log}")
+        staged(nice('bismark', ["{params}", "{input.fqfile}"], "{log}"),
+               inputs=["{input.fqfile:q}"], collect=DIR_mapped)
 
 rule bismark_align_and_map_pe:
     input:
-        refconvert_CT = GENOMEPATH+"Bisulfite_Genome/CT_conversion/genome_mfa.CT_conversion.fa",
-	refconvert_GA = GENOMEPATH+"Bisulfite_Genome/GA_conversion/genome_mfa.GA_conversion.fa",
-        fin1 = DIR_trimmed+"{sample}_1_val_1.fq.gz",
-        fin2 = DIR_trimmed+"{sample}_2_val_2.fq.gz",
-        qc   = [ DIR_posttrim_QC+"{sample}_1_val_1_fastqc.html",
-                 DIR_posttrim_QC+"{sample}_2_val_2_fastqc.html"]
+        refconvert_CT = bisulfite_index("CT"),
+	refconvert_GA = bisulfite_index("GA"),
+        fin1 = DIR_trimmed+"{sample}_1_val_1"+TRIMMED_EXT,
+        fin2 = DIR_trimmed+"{sample}_2_val_2"+TRIMMED_EXT,
+        qc   = posttrim_qc('pe')
     output:
         DIR_mapped+"{sample}_1_val_1_bismark_bt2_pe.bam",
         DIR_mapped+"{sample}_1_val_1_bismark_bt2_PE_report.txt"
     params:
         bismark_args = config['tools']['bismark']['args'],
-        genomeFolder = "--genome_folder " + GENOMEPATH,
-        outdir       = "--output_dir  "+DIR_mapped,
+        genomeFolder = lambda wc: "--genome_folder " + genome_path(wc.sample),
+        outdir       = "--output_dir  "+scratch_or(DIR_mapped, "PIGX_SCRATCH"),
         nucCov       = "--nucleotide_coverage",
         pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
         useBowtie2   = "--bowtie2 ",
         samtools     = "--samtools_path "+ os.path.dirname(tool('samtools')),
-        tempdir      = "--temp_dir "+DIR_mapped,
+        tempdir      = "--temp_dir "+scratch_or(DIR_mapped),
         cores        = "--multicore "+bismark_cores
     log:
         DIR_mapped+"{sample}_bismark_pe_mapping.log"
+    benchmark: benchmark_file('bismark_align_and_map_pe', "{sample}")
+    threads: rule_threads('bismark_align_and_map_pe')
+    resources: **memory_resources(rule_memory('bismark_align_and_map_pe'))
     message: fmt("Mapping paired-end reads to genome {ASSEMBLY}.")
     shell:
-        nice('bismark', ["{params}", "-1 {input.fin1}", "-2 {input.fin2}"], "{log}")
+        staged(nice('bismark', ["{params}", "-1 {input.fin1}", "-2 {input.fin2}"], "{log}"),
+               inputs=["{input.fin1:q}", "{input.fin2:q}"], collect=DIR_mapped)
 
 
 
+# ==========================================================================================
+# Optionally align each sample in several read chunks that run as
+# separate jobs, and merge the chunks into the usual outputs:
+
+if ALIGN_CHUNKS > 1:
+    ruleorder: bismark_merge_chunks_se > bismark_align_and_map_se
+    ruleorder: bismark_merge_chunks_pe > bismark_align_and_map_pe
+
+    rule bismark_merge_chunks_se:
+        input:
+            bams    = expand(DIR_mapped+"chunks/{{sample}}_trimmed.chunk{chunk}_bismark_bt2.bam", chunk=range(ALIGN_CHUNKS)),
+            reports = expand(DIR_mapped+"chunks/{{sample}}_trimmed.chunk{chunk}_bismark_bt2_SE_report.txt", chunk=range(ALIGN_CHUNKS))
+        output:
+            bam     = DIR_mapped+"{sample}_trimmed_bismark_bt2.bam",
+            report  = DIR_mapped+"{sample}_trimmed_bismark_bt2_SE_report.txt"
+        benchmark: benchmark_file('bismark_merge_chunks_se', "{sample}")
+        threads: rule_threads('bismark_merge_chunks_se')
+        resources: **memory_resources(rule_memory('bismark_merge_chunks_se'))
+        message: fmt("Merging aligned single-end read chunks of {wildcards.sample}")
+        shell:
+            " && ".join([nice('samtools', ["cat", "-o {output.bam}", "{input.bams}"]),
+                         nice('python', ["{DIR_scripts}/readChunks.py", "merge-reports",
+                                         "--output={output.report}", "{input.reports}"])])
+
+    rule bismark_merge_chunks_pe:
+        input:
+            bams    = expand(DIR_mapped+"chunks/{{sample}}_1_val_1.chunk{chunk}_bismark_bt2_pe.bam", chunk=range(ALIGN_CHUNKS)),
+            reports = expand(DIR_mapped+"chunks/{{sample}}_1_val_1.chunk{chunk}_bismark_bt2_PE_report.txt", chunk=range(ALIGN_CHUNKS))
+        output:
+            bam     = DIR_mapped+"{sample}_1_val_1_bismark_bt2_pe.bam",
+            report  = DIR_mapped+"{sample}_1_val_1_bismark_bt2_PE_report.txt"
+        benchmark: benchmark_file('bismark_merge_chunks_pe', "{sample}")
+        threads: rule_threads('bismark_merge_chunks_pe')
+        resources: **memory_resources(rule_memory('bismark_merge_chunks_pe'))
+        message: fmt("Merging aligned paired-end read chunks of {wildcards.sample}")
+        shell:
+            " && ".join([nice('samtools', ["cat", "-o {output.bam}", "{input.bams}"]),
+                         nice('python', ["{DIR_scripts}/readChunks.py", "merge-reports",
+                                         "--output={output.report}", "{input.reports}"])])
+
+    #-----------------------
+    rule bismark_align_chunk_se:
+        input:
+            refconvert_CT = bisulfite_index("CT"),
+            refconvert_GA = bisulfite_index("GA"),
+            fqfile = DIR_trimmed+"chunks/{sample}_trimmed.chunk{chunk}"+TRIMMED_EXT
+        output:
+            temp(DIR_mapped+"chunks/{sample}_trimmed.chunk{chunk}_bismark_bt2.bam"),
+            DIR_mapped+"chunks/{sample}_trimmed.chunk{chunk}_bismark_bt2_SE_report.txt"
+        params:
+            bismark_args = config['tools']['bismark']['args'],
+            genomeFolder = lambda wc: "--genome_folder " + genome_path(wc.sample),
+            outdir       = "--output_dir  "+DIR_mapped+"chunks/",
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            samtools     = "--samtools_path "+ os.path.dirname(tool('samtools')),
+            tempdir      = "--temp_dir " + DIR_mapped+"chunks/",
+            cores        = "--multicore " + bismark_cores
+        log:
+            DIR_mapped+"chunks/{sample}_trimmed.chunk{chunk}_bismark_se_mapping.log"
+        benchmark: benchmark_file('bismark_align_chunk_se', "{sample}.chunk{chunk}")
+        threads: rule_threads('bismark_align_and_map_se')
+        resources: **memory_resources(rule_memory('bismark_align_and_map_se'))
+        message: fmt("Mapping single-end read chunk {wildcards.chunk} to genome {ASSEMBLY}")
+        shell:
+            nice('bismark', ["{params}", "{input.fqfile}"], "{log}")
+
+    rule bismark_align_chunk_pe:
+        input:
+            refconvert_CT = bisulfite_index("CT"),
+            refconvert_GA = bisulfite_index("GA"),
+            fin1 = DIR_trimmed+"chunks/{sample}_1_val_1.chunk{chunk}"+TRIMMED_EXT,
+            fin2 = DIR_trimmed+"chunks/{sample}_2_val_2.chunk{chunk}"+TRIMMED_EXT
+        output:
+            temp(DIR_mapped+"chunks/{sample}_1_val_1.chunk{chunk}_bismark_bt2_pe.bam"),
+            DIR_mapped+"chunks/{sample}_1_val_1.chunk{chunk}_bismark_bt2_PE_report.txt"
+        params:
+            bismark_args = config['tools']['bismark']['args'],
+            genomeFolder = lambda wc: "--genome_folder " + genome_path(wc.sample),
+            outdir       = "--output_dir  "+DIR_mapped+"chunks/",
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            samtools     = "--samtools_path "+ os.path.dirname(tool('samtools')),
+            tempdir      = "--temp_dir "+DIR_mapped+"chunks/",
+            cores        = "--multicore "+bismark_cores
+        log:
+            DIR_mapped+"chunks/{sample}_1_val_1.chunk{chunk}_bismark_pe_mapping.log"
+        benchmark: benchmark_file('bismark_align_chunk_pe', "{sample}.chunk{chunk}")
+        threads: rule_threads('bismark_align_and_map_pe')
+        resources: **memory_resources(rule_memory('bismark_align_and_map_pe'))
+        message: fmt("Mapping paired-end read chunk {wildcards.chunk} to genome {ASSEMBLY}.")
+        shell:
+            nice('bismark', ["{params}", "-1 {input.fin1}", "-2 {input.fin2}"], "{log}")
+
+    #-----------------------
+    rule split_trimmed_se:
+        input:
+            fqfile = DIR_trimmed+"{sample}_trimmed"+TRIMMED_EXT,
+            qc     = posttrim_qc('se')
+        output:
+            chunks = temp(expand(DIR_trimmed+"chunks/{{sample}}_trimmed.chunk{chunk}"+TRIMMED_EXT, chunk=range(ALIGN_CHUNKS)))
+        params:
+            chunks = lambda wc, output: ",".join(output.chunks),
+            block  = int(config['tools']['bismark']['chunk-block-size'])
+        benchmark: benchmark_file('split_trimmed_se', "{sample}")
+        threads: rule_threads('split_trimmed_se')
+        resources: **memory_resources(rule_memory('split_trimmed_se'))
+        message: fmt("Splitting single-end reads of {wildcards.sample} into " + str(ALIGN_CHUNKS) + " chunks")
+        shell:
+            nice('python', ["{DIR_scripts}/readChunks.py", "split",
+                            "--block-size={params.block}",
+                            "--input={input.fqfile}", "--output={params.chunks}"])
+
+    rule split_trimmed_pe:
+        input:
+            fin1 = DIR_trimmed+"{sample}_1_val_1"+TRIMMED_EXT,
+            fin2 = DIR_trimmed+"{sample}_2_val_2"+TRIMMED_EXT,
+            qc   = posttrim_qc('pe')
+        output:
+            chunks1 = temp(expand(DIR_trimmed+"chunks/{{sample}}_1_val_1.chunk{chunk}"+TRIMMED_EXT, chunk=range(ALIGN_CHUNKS))),
+            chunks2 = temp(expand(DIR_trimmed+"chunks/{{sample}}_2_val_2.chunk{chunk}"+TRIMMED_EXT, chunk=range(ALIGN_CHUNKS)))
+        params:
+            chunks1 = lambda wc, output: ",".join(output.chunks1),
+            chunks2 = lambda wc, output: ",".join(output.chunks2),
+            block   = int(config['tools']['bismark']['chunk-block-size'])
+        benchmark: benchmark_file('split_trimmed_pe', "{sample}")
+        threads: rule_threads('split_trimmed_pe')
+        resources: **memory_resources(rule_memory('split_trimmed_pe'))
+        message: fmt("Splitting paired-end reads of {wildcards.sample} into " + str(ALIGN_CHUNKS) + " chunks")
+        shell:
+            nice('python', ["{DIR_scripts}/readChunks.py", "split",
+                            "--block-size={params.block}",
+                            "--input={input.fin1}", "--output={params.chunks1}",
+                            "--input={input.fin2}", "--output={params.chunks2}"])
+
+
+
 # ==========================================================================================
 # Generate methyl-converted version of the reference genome, if necessary:
 
-rule bismark_genome_preparation:
-    input:
-        ancient(GENOMEPATH)
-    output:
-        GENOMEPATH+"Bisulfite_Genome/CT_conversion/genome_mfa.CT_conversion.fa",
-        GENOMEPATH+"Bisulfite_Genome/GA_conversion/genome_mfa.GA_conversion.fa"
-    params:
-        bismark_genome_preparation_args = config['tools']['bismark-genome-preparation']['args'],
-        pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
-        useBowtie2   = "--bowtie2 ",
-        verbose      = "--verbose "
-    log:
-        'bismark_genome_preparation_'+ASSEMBLY+'.log'
-    message: fmt("Converting {ASSEMBLY} Genome into Bisulfite analogue")
-    shell:
-        nice('bismark-genome-preparation', ["{params}", "{input}"], "{log}")
+if config['locations']['index-cache']:
+    rule bismark_genome_preparation:
+        input:
+            ancient(GENOMEPATH)
+        output:
+            GENOMEPATH+"Bisulfite_Genome/CT_conversion/genome_mfa.CT_conversion.fa",
+            GENOMEPATH+"Bisulfite_Genome/GA_conversion/genome_mfa.GA_conversion.fa"
+        params:
+            cache = config['locations']['index-cache'],
+            fasta = genome_fasta(),
+            bismark_genome_preparation_args = toolArgs('bismark-genome-preparation'),
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            verbose      = "--verbose "
+        log:
+            'bismark_genome_preparation_'+ASSEMBLY+'.log'
+        benchmark: benchmark_file('bismark_genome_preparation')
+        threads: rule_threads('bismark_genome_preparation')
+        resources: **memory_resources(rule_memory('bismark_genome_preparation'))
+        message: fmt("Converting {ASSEMBLY} Genome into Bisulfite analogue in the shared index cache")
+        shell:
+            nice('python', ["{DIR_scripts}/indexCache.py", "build",
+                            "--cache={params.cache}", "--fasta={params.fasta}",
+                            "--bismark=" + tool('bismark'), "--bowtie2=" + tool('bowtie2'),
+                            "--args=\"{params.bismark_genome_preparation_args}\"",
+                            "--link=" + GENOMEPATH + "Bisulfite_Genome", "--",
+                            tool('bismark-genome-preparation'),
+                            "{params.bismark_genome_preparation_args}",
+                            "{params.pathToBowtie}", "{params.useBowtie2}", "{params.verbose}"],
+                 "{log}")
+else:
+    rule bismark_genome_preparation:
+        input:
+            ancient(GENOMEPATH)
+        output:
+            GENOMEPATH+"Bisulfite_Genome/CT_conversion/genome_mfa.CT_conversion.fa",
+            GENOMEPATH+"Bisulfite_Genome/GA_conversion/genome_mfa.GA_conversion.fa"
+        params:
+            bismark_genome_preparation_args = config['tools']['bismark-genome-preparation']['args'],
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            verbose      = "--verbose "
+        log:
+            'bismark_genome_preparation_'+ASSEMBLY+'.log'
+        benchmark: benchmark_file('bismark_genome_preparation')
+        threads: rule_threads('bismark_genome_preparation')
+        resources: **memory_resources(rule_memory('bismark_genome_preparation'))
+        message: fmt("Converting {ASSEMBLY} Genome into Bisulfite analogue")
+        shell:
+            nice('bismark-genome-preparation', ["{params}", "{input}"], "{log}")
+
+
+
+# ==========================================================================================
+# Optionally align RRBS samples to a reduced reference genome that only
+# holds the size-selected fragments of an in-silico MspI digest:
+
+if config['general']['rrbs']['reduced-reference']:
+    rule reduced_reference:
+        input:
+            ancient(genome_fasta())
+        output:
+            fasta      = REDUCEDPATH+"reduced_genome.fa",
+            regions    = REDUCEDPATH+"regions.tsv",
+            seqlengths = REDUCEDPATH+"seqlengths.tsv"
+        params:
+            min_size = int(config['general']['rrbs']['min-fragment']),
+            max_size = int(config['general']['rrbs']['max-fragment'])
+        log:
+            REDUCEDPATH+"reduced_reference.log"
+        benchmark: benchmark_file('reduced_reference')
+        threads: rule_threads('reduced_reference')
+        resources: **memory_resources(rule_memory('reduced_reference'))
+        message: fmt("Digesting {ASSEMBLY} Genome into a reduced reference for RRBS")
+        shell:
+            nice('python', ["{DIR_scripts}/reducedReference.py", "digest",
+                            "--fasta={input}", "--output={output.fasta}",
+                            "--regions={output.regions}", "--seqlengths={output.seqlengths}",
+                            "--min-size={params.min_size}", "--max-size={params.max_size}"],
+                 "{log}")
+
+    rule bismark_genome_preparation_reduced:
+        input:
+            REDUCEDPATH+"reduced_genome.fa"
+        output:
+            REDUCEDPATH+"Bisulfite_Genome/CT_conversion/genome_mfa.CT_conversion.fa",
+            REDUCEDPATH+"Bisulfite_Genome/GA_conversion/genome_mfa.GA_conversion.fa"
+        params:
+            bismark_genome_preparation_args = config['tools']['bismark-genome-preparation']['args'],
+            pathToBowtie = "--path_to_bowtie "+ os.path.dirname(tool('bowtie2')),
+            useBowtie2   = "--bowtie2 ",
+            verbose      = "--verbose "
+        log:
+            'bismark_genome_preparation_reduced_'+ASSEMBLY+'.log'
+        benchmark: benchmark_file('bismark_genome_preparation_reduced')
+        threads: rule_threads('bismark_genome_preparation_reduced')
+        resources: **memory_resources(rule_memory('bismark_genome_preparation_reduced'))
+        message: fmt("Converting the reduced {ASSEMBLY} Genome into Bisulfite analogue")
+        shell:
+            nice('bismark-genome-preparation', ["{params}", REDUCEDPATH], "{log}")
+
 
 
-
 # ==========================================================================================
 # Create a csv file tabulating the lengths of the chromosomes in the reference genome:
 
-rule tabulate_seqlengths:
-    input:
-        rules.bismark_genome_preparation.output
-    output:
-        seqlengths = DIR_mapped+"Refgen_"+ASSEMBLY+"_chromlengths.csv",
-    params:
-        chromlines = " | " + tool('grep') + " Sequence ",
-        chromcols  = " | " + tool('cut') + " -f2,3     ",
-        seqnames   = " | " + tool('sed') + " \"s/_CT_converted//g\" "
-    message: fmt("Tabulating chromosome lengths in genome: {ASSEMBLY} for later reference.")
-    shell:
-        nice('bowtie2-inspect', ['-s ' + GENOMEPATH + "Bisulfite_Genome/CT_conversion/BS_CT", '{params.chromlines}', '{params.chromcols}', '{params.seqnames}', ' > {output}'])
+# When no sample is aligned to the whole genome, the bisulfite genome
+# is not needed: the lengths are taken from the digest of the reduced
+# reference or from the header of a bam file.
+GENOME_SAMPLES  = [sample for sample in config['SAMPLES'] if needs_genome_index(sample)]
+REDUCED_SAMPLES = [sample for sample in config['SAMPLES'] if reduced_reference(sample)]
+BAM_SAMPLES     = [sample for sample in config['SAMPLES'] if bam_input(sample)]
+
+if not GENOME_SAMPLES and REDUCED_SAMPLES:
+    rule tabulate_seqlengths:
+        input:
+            REDUCEDPATH+"seqlengths.tsv"
+        output:
+            seqlengths = DIR_mapped+"Refgen_"+ASSEMBLY+"_chromlengths.csv",
+        benchmark: benchmark_file('tabulate_seqlengths')
+        threads: rule_threads('tabulate_seqlengths')
+        resources: **memory_resources(rule_memory('tabulate_seqlengths'))
+        message: fmt("Tabulating chromosome lengths in genome: {ASSEMBLY} for later reference.")
+        shell:
+            nice('cut', ["-f1,2", "{input}", "> {output}"])
+elif not GENOME_SAMPLES and BAM_SAMPLES:
+    rule tabulate_seqlengths:
+        input:
+            os.path.join(config['locations']['input-dir'], config['SAMPLES'][BAM_SAMPLES[0]]['files'][0])
+        output:
+            seqlengths = DIR_mapped+"Refgen_"+ASSEMBLY+"_chromlengths.csv",
+        benchmark: benchmark_file('tabulate_seqlengths')
+        threads: rule_threads('tabulate_seqlengths')
+        resources: **memory_resources(rule_memory('tabulate_seqlengths'))
+        message: fmt("Tabulating chromosome lengths in the header of {input} for later reference.")
+        shell:
+            nice('python', ["{DIR_scripts}/bamInput.py", "seqlengths", "--bam {input}", "--output {output}"])
+else:
+    rule tabulate_seqlengths:
+        input:
+            rules.bismark_genome_preparation.output
+        output:
+            seqlengths = DIR_mapped+"Refgen_"+ASSEMBLY+"_chromlengths.csv",
+        params:
+            chromlines = " | " + tool('grep') + " Sequence ",
+            chromcols  = " | " + tool('cut') + " -f2,3     ",
+            seqnames   = " | " + tool('sed') + " \"s/_CT_converted//g\" "
+        benchmark: benchmark_file('tabulate_seqlengths')
+        threads: rule_threads('tabulate_seqlengths')
+        resources: **memory_resources(rule_memory('tabulate_seqlengths'))
+        message: fmt("Tabulating chromosome lengths in genome: {ASSEMBLY} for later reference.")
+        shell:
+            nice('bowtie2-inspect', ['-s ' + GENOMEPATH + "Bisulfite_Genome/CT_conversion/BS_CT", '{params.chromlines}', '{params.chromcols}', '{params.seqnames}', ' > {output}'])
 
 
 
@@ -565,7 +1466,7 @@ rule tabulate_seqlengths:
 
 rule fastqc_after_trimming_se:
     input:
-        DIR_trimmed+"{sample}_trimmed.fq.gz",
+        DIR_trimmed+"{sample}_trimmed"+TRIMMED_EXT,
     output:
     	DIR_posttrim_QC+"{sample}_trimmed_fastqc.html",
     	DIR_posttrim_QC+"{sample}_trimmed_fastqc.zip"
@@ -574,14 +1475,17 @@ rule fastqc_after_trimming_se:
         outdir = "--outdir "+DIR_posttrim_QC
     log:
    	    DIR_posttrim_QC+"{sample}_trimmed_fastqc.log"
+    benchmark: benchmark_file('fastqc_after_trimming_se', "{sample}")
+    threads: rule_threads('fastqc_after_trimming_se')
+    resources: **memory_resources(rule_memory('fastqc_after_trimming_se'))
     message: fmt("Quality checking trimmmed single-end data from {input}")
     shell:
         nice('fastqc', ["{params}", "{input}"], "{log}")
 
 rule fastqc_after_trimming_pe:
     input:
-        DIR_trimmed+"{sample}_1_val_1.fq.gz",
-        DIR_trimmed+"{sample}_2_val_2.fq.gz"
+        DIR_trimmed+"{sample}_1_val_1"+TRIMMED_EXT,
+        DIR_trimmed+"{sample}_2_val_2"+TRIMMED_EXT
     output:
     	DIR_posttrim_QC+"{sample}_1_val_1_fastqc.html",
     	DIR_posttrim_QC+"{sample}_1_val_1_fastqc.zip",
@@ -592,6 +1496,9 @@ rule fastqc_after_trimming_pe:
         outdir = "--outdir "+DIR_posttrim_QC
     log:
    	    DIR_posttrim_QC+"{sample}_trimmed_fastqc.log"
+    benchmark: benchmark_file('fastqc_after_trimming_pe', "{sample}")
+    threads: rule_threads('fastqc_after_trimming_pe')
+    resources: **memory_resources(rule_memory('fastqc_after_trimming_pe'))
     message: fmt("Quality checking trimmmed paired-end data from {input}")
     shell:
         nice('fastqc', ["{params}", "{input}"], "{log}")
@@ -605,18 +1512,22 @@ rule trim_reads_se:
        qc   = DIR_rawqc+"{sample}_fastqc.html",
        file = PATHIN+"{sample}.fq.gz"
     output:
-       DIR_trimmed+"{sample}_trimmed.fq.gz" #---- this ALWAYS outputs .fq.qz format.
+       DIR_trimmed+"{sample}_trimmed"+TRIMMED_EXT #---- compressed as set by execution:intermediate-compression
     params:
        extra      = config['tools']['trim-galore']['args'],
        outdir     = "--output_dir "+DIR_trimmed,
        phred      = "--phred33",
-       gz         = "--gzip",
+       gz         = "--gzip" if COMPRESSION == 'gzip' else "--dont_gzip",
        cutadapt   = "--path_to_cutadapt " + tool('cutadapt'),
     log:
        DIR_trimmed+"{sample}.trimgalore.log"
+    benchmark: benchmark_file('trim_reads_se', "{sample}")
+    threads: rule_threads('trim_reads_se')
+    resources: **memory_resources(rule_memory('trim_reads_se'))
     message: fmt("Trimming raw single-end read data from {input}")
     shell:
-       nice('trim-galore', ["{params}", "{input.file}"], "{log}")
+       compress_trimmed(nice('trim-galore', ["{params}", "{input.file}"], "{log}"),
+                        [DIR_trimmed+"{wildcards.sample}_trimmed.fq"])
 
 rule trim_reads_pe:
     input:
@@ -625,21 +1536,92 @@ rule trim_reads_pe:
         files = [ PATHIN+"{sample}_1.fq.gz",
                   PATHIN+"{sample}_2.fq.gz"]
     output:
-        DIR_trimmed+"{sample}_1_val_1.fq.gz", #---- this ALWAYS outputs .fq.qz format.
-        DIR_trimmed+"{sample}_2_val_2.fq.gz",
+        DIR_trimmed+"{sample}_1_val_1"+TRIMMED_EXT, #---- compressed as set by execution:intermediate-compression
+        DIR_trimmed+"{sample}_2_val_2"+TRIMMED_EXT,
     params:
         extra          = config['tools']['trim-galore']['args'],
         outdir         = "--output_dir "+DIR_trimmed,
         phred          = "--phred33",
-        gz             = "--gzip",
+        gz             = "--gzip" if COMPRESSION == 'gzip' else "--dont_gzip",
         cutadapt       = "--path_to_cutadapt " + tool('cutadapt'),
         paired         = "--paired"
     log:
         DIR_trimmed+"{sample}.trimgalore.log"
+    benchmark: benchmark_file('trim_reads_pe', "{sample}")
+    threads: rule_threads('trim_reads_pe')
+    resources: **memory_resources(rule_memory('trim_reads_pe'))
     message:
         fmt("Trimming raw paired-end read data from {input}")
     shell:
-        nice('trim-galore', ["{params}", "{input.files}"], "{log}")
+        compress_trimmed(nice('trim-galore', ["{params}", "{input.files}"], "{log}"),
+                         [DIR_trimmed+"{wildcards.sample}_1_val_1.fq",
+                          DIR_trimmed+"{wildcards.sample}_2_val_2.fq"])
+
+
+# ==========================================================================================
+# Optionally trim the reads and check their quality before and after
+# trimming in a single pass over the raw reads:
+
+if config['execution']['fused-trimming']:
+    ruleorder: trim_qc_fused_se > trim_reads_se
+    ruleorder: trim_qc_fused_pe > trim_reads_pe
+
+    rule trim_qc_fused_se:
+        input:
+            file = PATHIN+"{sample}.fq.gz"
+        output:
+            fqfile  = intermediate(DIR_trimmed+"{sample}_trimmed"+TRIMMED_EXT),
+            raw     = DIR_rawqc+"{sample}_readstats.json",
+            trimmed = DIR_posttrim_QC+"{sample}_trimmed_readstats.json"
+        log:
+            DIR_trimmed+"{sample}.trimpass.log"
+        benchmark: benchmark_file('trim_qc_fused_se', "{sample}")
+        threads: rule_threads('trim_qc_fused_se')
+        resources: **memory_resources(rule_memory('trim_qc_fused_se'))
+        message: fmt("Trimming and quality checking raw single-end read data from {input}")
+        shell:
+            nice('python', ["{DIR_scripts}/trimPass.py",
+                            "--sample={wildcards.sample}",
+                            "--input={input.file}",
+                            "--output={output.fqfile}",
+                            "--raw-stats={output.raw}",
+                            "--trimmed-stats={output.trimmed}",
+                            "--cutadapt=" + tool('cutadapt'),
+                            "--cutadapt-args=\"" + toolArgs('cutadapt') + "\"",
+                            "--pigz=" + tool('pigz'),
+                            "--bgzip=" + tool('bgzip'),
+                            "--compression=" + ('none' if COMPRESSION == 'pipe' else COMPRESSION),
+                            "--threads={threads}"], "{log}")
+
+    rule trim_qc_fused_pe:
+        input:
+            files = [ PATHIN+"{sample}_1.fq.gz",
+                      PATHIN+"{sample}_2.fq.gz"]
+        output:
+            fin1    = intermediate(DIR_trimmed+"{sample}_1_val_1"+TRIMMED_EXT),
+            fin2    = intermediate(DIR_trimmed+"{sample}_2_val_2"+TRIMMED_EXT),
+            raw     = DIR_rawqc+"{sample}_readstats.json",
+            trimmed = DIR_posttrim_QC+"{sample}_val_readstats.json"
+        log:
+            DIR_trimmed+"{sample}.trimpass.log"
+        benchmark: benchmark_file('trim_qc_fused_pe', "{sample}")
+        threads: rule_threads('trim_qc_fused_pe')
+        resources: **memory_resources(rule_memory('trim_qc_fused_pe'))
+        message: fmt("Trimming and quality checking raw paired-end read data from {input}")
+        shell:
+            nice('python', ["{DIR_scripts}/trimPass.py",
+                            "--sample={wildcards.sample}",
+                            "--input={input.files[0]}", "--input={input.files[1]}",
+                            "--output={output.fin1}", "--output={output.fin2}",
+                            "--raw-stats={output.raw}",
+                            "--trimmed-stats={output.trimmed}",
+                            "--cutadapt=" + tool('cutadapt'),
+                            "--cutadapt-args=\"" + toolArgs('cutadapt') + "\"",
+                            "--pigz=" + tool('pigz'),
+                            "--bgzip=" + tool('bgzip'),
+                            "--compression=" + ('none' if COMPRESSION == 'pipe' else COMPRESSION),
+                            "--threads={threads}"], "{log}")
+
 
 
 # ==========================================================================================
@@ -656,6 +1638,9 @@ rule fastqc_raw: #----only need one: covers BOTH pe and se cases.
         outdir      = "--outdir "+ DIR_rawqc     # usually pass params as strings instead of wildcards.
     log:
         DIR_rawqc+"{sample}_fastqc.log"
+    benchmark: benchmark_file('fastqc_raw', "{sample}")
+    threads: rule_threads('fastqc_raw')
+    resources: **memory_resources(rule_memory('fastqc_raw'))
     message: fmt("Quality checking raw read data from {input}")
     shell:
         nice('fastqc', ["{params}", "{input}"], "{log}")
@@ -0,0 +1,384 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# runBenchmark.py - run the pipeline on synthetic bisulfite data and
+# record the resources used by every rule.
+#
+# The pipeline writes a snakemake benchmark file for every job to
+# "pigx_work/benchmarks/<rule>/".  After the run these files are
+# collected into a JSON results file holding the wall time, CPU time and
+# peak resident memory of every job and their totals per rule, together
+# with the parameters of the run, so that results of different versions
+# can be compared.
+#
+#   run:     simulate data, run the pipeline and write the results
+#   compare: print the per-rule differences between two results files
+#   startup: time the dry run of the pipeline for growing numbers of
+#            samples, i.e. the parsing, target resolution and DAG
+#            construction before the first job starts
+
+import argparse
+import csv
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIMULATE = os.path.join(HERE, "simulateReads.py")
+TEST_GENOME = os.path.join(HERE, "..", "tests", "genome")
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def merge(base, extra):
+    """Recursively update the dictionary BASE with EXTRA."""
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def prepare_genome(args, genome_dir):
+    """Fill GENOME_DIR with the reference genome and return its FASTA."""
+    os.makedirs(genome_dir)
+    if args.genome_size:
+        fasta = os.path.join(genome_dir, "synthetic.fasta")
+        subprocess.check_call([sys.executable, SIMULATE, "genome", "--output", fasta,
+                               "--size", str(args.genome_size),
+                               "--chromosomes", str(args.chromosomes),
+                               "--seed", str(args.seed)])
+        return fasta
+    # Link every file of the reference directory, so that annotation
+    # files next to the genome can be used as well.
+    source = os.path.abspath(args.genome_dir)
+    for name in sorted(os.listdir(source)):
+        os.symlink(os.path.join(source, name), os.path.join(genome_dir, name))
+    fastas = sorted(glob.glob(os.path.join(genome_dir, "*.fa")) +
+                    glob.glob(os.path.join(genome_dir, "*.fasta")))
+    if len(fastas) != 1:
+        raise Exception("Expected exactly one FASTA file in {}.".format(source))
+    return fastas[0]
+
+
+def prepare_samples(args, fasta, input_dir):
+    """Simulate the reads of every sample and return the sample sheet
+rows.  Samples are assigned to the treatment groups in turn; each group
+has its own methylation rate."""
+    os.makedirs(input_dir)
+    rates = [float(rate) for rate in args.methylation_rate.split(',')]
+    rows = []
+    for idx in range(args.samples):
+        group = idx % len(rates)
+        sampleid = "sample{}".format(idx + 1)
+        command = [sys.executable, SIMULATE, "reads",
+                   "--reference", fasta,
+                   "--output", os.path.join(input_dir, sampleid),
+                   "--reads", str(args.reads),
+                   "--read-length", str(args.read_length),
+                   "--layout", args.layout,
+                   "--protocol", args.protocol,
+                   "--methylation-rate", str(rates[group]),
+                   "--seed", str(args.seed + idx)]
+        log("Simulating {} reads of {}.".format(args.reads, sampleid))
+        subprocess.check_call(command)
+        if args.layout == 'pe':
+            reads = [sampleid + "_1.fq.gz", sampleid + "_2.fq.gz"]
+        else:
+            reads = [sampleid + ".fq.gz", ""]
+        rows.append(reads + [sampleid, args.protocol.upper(), str(group)])
+    return rows, len(rates)
+
+
+def write_settings(args, workdir, groups):
+    settings = {
+        'locations': {
+            'input-dir': os.path.join(workdir, "in/"),
+            'output-dir': os.path.join(workdir, "out/"),
+            'genome-dir': os.path.join(workdir, "genome/"),
+        },
+        'general': {
+            'assembly': args.assembly,
+            'methylation-calling': {'minimum-coverage': 1},
+            'differential-methylation': {
+                'treatment-groups': [['0', str(g)] for g in range(1, groups)] or [[]],
+            },
+        },
+        'execution': {'jobs': args.jobs},
+    }
+    if args.settings:
+        with open(args.settings, 'r') as f:
+            merge(settings, yaml.safe_load(f) or {})
+    filename = os.path.join(workdir, "settings.yaml")
+    with open(filename, 'w') as f:
+        yaml.safe_dump(settings, f, default_flow_style=False)
+    return filename
+
+
+def pigx_version(pigx):
+    try:
+        return subprocess.check_output([pigx, "--version"], stderr=subprocess.STDOUT,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def number(row, column):
+    """Return the value of COLUMN in a benchmark ROW, or None when
+snakemake did not record it."""
+    value = row.get(column, "NA")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def collect(benchmark_dir):
+    """Return the jobs recorded in the benchmark files and their totals
+per rule."""
+    jobs = []
+    for filename in sorted(glob.glob(os.path.join(benchmark_dir, "*", "*.tsv"))):
+        rule = os.path.basename(os.path.dirname(filename))
+        with open(filename, 'r') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                jobs.append({
+                    'rule': rule,
+                    'job': os.path.basename(filename)[:-len(".tsv")],
+                    'wall_time_s': number(row, 's'),
+                    'cpu_time_s': number(row, 'cpu_time'),
+                    'peak_rss_mb': number(row, 'max_rss'),
+                    'io_in_mb': number(row, 'io_in'),
+                    'io_out_mb': number(row, 'io_out'),
+                })
+
+    rules = {}
+    for job in jobs:
+        total = rules.setdefault(job['rule'], {'jobs': 0, 'wall_time_s': 0.0,
+                                               'max_wall_time_s': 0.0, 'cpu_time_s': 0.0,
+                                               'peak_rss_mb': 0.0})
+        total['jobs'] += 1
+        total['wall_time_s'] += job['wall_time_s'] or 0
+        total['max_wall_time_s'] = max(total['max_wall_time_s'], job['wall_time_s'] or 0)
+        total['cpu_time_s'] += job['cpu_time_s'] or 0
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], job['peak_rss_mb'] or 0)
+    return jobs, rules
+
+
+def run(args):
+    workdir = os.path.abspath(args.workdir)
+    if os.path.exists(workdir) and os.listdir(workdir):
+        if not args.overwrite:
+            raise Exception("{} is not empty; pass --overwrite to replace it.".format(workdir))
+        shutil.rmtree(workdir)
+    os.makedirs(workdir, exist_ok=True)
+
+    fasta = prepare_genome(args, os.path.join(workdir, "genome"))
+    rows, groups = prepare_samples(args, fasta, os.path.join(workdir, "in"))
+    sample_sheet = os.path.join(workdir, "sample_sheet.csv")
+    with open(sample_sheet, 'w') as f:
+        f.write("Read1,Read2,SampleID,Protocol,Treatment\n")
+        for row in rows:
+            f.write(",".join(row) + "\n")
+    settings = write_settings(args, workdir, groups)
+
+    command = [args.pigx, "-s", settings, "--configfile", os.path.join(workdir, "config.json")]
+    command += ["--target={}".format(target) for target in args.target]
+    command.append(sample_sheet)
+    log("Running: " + " ".join(command))
+    start = time.time()
+    status = subprocess.call(command, cwd=workdir)
+    wall_time = time.time() - start
+
+    jobs, rules = collect(os.path.join(workdir, "out", "pigx_work", "benchmarks"))
+    results = {
+        'pigx_version': pigx_version(args.pigx),
+        'date': datetime.datetime.now().isoformat(),
+        'host': {'name': platform.node(), 'system': platform.platform(), 'cpus': os.cpu_count()},
+        'parameters': {
+            'targets': args.target,
+            'samples': args.samples,
+            'reads': args.reads,
+            'read_length': args.read_length,
+            'layout': args.layout,
+            'protocol': args.protocol,
+            'methylation_rate': args.methylation_rate,
+            'genome': 'synthetic:{}'.format(args.genome_size) if args.genome_size
+                      else os.path.basename(fasta),
+            'seed': args.seed,
+        },
+        'exit_status': status,
+        'wall_time_s': wall_time,
+        'rules': rules,
+        'jobs': jobs,
+    }
+    output = args.output or os.path.join(workdir, "benchmark.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    log("Wrote the results of {} jobs to {}.".format(len(jobs), output))
+    if status != 0:
+        sys.exit("The pipeline failed with exit status {}.".format(status))
+
+
+def startup(args):
+    """Time a dry run for each number of samples in ARGS.samples.  The
+input files are empty, as a dry run never reads them."""
+    workdir = os.path.abspath(args.workdir)
+    counts = [int(n) for n in args.samples.split(',')]
+    groups = max(1, args.treatments)
+    rows = []
+    for count in counts:
+        rundir = os.path.join(workdir, "samples{}".format(count))
+        if os.path.exists(rundir):
+            shutil.rmtree(rundir)
+        os.makedirs(os.path.join(rundir, "in"))
+        os.makedirs(os.path.join(rundir, "genome"))
+        source = os.path.abspath(args.genome_dir)
+        for name in sorted(os.listdir(source)):
+            os.symlink(os.path.join(source, name), os.path.join(rundir, "genome", name))
+        sample_sheet = os.path.join(rundir, "sample_sheet.csv")
+        with open(sample_sheet, 'w') as f:
+            f.write("Read1,Read2,SampleID,Protocol,Treatment\n")
+            for idx in range(count):
+                sampleid = "sample{}".format(idx + 1)
+                # alternate between single-end and paired-end samples
+                reads = [sampleid + ".fq.gz"] if idx % 2 == 0 else \
+                        [sampleid + "_1.fq.gz", sampleid + "_2.fq.gz"]
+                for name in reads:
+                    open(os.path.join(rundir, "in", name), 'w').close()
+                f.write(",".join(reads + [""] * (2 - len(reads)) +
+                                 [sampleid, "WGBS", str(idx % groups)]) + "\n")
+        settings = write_settings(args, rundir, groups)
+
+        command = [args.pigx, "--dry-run", "-s", settings,
+                   "--configfile", os.path.join(rundir, "config.json"), sample_sheet]
+        start = time.time()
+        status = subprocess.call(command, cwd=rundir, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        seconds = time.time() - start
+        if status != 0:
+            raise Exception("The dry run of {} samples failed; see {}.".format(count, rundir))
+        rows.append({'samples': count, 'seconds': seconds, 'seconds_per_sample': seconds / count})
+        log("{} samples: {:.1f}s ({:.3f}s per sample)".format(count, seconds, seconds / count))
+
+    output = args.output or os.path.join(workdir, "startup.json")
+    with open(output, 'w') as f:
+        json.dump({'pigx_version': pigx_version(args.pigx),
+                   'date': datetime.datetime.now().isoformat(),
+                   'treatments': groups,
+                   'runs': rows}, f, indent=2, sort_keys=True)
+    log("Wrote the results to {}.".format(output))
+
+
+def compare(args):
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r') as f:
+        current = json.load(f)
+
+    def change(old, new):
+        if not old:
+            return "NA"
+        return "{:+.1f}%".format(100.0 * (new - old) / old)
+
+    out = sys.stdout
+    out.write("rule\twall_time_s\tchange\tcpu_time_s\tchange\tpeak_rss_mb\tchange\n")
+    for rule in sorted(set(baseline['rules']) | set(current['rules'])):
+        old = baseline['rules'].get(rule, {})
+        new = current['rules'].get(rule, {})
+        fields = [rule]
+        for key in ['wall_time_s', 'cpu_time_s', 'peak_rss_mb']:
+            fields += ["{:.2f}".format(new[key]) if key in new else "NA",
+                       change(old.get(key), new.get(key, 0))]
+        out.write("\t".join(fields) + "\n")
+    out.write("total\t{:.2f}\t{}\n".format(current['wall_time_s'],
+                                          change(baseline['wall_time_s'], current['wall_time_s'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic bisulfite data.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('run', help="run the pipeline on synthetic data")
+    p.add_argument('--workdir', required=True, help="directory for the data and the pipeline output")
+    p.add_argument('--overwrite', action='store_true', help="replace an existing working directory")
+    p.add_argument('--output', default=None, help="results file (default: WORKDIR/benchmark.json)")
+    p.add_argument('--pigx', default='pigx-bsseq', help="pigx-bsseq executable")
+    p.add_argument('--target', action='append', default=None,
+                   help="pipeline target to run; may be given more than once (default: final-report)")
+    p.add_argument('--settings', default=None,
+                   help="YAML file with settings that override the generated ones")
+    p.add_argument('--jobs', type=int, default=6, help="number of jobs to run at once")
+    p.add_argument('--genome-dir', dest='genome_dir', default=TEST_GENOME,
+                   help="directory with the reference FASTA and annotation files")
+    p.add_argument('--genome-size', dest='genome_size', type=int, default=0,
+                   help="simulate a random genome of this size instead")
+    p.add_argument('--chromosomes', type=int, default=1, help="chromosomes of the random genome")
+    p.add_argument('--assembly', default='hg19', help="assembly name passed to the pipeline")
+    p.add_argument('--samples', type=int, default=4, help="number of samples")
+    p.add_argument('--reads', type=int, default=100000, help="reads (or read pairs) per sample")
+    p.add_argument('--read-length', dest='read_length', type=int, default=100)
+    p.add_argument('--layout', choices=['se', 'pe'], default='se')
+    p.add_argument('--protocol', choices=['wgbs', 'rrbs'], default='wgbs')
+    p.add_argument('--methylation-rate', dest='methylation_rate', default='0.7,0.4',
+                   help="comma-separated methylation rates of the treatment groups")
+    p.add_argument('--seed', type=int, default=1, help="seed of the first sample")
+
+    p = sub.add_parser('startup', help="time dry runs for growing numbers of samples")
+    p.add_argument('--workdir', required=True, help="directory for the sample sheets and outputs")
+    p.add_argument('--output', default=None, help="results file (default: WORKDIR/startup.json)")
+    p.add_argument('--pigx', default='pigx-bsseq', help="pigx-bsseq executable")
+    p.add_argument('--samples', default='100,200,400,800',
+                   help="comma-separated numbers of samples to time")
+    p.add_argument('--treatments', type=int, default=4,
+                   help="number of treatment groups; each is compared to group 0")
+    p.add_argument('--settings', default=None,
+                   help="YAML file with settings that override the generated ones")
+    p.add_argument('--genome-dir', dest='genome_dir', default=TEST_GENOME,
+                   help="directory with the reference FASTA and annotation files")
+    p.add_argument('--assembly', default='hg19', help="assembly name passed to the pipeline")
+    p.set_defaults(jobs=1)
+
+    p = sub.add_parser('compare', help="compare two results files")
+    p.add_argument('baseline', help="results of the reference version")
+    p.add_argument('current', help="results of the version under test")
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        args.target = args.target or ['final-report']
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+    elif args.command == 'startup':
+        startup(args)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
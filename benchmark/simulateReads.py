@@ -0,0 +1,272 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# simulateReads.py - generate synthetic bisulfite sequencing reads.
+#
+# Reads are drawn from a reference genome as a directional library:
+# read 1 comes from either the original top (OT) or the original bottom
+# (OB) strand.  Each CpG of the genome is methylated with the given
+# methylation rate on both strands; every other cytosine is converted
+# to thymine with the given conversion rate.
+#
+# WGBS fragments start anywhere in the genome; RRBS fragments are the
+# size-selected pieces of an in-silico MspI (C^CGG) digest.  Reads that
+# are longer than their fragment run into the adapter.
+#
+# The output only depends on the arguments: the same seed always gives
+# the same reads, and the gzip headers carry no time stamp.
+#
+#   genome: write a random reference genome
+#   reads:  simulate reads from a reference genome
+
+import argparse
+import bisect
+import gzip
+import random
+import sys
+
+ADAPTER = "AGATCGGAAGAGC"
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def read_fasta(fasta):
+    """Return a list of (name, sequence) tuples."""
+    chroms = []
+    name, parts = None, []
+    with open(fasta, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    chroms.append((name, "".join(parts).upper()))
+                name, parts = line[1:].split()[0], []
+            elif line:
+                parts.append(line)
+    if name is not None:
+        chroms.append((name, "".join(parts).upper()))
+    if not chroms:
+        raise Exception("{} does not contain any sequences.".format(fasta))
+    return chroms
+
+
+def write_genome(fasta, size, chromosomes, seed):
+    """Write a random genome of SIZE bases in CHROMOSOMES sequences."""
+    rng = random.Random(seed)
+    with open(fasta, 'w') as out:
+        for idx in range(chromosomes):
+            length = size // chromosomes + (1 if idx < size % chromosomes else 0)
+            seq = "".join(rng.choice("ACGT") for _ in range(length))
+            out.write(">chr{}\n".format(idx + 1))
+            for start in range(0, length, 60):
+                out.write(seq[start:start + 60] + "\n")
+
+
+def methylated_sites(seq, rate, rng):
+    """Return the set of CpG positions (of the C on the top strand) in
+SEQ that are methylated."""
+    sites = set()
+    pos = seq.find("CG")
+    while pos >= 0:
+        if rng.random() < rate:
+            sites.add(pos)
+        pos = seq.find("CG", pos + 1)
+    return sites
+
+
+def convert(seq, offset, methylated, conversion, rng):
+    """Bisulfite-convert the top strand SEQ, which starts at OFFSET in its
+chromosome: unmethylated cytosines become thymines."""
+    bases = list(seq)
+    for i, base in enumerate(bases):
+        if base == 'C':
+            if offset + i in methylated:
+                continue
+            if rng.random() < conversion:
+                bases[i] = 'T'
+    return "".join(bases)
+
+
+def convert_bottom(seq, offset, methylated, conversion, rng):
+    """Bisulfite-convert the bottom strand of SEQ and return it in the
+orientation of the bottom strand."""
+    bases = list(seq)
+    for i, base in enumerate(bases):
+        if base == 'G':
+            # the C of this CpG is the preceding base on the top strand
+            if offset + i - 1 in methylated:
+                continue
+            if rng.random() < conversion:
+                bases[i] = 'A'
+    return revcomp("".join(bases))
+
+
+def msp1_fragments(chroms, min_size, max_size):
+    """Return (chromosome index, start, end) of the fragments between two
+MspI sites that pass the size selection."""
+    fragments = []
+    for idx, (name, seq) in enumerate(chroms):
+        cuts = []
+        pos = seq.find("CCGG")
+        while pos >= 0:
+            cuts.append(pos + 1)
+            pos = seq.find("CCGG", pos + 1)
+        for start, end in zip(cuts, cuts[1:]):
+            if min_size <= end - start <= max_size:
+                fragments.append((idx, start, end))
+    return fragments
+
+
+def to_read_length(seq, length):
+    """Cut SEQ to LENGTH bases, adding adapter sequence and a poly-A tail
+when the fragment is shorter than the read."""
+    if len(seq) >= length:
+        return seq[:length]
+    return (seq + ADAPTER + "A" * length)[:length]
+
+
+def add_errors(seq, rate, rng):
+    if rate <= 0:
+        return seq
+    bases = list(seq)
+    for i in range(len(bases)):
+        if rng.random() < rate:
+            bases[i] = rng.choice([b for b in "ACGT" if b != bases[i]])
+    return "".join(bases)
+
+
+def open_fastq(filename):
+    # mtime=0 keeps the output byte-for-byte reproducible.
+    return gzip.GzipFile(filename, 'wb', compresslevel=6, mtime=0)
+
+
+def simulate(chroms, outputs, reads, read_length, paired, protocol,
+             methylation_rate, conversion_rate, fragment_mean, fragment_sd,
+             min_size, max_size, error_rate, seed):
+    rng = random.Random(seed)
+    methylated = [methylated_sites(seq, methylation_rate, rng) for name, seq in chroms]
+
+    if protocol == 'rrbs':
+        fragments = msp1_fragments(chroms, min_size, max_size)
+        if not fragments:
+            raise Exception("The MspI digest yields no fragments of {} to {} bp.".format(min_size, max_size))
+        log("{} RRBS fragments after size selection.".format(len(fragments)))
+    else:
+        lengths = [len(seq) for name, seq in chroms]
+        cumulative = []
+        total = 0
+        for length in lengths:
+            total += length
+            cumulative.append(total)
+
+    def draw_fragment():
+        if protocol == 'rrbs':
+            return rng.choice(fragments)
+        while True:
+            size = max(min_size, int(rng.gauss(fragment_mean, fragment_sd)))
+            point = rng.randrange(total)
+            idx = bisect.bisect_right(cumulative, point)
+            start = point - (cumulative[idx] - lengths[idx])
+            if start + size <= lengths[idx]:
+                return idx, start, start + size
+
+    outs = [open_fastq(filename) for filename in outputs]
+    quality = "I" * read_length
+    try:
+        for n in range(reads):
+            idx, start, end = draw_fragment()
+            name, seq = chroms[idx]
+            fragment = seq[start:end]
+            if rng.random() < 0.5:
+                strand = convert(fragment, start, methylated[idx], conversion_rate, rng)
+                origin = "OT"
+            else:
+                strand = convert_bottom(fragment, start, methylated[idx], conversion_rate, rng)
+                origin = "OB"
+            ends = [strand]
+            if paired:
+                ends.append(revcomp(strand))
+            header = "@read{}:{}:{}-{}:{}".format(n + 1, name, start + 1, end, origin)
+            for mate, (out, sequence) in enumerate(zip(outs, ends)):
+                sequence = add_errors(to_read_length(sequence, read_length), error_rate, rng)
+                record = "{}/{}\n{}\n+\n{}\n".format(header, mate + 1, sequence, quality)
+                out.write(record.encode())
+    finally:
+        for out in outs:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic bisulfite sequencing data.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('genome', help="write a random reference genome")
+    p.add_argument('--output', required=True, help="FASTA file to write")
+    p.add_argument('--size', type=int, default=1000000, help="total number of bases")
+    p.add_argument('--chromosomes', type=int, default=1, help="number of sequences")
+    p.add_argument('--seed', type=int, default=1, help="seed of the random number generator")
+
+    p = sub.add_parser('reads', help="simulate reads from a reference genome")
+    p.add_argument('--reference', required=True, help="reference genome FASTA file")
+    p.add_argument('--output', required=True,
+                   help="output prefix; writes PREFIX.fq.gz or PREFIX_1.fq.gz and PREFIX_2.fq.gz")
+    p.add_argument('--reads', type=int, default=100000, help="number of reads (or read pairs)")
+    p.add_argument('--read-length', dest='read_length', type=int, default=100)
+    p.add_argument('--layout', choices=['se', 'pe'], default='se', help="single-end or paired-end")
+    p.add_argument('--protocol', choices=['wgbs', 'rrbs'], default='wgbs')
+    p.add_argument('--methylation-rate', dest='methylation_rate', type=float, default=0.7,
+                   help="fraction of methylated CpGs")
+    p.add_argument('--conversion-rate', dest='conversion_rate', type=float, default=0.995,
+                   help="bisulfite conversion rate of unmethylated cytosines")
+    p.add_argument('--fragment-mean', dest='fragment_mean', type=int, default=300,
+                   help="mean WGBS fragment size")
+    p.add_argument('--fragment-sd', dest='fragment_sd', type=int, default=50,
+                   help="standard deviation of the WGBS fragment size")
+    p.add_argument('--min-size', dest='min_size', type=int, default=40,
+                   help="smallest fragment (RRBS size selection)")
+    p.add_argument('--max-size', dest='max_size', type=int, default=220,
+                   help="largest fragment (RRBS size selection)")
+    p.add_argument('--error-rate', dest='error_rate', type=float, default=0.001,
+                   help="rate of sequencing errors per base")
+    p.add_argument('--seed', type=int, default=1, help="seed of the random number generator")
+
+    args = parser.parse_args()
+    if args.command == 'genome':
+        write_genome(args.output, args.size, args.chromosomes, args.seed)
+    elif args.command == 'reads':
+        if args.layout == 'pe':
+            outputs = [args.output + "_1.fq.gz", args.output + "_2.fq.gz"]
+        else:
+            outputs = [args.output + ".fq.gz"]
+        simulate(read_fasta(args.reference), outputs, args.reads, args.read_length,
+                 args.layout == 'pe', args.protocol, args.methylation_rate,
+                 args.conversion_rate, args.fragment_mean, args.fragment_sd,
+                 args.min_size, args.max_size, args.error_rate, args.seed)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -88,12 +88,15 @@
        ("ghc-pandoc-citeproc" ,ghc-pandoc-citeproc-with-pandoc-1)
        ("python-wrapper" ,python-wrapper)
        ("python-pyyaml" ,python-pyyaml)
+       ("python-pybigwig" ,python-pybigwig)
        ("snakemake" ,snakemake)
        ("bismark" ,bismark)
        ("fastqc" ,fastqc)
        ("bowtie" ,bowtie)
        ("trim-galore" ,trim-galore)
        ("cutadapt" ,cutadapt)
+       ("pigz" ,pigz)
+       ("htslib" ,htslib)
        ("samtools" ,samtools)))
     (home-page "https://github.com/BIMSBbioinfo/pigx_bsseq/")
     (synopsis "Bisulfite sequencing pipeline from fastq to methylation reports")
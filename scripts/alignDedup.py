@@ -0,0 +1,139 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# alignDedup.py - run Bismark and stream its alignments straight into
+# sorting, mate fixing and duplicate marking.
+#
+# Bismark cannot write its BAM file to stdout, so the file it would
+# write is replaced by a named pipe that feeds the samtools pipeline:
+#
+#   paired-end: sort -n | fixmate -m | sort | markdup -r
+#   single-end: sort | markdup -rs
+#
+# Only the deduplicated BAM file and the Bismark report(s) are kept.
+#
+# Usage: alignDedup.py [options] -- BISMARK-COMMAND...
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from glob import glob
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def samtools_pipeline(args, source, tmpdir, output):
+    """Return the list of commands that turn the unsorted alignments in
+SOURCE into the deduplicated, coordinate-sorted OUTPUT."""
+    samtools = args.samtools
+    sort = [samtools, 'sort', '-@', str(args.threads), '-m', args.sort_memory]
+    if args.paired:
+        return [sort + ['-n', '-l', '0', '-T', os.path.join(tmpdir, 'nsort'), source],
+                [samtools, 'fixmate', '-m', '-', '-'],
+                sort + ['-l', '0', '-T', os.path.join(tmpdir, 'csort'), '-'],
+                [samtools, 'markdup', '-r', '-', output]]
+    else:
+        return [sort + ['-l', '0', '-T', os.path.join(tmpdir, 'csort'), source],
+                [samtools, 'markdup', '-rs', '-', output]]
+
+
+def start_pipeline(commands):
+    procs = []
+    stdin = None
+    for idx, cmd in enumerate(commands):
+        last = idx == len(commands) - 1
+        proc = subprocess.Popen(cmd, stdin=stdin,
+                                stdout=None if last else subprocess.PIPE)
+        if stdin is not None:
+            stdin.close()
+        stdin = proc.stdout
+        procs.append(proc)
+    return procs
+
+
+def release_fifo(fifo):
+    """Unblock a reader still waiting on FIFO by opening and closing its
+write end.  Opening read-write never blocks."""
+    try:
+        fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+        os.close(fd)
+    except OSError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Align with Bismark and deduplicate without intermediate BAM files.")
+    parser.add_argument('--samtools', default='samtools', help="samtools executable")
+    parser.add_argument('--threads', type=int, default=1, help="additional threads for samtools sort")
+    parser.add_argument('--sort-memory', dest='sort_memory', default='768M',
+                        help="memory per samtools sort thread")
+    parser.add_argument('--paired', action='store_true', help="input is paired-end")
+    parser.add_argument('--bam-name', dest='bam_name', required=True,
+                        help="name of the BAM file Bismark writes")
+    parser.add_argument('--output', required=True, help="deduplicated BAM file")
+    parser.add_argument('--report-dir', dest='report_dir', required=True,
+                        help="where to move the Bismark reports to")
+    parser.add_argument('--tmpdir', default=None, help="directory for temporary files")
+    parser.add_argument('bismark', nargs=argparse.REMAINDER,
+                        help="Bismark command line (after --)")
+    args = parser.parse_args()
+
+    bismark = args.bismark[1:] if args.bismark[:1] == ['--'] else args.bismark
+    if not bismark:
+        parser.error("missing Bismark command")
+
+    tmpdir = tempfile.mkdtemp(prefix='align_dedup.', dir=args.tmpdir)
+    partial = args.output + '.partial'
+    fifo = os.path.join(tmpdir, args.bam_name)
+    os.mkfifo(fifo)
+    status = 1
+    procs = []
+    try:
+        procs = start_pipeline(samtools_pipeline(args, fifo, tmpdir, partial))
+        cmd = bismark + ['--output_dir', tmpdir, '--temp_dir', tmpdir]
+        log("Running: " + " ".join(cmd))
+        ret = subprocess.call(" ".join(cmd), shell=True)
+        if ret != 0:
+            log("Bismark failed with exit status {}.".format(ret))
+            release_fifo(fifo)
+            for proc in procs:
+                proc.kill()
+        failed = [proc.args[1] for proc in procs if proc.wait() != 0]
+        if ret == 0 and failed:
+            log("samtools {} failed.".format(", ".join(failed)))
+        if ret == 0 and not failed:
+            for report in glob(os.path.join(tmpdir, '*_report.txt')):
+                shutil.move(report, os.path.join(args.report_dir, os.path.basename(report)))
+            os.rename(partial, args.output)
+            status = 0
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if os.path.exists(partial):
+            os.remove(partial)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# annotateRegions.py - annotate the regions of a BED file with gene
+# parts, CpG islands and the nearest TSS.
+#
+# The features are read from the table that scripts/annotationIndex.R
+# writes next to the annotation index; it is sorted by chromosome and
+# position and has the columns
+#
+#   chromosome  start  end  feature  strand  name
+#
+# with 0-based starts and the features "promoter", "exon", "intron",
+# "CpGi", "shores" and "TSS".  The features of a chromosome are merged
+# into sorted arrays of disjoint intervals, so that the overlaps of a
+# region are found by bisection.
+#
+# The regions are read in batches of consecutive lines of the same
+# chromosome; the batches are annotated in parallel and written in the
+# order of the input, so that memory only grows with the batch size and
+# the number of cores.  Every region gets one line of the output table:
+#
+#   chr start end name score gene.part cpgi.part dist.to.tss tss.name tss.strand
+#
+# gene.part is "promoter", "exon", "intron" or "intergenic" and
+# cpgi.part is "CpGi", "shores" or "other", where the first overlapping
+# feature takes precedence.  dist.to.tss is the distance of the region
+# to the nearest TSS in the direction of transcription; it is "NA" on
+# chromosomes without TSSes.
+
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from multiprocessing import Pool
+
+GENE_PARTS = ['promoter', 'exon', 'intron']
+CPGI_PARTS = ['CpGi', 'shores']
+HEADER = ['chr', 'start', 'end', 'name', 'score', 'gene.part', 'cpgi.part',
+          'dist.to.tss', 'tss.name', 'tss.strand']
+
+
+def index_features(features):
+    """Return a dict of the chromosomes of the sorted feature table
+FEATURES to the byte offset and length of their lines."""
+    offsets = {}
+    chrom = None
+    start = offset = 0
+    with open(features, 'rb') as f:
+        for line in f:
+            name = line.split(b'\t', 1)[0].decode()
+            if name != chrom:
+                if chrom is not None:
+                    offsets[chrom] = (start, offset - start)
+                if name in offsets:
+                    raise Exception("{}: the features of {} are not contiguous.".format(features, name))
+                chrom, start = name, offset
+            offset += len(line)
+    if chrom is not None:
+        offsets[chrom] = (start, offset - start)
+    return offsets
+
+
+def merge(intervals):
+    """Return the sorted disjoint union of INTERVALS as arrays of starts
+and ends."""
+    starts, ends = array('l'), array('l')
+    for start, end in sorted(intervals):
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def read_chromosome(features, offset, length):
+    """Return the merged intervals of every feature and the sorted TSSes
+of the LENGTH bytes at OFFSET of the table FEATURES."""
+    intervals = {feature: [] for feature in GENE_PARTS + CPGI_PARTS}
+    tsses = []
+    with open(features, 'rb') as f:
+        f.seek(offset)
+        for line in f.read(length).decode().splitlines():
+            chrom, start, end, feature, strand, name = line.split('\t')
+            if feature == 'TSS':
+                position = int(start) if strand != '-' else int(end) - 1
+                tsses.append((position, strand, name))
+            elif feature in intervals:
+                intervals[feature].append((int(start), int(end)))
+    merged = {feature: merge(parts) for feature, parts in intervals.items()}
+    tsses.sort()
+    return merged, (array('l', [t[0] for t in tsses]), [t[1] for t in tsses], [t[2] for t in tsses])
+
+
+def overlaps(interval_arrays, start, end):
+    starts, ends = interval_arrays
+    idx = bisect_right(ends, start)
+    return idx < len(starts) and starts[idx] < end
+
+
+def nearest_tss(tsses, start, end):
+    """Return the distance of the region from START to END to the nearest
+TSS in the direction of transcription, its strand and its name."""
+    positions, strands, names = tsses
+    if not positions:
+        return "NA", "NA", "NA"
+    idx = bisect_left(positions, start)
+    def offset(i):
+        if positions[i] < start:
+            return start - positions[i]
+        if positions[i] >= end:
+            return end - 1 - positions[i]
+        return 0
+    best = min((i for i in (idx - 1, idx) if 0 <= i < len(positions)),
+               key=lambda i: abs(offset(i)))
+    dist = offset(best) if strands[best] != '-' else -offset(best)
+    return str(dist), strands[best], names[best]
+
+
+# The features of the last chromosome a worker annotated.
+_cache = {}
+
+def annotate_batch(job):
+    features, offsets, chrom, lines = job
+    if _cache.get('chrom') != chrom:
+        if chrom in offsets:
+            merged, tsses = read_chromosome(features, *offsets[chrom])
+        else:
+            merged = {feature: (array('l'), array('l')) for feature in GENE_PARTS + CPGI_PARTS}
+            tsses = (array('l'), [], [])
+        _cache.update(chrom=chrom, merged=merged, tsses=tsses)
+    merged, tsses = _cache['merged'], _cache['tsses']
+    out = []
+    for fields in lines:
+        start, end = int(fields[1]), int(fields[2])
+        gene_part = next((p for p in GENE_PARTS if overlaps(merged[p], start, end)), 'intergenic')
+        cpgi_part = next((p for p in CPGI_PARTS if overlaps(merged[p], start, end)), 'other')
+        dist, strand, name = nearest_tss(tsses, start, end)
+        out.append("\t".join([chrom, fields[1], fields[2],
+                              fields[3] if len(fields) > 3 else ".",
+                              fields[4] if len(fields) > 4 else ".",
+                              gene_part, cpgi_part, dist, name, strand]) + "\n")
+    return "".join(out)
+
+
+def read_batches(bed, batch_size):
+    """Yield (chromosome, lines) batches of at most BATCH_SIZE consecutive
+regions of the same chromosome of the BED file."""
+    chrom, lines = None, []
+    with open(bed, 'r') as f:
+        for line in f:
+            if line.startswith(('track', 'browser', '#')) or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if lines and (fields[0] != chrom or len(lines) >= batch_size):
+                yield chrom, lines
+                lines = []
+            chrom = fields[0]
+            lines.append(fields)
+    if lines:
+        yield chrom, lines
+
+
+def annotate(features, bed, output, cores, batch_size):
+    offsets = index_features(features)
+    jobs = ((features, offsets, chrom, lines) for chrom, lines in read_batches(bed, batch_size))
+    with open(output, 'w') as out, Pool(max(1, cores)) as pool:
+        out.write("\t".join(HEADER) + "\n")
+        # Annotate as many batches at once as there are workers, so
+        # that no more than these are held in memory.
+        while True:
+            window = list(islice(jobs, max(1, cores)))
+            if not window:
+                break
+            for text in pool.map(annotate_batch, window, chunksize=1):
+                out.write(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate the regions of a BED file with gene parts, CpG islands and the nearest TSS.")
+    parser.add_argument('--features', required=True, help="sorted feature table of the annotation index")
+    parser.add_argument('--bed', required=True, help="BED file of the regions")
+    parser.add_argument('--output', required=True, help="tab-separated table of the annotated regions")
+    parser.add_argument('--cores', type=int, default=1, help="number of batches annotated in parallel")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=100000,
+                        help="largest number of regions in a batch")
+    args = parser.parse_args()
+    annotate(args.features, args.bed, args.output, args.cores, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# bamInput.py - helpers for samples that enter the pipeline as aligned
+# bam files.
+#
+# Only the header and the first alignment of a bam file are read; BGZF
+# is a series of gzip members, so no samtools is needed for that.
+#
+#   inspect:    print whether a bam file is coordinate-sorted,
+#               deduplicated and paired as JSON
+#   seqlengths: write the chromosome lengths of the header in the
+#               format of the tabulate_seqlengths rule
+
+import argparse
+import gzip
+import json
+import struct
+import sys
+
+# Programs that mark or remove duplicate reads, as found in the @PG
+# lines they leave in the header.
+DEDUPLICATORS = ['markdup', 'rmdup', 'deduplicate_bismark', 'MarkDuplicates']
+
+
+def read_header(bam):
+    """Return the header text, the reference sequences as (name, length)
+tuples and the flag of the first alignment (None without alignments) of
+the bam file BAM."""
+    with gzip.open(bam, 'rb') as f:
+        if f.read(4) != b"BAM\x01":
+            raise Exception("{} is not a bam file.".format(bam))
+        l_text, = struct.unpack('<i', f.read(4))
+        text = f.read(l_text).rstrip(b"\0").decode()
+        n_ref, = struct.unpack('<i', f.read(4))
+        refs = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack('<i', f.read(4))
+            name = f.read(l_name).rstrip(b"\0").decode()
+            l_ref, = struct.unpack('<i', f.read(4))
+            refs.append((name, l_ref))
+        # block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag
+        record = f.read(20)
+        flag = struct.unpack('<iiiBBHHH', record)[7] if len(record) == 20 else None
+    return text, refs, flag
+
+
+def inspect(bam):
+    """Return a dict that tells whether BAM is "sorted" by coordinate,
+"deduped" by one of the DEDUPLICATORS and holds "paired" reads."""
+    text, refs, flag = read_header(bam)
+    sorted_ = False
+    deduped = False
+    for line in text.splitlines():
+        fields = line.split("\t")
+        if fields[0] == "@HD":
+            sorted_ = "SO:coordinate" in fields[1:]
+        elif fields[0] == "@PG":
+            deduped = deduped or any(name in field for field in fields[1:]
+                                     for name in DEDUPLICATORS
+                                     if field[:3] in ["ID:", "PN:", "CL:"])
+    return {'sorted': sorted_,
+            'deduped': deduped,
+            'paired': bool(flag is not None and flag & 0x1)}
+
+
+def write_seqlengths(bam, output):
+    text, refs, flag = read_header(bam)
+    with open(output, 'w') as out:
+        for name, length in refs:
+            out.write("{}\t{}\n".format(name, length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect aligned bam files given as input.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('inspect', help="print whether a bam file is sorted, deduplicated and paired")
+    p.add_argument('bam', help="bam file")
+
+    p = sub.add_parser('seqlengths', help="write the chromosome lengths of a bam file")
+    p.add_argument('--bam', required=True, help="bam file")
+    p.add_argument('--output', required=True, help="tab-separated chromosome lengths file")
+
+    args = parser.parse_args()
+    if args.command == 'inspect':
+        print(json.dumps(inspect(args.bam), sort_keys=True))
+    elif args.command == 'seqlengths':
+        write_seqlengths(args.bam, args.output)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# chromShards.py - helpers for running per-sample rules on groups of
+# chromosomes ("shards").
+#
+#   assign: print the comma-separated chromosomes of one shard
+#   gather: concatenate per-shard tables, keeping a single header
+
+import argparse
+import sys
+
+
+def read_seqlengths(filename):
+    """Return a list of (name, length) tuples from the tab-separated
+chromosome lengths file produced by the tabulate_seqlengths rule."""
+    chroms = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                chroms.append((fields[0], int(fields[1])))
+    return chroms
+
+
+def assign_shards(chroms, nshards):
+    """Split CHROMS into NSHARDS contiguous groups of similar total
+length.  Chromosomes keep their reference order, so concatenating the
+shards in order yields genome-ordered output.  Shards beyond the number
+of chromosomes are empty."""
+    shards = [[] for _ in range(nshards)]
+    remaining = sum(length for name, length in chroms)
+    idx = 0
+    total = 0
+    for pos, (name, length) in enumerate(chroms):
+        left_chroms = len(chroms) - pos
+        left_shards = nshards - idx
+        # Move on to the next shard once this one holds its share of
+        # the remaining sequence, but leave at least one chromosome for
+        # every remaining shard.
+        if shards[idx] and idx < nshards - 1 and (
+                total >= remaining / left_shards or left_chroms < left_shards):
+            remaining -= total
+            idx += 1
+            total = 0
+        shards[idx].append(name)
+        total += length
+    return shards
+
+
+def gather(output, inputs, header_lines):
+    with open(output, 'w') as out:
+        for idx, filename in enumerate(inputs):
+            with open(filename, 'r') as f:
+                for lineno, line in enumerate(f):
+                    if idx > 0 and lineno < header_lines:
+                        continue
+                    out.write(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scatter/gather helpers for chromosome shards.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('assign', help="print the chromosomes of one shard")
+    p.add_argument('--seqlengths', required=True, help="chromosome lengths file")
+    p.add_argument('--shards', type=int, required=True, help="total number of shards")
+    p.add_argument('--shard', type=int, required=True, help="index of the shard to print")
+
+    p = sub.add_parser('gather', help="concatenate shard tables")
+    p.add_argument('--output', required=True, help="output file")
+    p.add_argument('--header', type=int, default=0, help="number of header lines per input")
+    p.add_argument('inputs', nargs='+', help="shard files in order")
+
+    args = parser.parse_args()
+    if args.command == 'assign':
+        if not 0 <= args.shard < args.shards:
+            sys.exit("Shard index {} out of range.".format(args.shard))
+        shards = assign_shards(read_seqlengths(args.seqlengths), args.shards)
+        print(",".join(shards[args.shard]))
+    elif args.command == 'gather':
+        gather(args.output, args.inputs, args.header)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
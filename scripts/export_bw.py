@@ -0,0 +1,100 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# export_bw.py - write the methylation level (numCs / coverage) and the
+# read coverage of every CpG of a sample to two bigWig files.
+#
+# The calls are read from the sample's methylation store one chromosome
+# at a time and handed to the bigWig writers in batches, so memory use
+# is bounded by the batch size rather than by the size of the genome.
+
+import argparse
+import sys
+
+import pyBigWig
+
+from chromShards import read_seqlengths
+from methylStore import MethylStore
+
+
+def sites(store, chrom):
+    """Yield (position, numCs, coverage) for the CpGs of CHROM, adding
+up the two strands should both be called at the same position."""
+    last = None
+    for pos, strand, numCs, numTs in store.fetch(chrom):
+        if last is not None and last[0] == pos:
+            last = (pos, last[1] + numCs, last[2] + numCs + numTs)
+            continue
+        if last is not None:
+            yield last
+        last = (pos, numCs, numCs + numTs)
+    if last is not None:
+        yield last
+
+
+def export(storefile, seqlengths, methylation, coverage, batch_size):
+    chroms = read_seqlengths(seqlengths)
+    store = MethylStore(storefile)
+    writers = [pyBigWig.open(methylation, "w"), pyBigWig.open(coverage, "w")]
+    try:
+        for bw in writers:
+            bw.addHeader(chroms, maxZooms=10)
+
+        def flush(chrom, starts, meth, cov):
+            if starts:
+                ends = [start + 1 for start in starts]
+                writers[0].addEntries([chrom] * len(starts), starts, ends=ends, values=meth)
+                writers[1].addEntries([chrom] * len(starts), starts, ends=ends, values=cov)
+
+        # Entries have to be added in the order of the header.
+        for chrom, length in chroms:
+            starts, meth, cov = [], [], []
+            for pos, numCs, total in sites(store, chrom):
+                if total == 0:
+                    continue
+                starts.append(pos - 1)   # bigWig intervals are 0-based
+                meth.append(float(numCs) / total)
+                cov.append(float(total))
+                if len(starts) >= batch_size:
+                    flush(chrom, starts, meth, cov)
+                    starts, meth, cov = [], [], []
+            flush(chrom, starts, meth, cov)
+
+        missing = set(store.chroms) - set(name for name, length in chroms)
+        if missing:
+            print("Skipped calls on chromosomes without a length: " + ", ".join(sorted(missing)),
+                  file=sys.stderr)
+    finally:
+        for bw in writers:
+            bw.close()
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export methylation and coverage bigWig files.")
+    parser.add_argument('--store', required=True, help="methylation store (without .bin/.idx)")
+    parser.add_argument('--seqlengths', required=True, help="chromosome lengths file")
+    parser.add_argument('--methylation', required=True, help="bigWig file of methylation levels")
+    parser.add_argument('--coverage', required=True, help="bigWig file of read coverage")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=100000,
+                        help="number of CpGs handed to the bigWig writers at once")
+    args = parser.parse_args()
+    export(args.store, args.seqlengths, args.methylation, args.coverage, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
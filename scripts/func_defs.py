@@ -20,8 +20,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
+import os, sys, subprocess, math, shlex, inspect
 from glob import glob
+from functools import lru_cache
+
+def genome_fasta():
+    genome_dir = config['locations']['genome-dir']
+    return (glob(os.path.join(genome_dir, '*.fasta')) +
+            glob(os.path.join(genome_dir, '*.fa')))[0]
 
 def dedupe_tag(protocol):
     if protocol.upper() == "WGBS":
@@ -31,14 +37,74 @@ def dedupe_tag(protocol):
     else:
         raise Exception("=== ERROR: unexpected protocol ===")
 
-def files_for_sample(proc):
-    return [ expand(proc(config['SAMPLES'][sample]['files'],
-                         config['SAMPLES'][sample]['SampleID'],
-                         config['SAMPLES'][sample]['Protocol']))
-             for sample in config['SAMPLES'] ]
+# An index of the samples that is built once from config['SAMPLES'],
+# so that target lists and input functions do not have to scan all
+# samples on every call.
+_sample_index = {}
+
+def sample_index():
+    """Return a dict with the sample ids of every treatment
+("treatments") and the layout ("se" or "pe") of every sample
+("layout")."""
+    if not _sample_index:
+        treatments = {}
+        layout = {}
+        for sampleid, sample in config['SAMPLES'].items():
+            treatments.setdefault(sample['Treatment'], []).append(sampleid)
+            layout[sampleid] = 'se' if len(sample['fastq_name']) == 1 else 'pe'
+        _sample_index['treatments'] = treatments
+        _sample_index['layout'] = layout
+    return _sample_index
+
+def files_for_sample(proc, bam=True):
+    # The file names contain no wildcards, so they need no expand().
+    # Samples given as aligned bam files are left out with BAM=False.
+    return [ proc(config['SAMPLES'][sample]['files'],
+                  config['SAMPLES'][sample]['SampleID'],
+                  config['SAMPLES'][sample]['Protocol'])
+             for sample in config['SAMPLES']
+             if bam or not bam_input(sample) ]
+
+def bam_input(sampleid):
+    """Return what the header of the bam file of SAMPLEID tells ("sorted",
+"deduped", "paired"), or None for a sample given as reads."""
+    return config['SAMPLES'][sampleid].get('bam')
+
+def reduced_reference(sampleid):
+    """Whether the reads of SAMPLEID are aligned to the reduced reference
+genome of RRBS samples."""
+    return (bool(config['general']['rrbs']['reduced-reference']) and
+            config['SAMPLES'][sampleid]['Protocol'].upper() == "RRBS")
+
+def needs_genome_index(sampleid):
+    """Whether the reads of SAMPLEID are aligned to the whole genome."""
+    return not bam_input(sampleid) and not reduced_reference(sampleid)
+
+def genome_path(sampleid):
+    return REDUCEDPATH if reduced_reference(sampleid) else GENOMEPATH
+
+def bisulfite_index(conversion):
+    """Return an input function of the bisulfite genome of CONVERSION
+("CT" or "GA") that the reads of {sample} are aligned to."""
+    return lambda wildcards: "{0}Bisulfite_Genome/{1}_conversion/genome_mfa.{1}_conversion.fa".format(
+        genome_path(wildcards.sample), conversion)
+
+def reduced_regions(wildcards):
+    if reduced_reference(wildcards.sample):
+        return [REDUCEDPATH+"regions.tsv", REDUCEDPATH+"seqlengths.tsv"]
+    return []
+
+def lift_to_genome():
+    """Return the command that lifts SAM records from the reduced
+reference to genome coordinates in a pipe."""
+    return [tool('python'), DIR_scripts + "reducedReference.py", "lift",
+            "--regions=" + REDUCEDPATH + "regions.tsv",
+            "--seqlengths=" + REDUCEDPATH + "seqlengths.tsv"]
 
 def list_files_rawQC(files, sampleID, protocol):
     PATH = DIR_rawqc
+    if config['execution']['fused-trimming']:
+        return [PATH+sampleID+"_readstats.json"]
     if len(files) == 1:
         return [PATH+sampleID+"_fastqc.html"] #---- single end
     elif len(files) == 2:
@@ -49,23 +115,38 @@ def list_files_rawQC(files, sampleID, protocol):
 
 def list_files_TG(files, sampleID, protocol):
     PATH = DIR_trimmed
+    if COMPRESSION == 'pipe':
+        # Named pipes only exist while their reader runs.
+        return []
     if len(files) == 1:
-        return [PATH+sampleID+"_trimmed.fq.gz"] #---- single end
+        return [PATH+sampleID+"_trimmed"+TRIMMED_EXT] #---- single end
     elif len(files) == 2:
-        return [PATH+sampleID+"_1_val_1.fq.gz", PATH+sampleID+"_2_val_2.fq.gz"] #---- paired end
+        return [PATH+sampleID+"_1_val_1"+TRIMMED_EXT, PATH+sampleID+"_2_val_2"+TRIMMED_EXT] #---- paired end
     else:
         raise Exception("=== ERROR: file list is neither 1 nor 2 in length. STOP! ===")
 
 
 def list_files_posttrim_QC(files, sampleID, protocol):
-    PATH = DIR_posttrim_QC
     if len(files) == 1:
-        return [PATH+sampleID+"_trimmed_fastqc.html" ] #---- single end
+        return [f.replace("{sample}", sampleID) for f in posttrim_qc('se')] #---- single end
     elif len(files) == 2:
-        return [PATH+sampleID+"_1_val_1_fastqc.html", PATH+sampleID+"_2_val_2_fastqc.html"] #---- paired end
+        return [f.replace("{sample}", sampleID) for f in posttrim_qc('pe')] #---- paired end
     else:
         raise Exception("=== ERROR: file list is neither 1 nor 2 in length. STOP! ===")
 
+def posttrim_qc(layout):
+    """Return the quality control files of the trimmed reads of a
+sample of LAYOUT ("se" or "pe") as patterns of the {sample} wildcard.
+The alignment of a sample waits for these files."""
+    PATH = DIR_posttrim_QC
+    if config['execution']['fused-trimming']:
+        if layout == 'se':
+            return [PATH+"{sample}_trimmed_readstats.json"]
+        return [PATH+"{sample}_val_readstats.json"]
+    if layout == 'se':
+        return [PATH+"{sample}_trimmed_fastqc.html"]
+    return [PATH+"{sample}_1_val_1_fastqc.html", PATH+"{sample}_2_val_2_fastqc.html"]
+
 def list_files_bismark(files, sampleID, protocol):
     PATH = DIR_mapped
     if len(files) == 1:
@@ -98,21 +179,25 @@ def list_files_sortbam(files, sampleID, protocol):
 def bam_processing(files, sampleID, protocol):
     PATH = DIR_methcall
     if len(files) == 1:
-        return  PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) + "_methylRaw.RDS" #---- single end
+        prefix = PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) #---- single end
     elif len(files) == 2:
-        return [PATH+sampleID+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) + "_methylRaw.RDS"] #---- paired end
+        prefix = PATH+sampleID+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) #---- paired end
+    return [prefix + "_methylRaw.RDS",
+            prefix + "_methylStore.bin",
+            prefix + "_methylStore.idx"]
 
 def bigwig_exporting(files, sampleID, protocol):
     PATH = os.path.join(config['locations']['output-dir'], DIR_bigwig )
     if len(files) == 1:
-        return  PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) + ".bw" #---- single end
+        prefix = PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) #---- single end
     elif len(files) == 2:
-        return [PATH+sampleID+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) + ".bw"] #---- paired end
+        prefix = PATH+sampleID+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) #---- paired end
+    return [prefix + ".bw", prefix + "_coverage.bw"]
 
 def methSeg(files, sampleID, protocol):
     PATH = DIR_seg
     if len(files) == 1:
-        return  PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) + "_meth_segments_gr.RDS" #---- single end
+        return [PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) + "_meth_segments_gr.RDS"] #---- single end
     elif len(files) == 2:
         return [PATH+sampleID+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) + "_meth_segments_gr.RDS"] #---- paired end
     else:
@@ -121,7 +206,7 @@ def methSeg(files, sampleID, protocol):
 def list_final_reports(files, sampleID, protocol):
     PATH = DIR_final
     if len(files) == 1:
-        return  PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) + "_"+ASSEMBLY+"_final.html" #---- single end
+        return [PATH+sampleID+"_se_bt2.sorted" + dedupe_tag(protocol) + "_"+ASSEMBLY+"_final.html"] #---- single end
     elif len(files) == 2:
         return [PATH+sampleID+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) + "_"+ASSEMBLY+"_final.html"] #---- paired end
     else:
@@ -129,6 +214,30 @@ def list_final_reports(files, sampleID, protocol):
 
 
 
+def intermediate(path):
+    """Return PATH as an output of trimmed reads: a named pipe to the
+next rule with intermediate-compression "pipe", a plain file
+otherwise."""
+    return pipe(path) if COMPRESSION == 'pipe' else path
+
+def compress_trimmed(command, files):
+    """Append to COMMAND, which writes the uncompressed FILES, the
+compression of FILES to FILES.gz as set by intermediate-compression.
+Trim Galore can only write default-level gzip by itself."""
+    if COMPRESSION == 'fast':
+        return " && ".join([command, nice('pigz', ["-f", "-1", "-p {threads}"] + files)])
+    elif COMPRESSION == 'bgzf':
+        return " && ".join([command, nice('bgzip', ["-f", "-@ {threads}"] + files)])
+    return command
+
+
+def shard_files(directory, prefix, suffix):
+    """Return the per-shard files of PREFIX in the "shards" sub-directory
+of DIRECTORY, in shard order."""
+    return [os.path.join(directory, "shards", "{}.shard{}{}".format(prefix, idx, suffix))
+            for idx in range(int(config['execution']['shards']))]
+
+
 def fmt(message):
     """Format the MESSAGE string."""
     return "----------  " + message + "  ----------"
@@ -148,42 +257,50 @@ def get_fastq_name(full_name):
 
     return(output)
 
+@lru_cache(maxsize=None)
 def get_sampleids_from_treatment(treatment):
-  treatment = treatment.replace(".deduped", "")
-
-  SAMPLE_IDS = list(config["SAMPLES"].keys())
-  SAMPLE_TREATMENTS = [config["SAMPLES"][s]["Treatment"] for s in SAMPLE_IDS]
+  treatments = treatment.replace(".deduped", "").split("_")
+  index = sample_index()['treatments']
+  return [sampleid for t in treatments for sampleid in index.get(t, [])]
 
-  treatments = treatment.split("_")
-  sampleids_list = []
-  for t in treatments:
-    sampleids = [SAMPLE_IDS[i] for i, x in enumerate(SAMPLE_TREATMENTS) if x == t]
-    sampleids_list.append(sampleids)
-
-  sampleids_list = list(sum(sampleids_list, []))
-  return(sampleids_list)
+@lru_cache(maxsize=None)
+def diffmeth_path(DIR_diffmeth, suffix, treatment):
+    # The protocol is that of the first sample of the first treatment.
+    first = get_sampleids_from_treatment(treatment.split('vs')[0])[0]
+    return DIR_diffmeth + treatment.replace('vs', '_') + dedupe_tag(config["SAMPLES"][first]['Protocol']) + '_' + suffix
 
 def makeDiffMethPath(DIR_diffmeth, suffix, wc):
-    return DIR_diffmeth + str(wc.treatment).replace('vs', '_') + dedupe_tag(config["SAMPLES"][get_sampleids_from_treatment(wc.treatment[0])[0]]['Protocol']) + '_' + suffix
+    return diffmeth_path(DIR_diffmeth, suffix, str(wc.treatment))
+
+@lru_cache(maxsize=None)
+def sample_prefix(sampleid):
+  """Return the file name prefix of the methylation calls of SAMPLEID."""
+  protocol = config["SAMPLES"][sampleid]['Protocol']
+  if sample_index()['layout'][sampleid] == 'se':
+    return sampleid+"_se_bt2.sorted" + dedupe_tag(protocol)
+  else:
+    return sampleid+"_1_val_1_bt2.sorted" + dedupe_tag(protocol)
+
+# Samples that take part in any of the treatment comparisons, in the
+# order in which they first appear.
+@lru_cache(maxsize=None)
+def united_sampleids():
+  sampleids = []
+  seen = set()
+  for group in config["general"]["differential-methylation"]["treatment-groups"]:
+    for sampleid in get_sampleids_from_treatment("_".join(group)):
+      if not sampleid in seen:
+        seen.add(sampleid)
+        sampleids.append(sampleid)
+  return(sampleids)
+
+# For only CpG context.  All comparisons select their samples from the
+# methylation matrix that is shared by all comparisons.
+def united_matrix_files():
+  return [os.path.join(DIR_diffmeth, "united_methylMatrix" + ext) for ext in [".bin", ".idx"]]
 
-# For only CpG context
 def diffmeth_input_function(wc):
-  treatments = wc.treatment
-  treatments = treatments.replace(".deduped", "")
-  sampleids  = get_sampleids_from_treatment(treatments)
-
-  inputfiles = []
-  for sampleid in sampleids:
-    fqname = config["SAMPLES"][sampleid]['fastq_name']
-    protocol = config["SAMPLES"][sampleid]['Protocol']
-    if len(fqname)==1:
-      inputfile=[os.path.join(DIR_methcall,sampleid+"_se_bt2.sorted" + dedupe_tag(protocol) + "_methylRaw.RDS")]
-    elif len(fqname)==2:
-      inputfile=[os.path.join(DIR_methcall,sampleid+"_1_val_1_bt2.sorted" + dedupe_tag(protocol) + "_methylRaw.RDS")]
-    inputfiles.append(inputfile)
-
-  inputfiles = list(sum(inputfiles, []))
-  return(inputfiles)
+  return united_matrix_files()
 
 def tool(name):
     return config['tools'][name]['executable']
@@ -195,15 +312,185 @@ def toolArgs(name):
         return ""
 
 # Generate a command line string that can be passed to snakemake's
-# "shell".  The string is prefixed with an invocation of "nice".
+# "shell".  The string is prefixed with an invocation of "nice", which
+# runs under jobLedger.py to record the resources used by the job.
 def nice(cmd, args, log=None):
     executable = tool(cmd)
+    ledger = [tool('python'), os.path.join(DIR_scripts, "jobLedger.py"), "run",
+              "--ledger", LEDGER, "--rule", "{rule}",
+              "--inputs", "{input:q}", "--outputs", "{output:q}"]
     line = ["nice -" + str(config['execution']['nice']), executable] + [toolArgs(cmd)] + args
     if log:
         line.append("> {} 2>&1".format(log))
-    return " ".join(line)
-
-def generateReport(input, output, params, log, reportSubDir):
+    # The ledger only measures the processes it starts, so a pipeline
+    # runs in a shell of its own under it.
+    if any(arg.strip() == "|" for arg in args):
+        return " ".join(ledger + ["--shell", "--", shlex.quote(" ".join(line))])
+    return " ".join(ledger + ["--"] + line)
+
+# Run the COMMAND of a rule in a directory on node-local scratch when
+# "execution:scratch" is set (see scripts/scratchStage.py).  The outputs
+# are moved back when the command succeeds; INPUTS are copied to
+# scratch first and the other files the command leaves there are moved
+# to COLLECT.
+def staged(command, inputs=[], collect=None):
+    root = config['execution']['scratch']
+    if not root:
+        return command
+    line = [tool('python'), os.path.join(DIR_scripts, "scratchStage.py"),
+            "--root", shlex.quote(root), "--outputs", "{output:q}"]
+    if inputs:
+        line += ["--inputs"] + inputs
+    if collect:
+        line += ["--collect", collect]
+    return " ".join(line + ["--", shlex.quote(command)])
+
+# The directory of a staged command given by the environment VARIABLE:
+# $TMPDIR for temporary files or $PIGX_SCRATCH for the files it writes.
+# Without scratch staging this is PATH.
+def scratch_or(path, variable="TMPDIR"):
+    return "$" + variable + "/" if config['execution']['scratch'] else path
+
+# The prefix of the temporary files of "samtools sort" in a staged
+# command.
+def sort_tmp(name):
+    return "-T $TMPDIR/" + name if config['execution']['scratch'] else ""
+
+# Cores and memory of a rule as given in the "execution:rules" section
+# of the settings, falling back to "__default__".
+def rule_settings(rule):
+    rules = config['execution']['rules']
+    settings = dict(rules['__default__'])
+    settings.update(rules.get(rule, {}))
+    return settings
+
+def memory_mb(amount):
+    """Convert a memory amount such as "768M" or "19G" to megabytes."""
+    units = {'K': 1.0/1024, 'M': 1, 'G': 1024, 'T': 1024*1024}
+    amount = str(amount).strip().upper().rstrip('B')
+    if amount[-1:] in units:
+        return int(float(amount[:-1]) * units[amount[-1]])
+    return int(float(amount))
+
+def auto_resources():
+    return config['execution']['cluster'].get('auto-resources', False)
+
+_resource_history = []
+_resource_models = {}
+
+def resource_model(rule):
+    """Return the resources of RULE learned from the job ledgers (see
+jobLedger.fit_resources), or None if there are too few past jobs or
+auto-resources is disabled."""
+    if not auto_resources():
+        return None
+    if rule not in _resource_models:
+        if DIR_scripts not in sys.path:
+            sys.path.insert(0, DIR_scripts)
+        import jobLedger
+        if not _resource_history:
+            for ledger in [LEDGER] + list(config['execution']['cluster'].get('history') or []):
+                _resource_history.extend(jobLedger.read_ledger(ledger))
+        _resource_models[rule] = jobLedger.fit_resources(_resource_history, rule)
+    return _resource_models[rule]
+
+def rule_threads(rule, used=1):
+    """Return the number of cores to reserve for RULE, but at least
+USED, the number of cores its command is configured to use.  With
+auto-resources no more cores are reserved than past jobs of the rule
+kept busy."""
+    threads = int(rule_settings(rule)['threads'])
+    model = resource_model(rule)
+    if model:
+        threads = min(threads, int(math.ceil(model['parallelism'])))
+    return max(threads, int(used))
+
+def input_sizes(input):
+    """Return the sizes of the existing files among INPUT."""
+    return [os.path.getsize(f) for f in input if os.path.isfile(f)]
+
+def rule_memory(rule):
+    """Return a function that estimates the memory (in MB) needed by a
+job of RULE.  When the entry of the rule itself has a
+"memory-per-input-gb" setting the estimate is its "base-memory" plus
+that amount for every gigabyte of input, but never more than "memory";
+other rules reserve "memory".  Local runs with a memory budget never
+reserve more than the budget.
+
+With auto-resources the estimate is the peak memory that past jobs of
+the rule needed for the same amount of input, plus a safety margin.
+Jobs that are restarted after a failure get more memory with every
+attempt.  No job reserves more than "memory"."""
+    settings = rule_settings(rule)
+    scaling = config['execution']['rules'].get(rule, {})
+    limit = memory_mb(settings['memory'])
+    budget = config['execution']['local-memory']
+    if budget and not config['execution']['submit-to-cluster']:
+        limit = min(limit, memory_mb(budget))
+
+    def static(sizes):
+        if 'memory-per-input-gb' not in scaling or not sizes:
+            # Without inputs (they do not exist yet) reserve the maximum.
+            return limit
+        base = memory_mb(scaling.get('base-memory', 0))
+        per_gb = memory_mb(scaling['memory-per-input-gb'])
+        return min(limit, int(base + per_gb * sum(sizes) / 1024.0**3))
+
+    model = resource_model(rule)
+    if not auto_resources():
+        return lambda wildcards, input: static(input_sizes(input))
+
+    import jobLedger
+    cluster = config['execution']['cluster']
+    margin = 1 + float(cluster['memory-margin'])
+    minimum = memory_mb(cluster['min-memory'])
+    escalation = float(cluster['memory-escalation'])
+
+    def learned(wildcards, input, attempt):
+        sizes = input_sizes(input)
+        if model and sizes:
+            mem = max(minimum, margin * jobLedger.predict_memory(model, sum(sizes)))
+        else:
+            mem = static(sizes)
+        mem *= escalation ** (attempt - 1)
+        return int(min(mem, limit))
+    return learned
+
+def worker_memory(rule):
+    """Return a function of the memory (in MB) needed by a job of RULE
+that runs one worker process per thread, each limited to the
+"worker-memory" of the rule, besides a parent process of "base-memory".
+No job reserves more than "memory" or a local memory budget.  Rules
+without a worker-memory setting reserve memory as with rule_memory."""
+    settings = rule_settings(rule)
+    if 'worker-memory' not in settings:
+        return rule_memory(rule)
+    limit = memory_mb(settings['memory'])
+    budget = config['execution']['local-memory']
+    if budget and not config['execution']['submit-to-cluster']:
+        limit = min(limit, memory_mb(budget))
+    worker = memory_mb(settings['worker-memory'])
+    base = memory_mb(config['execution']['rules'].get(rule, {}).get('base-memory', 0))
+    return lambda wildcards, threads: min(limit, threads * worker + base)
+
+def memory_resources(memory):
+    """Return the resources of a job that needs MEMORY, a function as
+returned by rule_memory or worker_memory: "mem_mb" for the whole job,
+and "mem_mb_per_slot" for each of its cores, which is what cluster jobs
+request since SGE applies h_vmem to every slot."""
+    names = inspect.signature(memory).parameters
+    def per_slot(wildcards, input, threads, attempt):
+        values = {'wildcards': wildcards, 'input': input, 'threads': threads, 'attempt': attempt}
+        return -(-memory(**{name: values[name] for name in names}) // max(threads, 1))
+    return {'mem_mb': memory, 'mem_mb_per_slot': per_slot}
+
+def benchmark_file(rule, name=None):
+    """Return the file in which snakemake records the wall time, CPU
+time and peak memory of a job of RULE.  NAME is a pattern of the
+wildcards that identify the job, such as "{sample}"."""
+    return os.path.join(DIR_benchmarks, rule, (name or rule) + ".tsv")
+
+def generateReport(input, output, params, log, reportSubDir, rule):
     dumps = json.dumps(dict(params.items()),sort_keys=True,
                        separators=(",",":"), ensure_ascii=True)
 
@@ -216,6 +503,14 @@ def generateReport(input, output, params, log, reportSubDir):
                            "--logFile={log}"])
     shell(cmd, dumps)
 
+def print_ledger_summary(since):
+    """Print the rules and stages that took the most time among the jobs
+recorded in the ledger since SINCE."""
+    if DIR_scripts not in sys.path:
+        sys.path.insert(0, DIR_scripts)
+    import jobLedger
+    jobLedger.summary(LEDGER, since)
+
 def bail(msg):
     """Print the error message to stderr and exit."""
     print(msg, file=sys.stderr)
@@ -224,7 +519,7 @@ def bail(msg):
 def validate_config(config):
     # Check that all locations exist
     for loc in config['locations']:
-        if (not loc == 'output-dir') and (not os.path.isdir(config['locations'][loc]) ) :
+        if (not loc in ['output-dir', 'index-cache']) and (not os.path.isdir(config['locations'][loc]) ) :
             bail("ERROR: The following necessary directory does not exist: {} ({})".format(config['locations'][loc], loc))
 
     # Check that all of the requested differential methylation
@@ -235,16 +530,82 @@ def validate_config(config):
             if ( (group not in treatments) or (not (str.isdigit(group))) )  :
                 bail("ERROR: Invalid treatment group '{}' in pair '{}'".format(group, pair))
 
+    if int(config['general']['differential-methylation']['tile-size']) < 0:
+        bail("ERROR: general:differential-methylation:tile-size must not be negative.")
+
+    if int(config['general']['segmentation']['min-sites']) < 0:
+        bail("ERROR: general:segmentation:min-sites must not be negative.")
+
+    # Check that we know the requested methylation calling engine
+    engine = config['general']['methylation-calling']['engine']
+    if not engine.lower() in ['methylkit', 'native']:
+        bail("ERROR: Invalid methylation-calling engine '{}'; choose either 'methylKit' or 'native'.".format(engine))
+
+    # Sharded methylation calling needs to restrict the calls to a
+    # subset of chromosomes, which only the native engine can do.
+    if int(config['execution']['shards']) < 1:
+        bail("ERROR: execution:shards must be a positive number.")
+    if int(config['execution']['shards']) > 1 and not engine.lower() == 'native':
+        bail("ERROR: Sharded execution (execution:shards > 1) requires the 'native' methylation-calling engine.")
+
+    # Check the compression of the trimmed reads.  Bismark reads its
+    # input twice and FastQC would be a second reader, so named pipes
+    # only work from the single-pass trimming into the read chunks.
+    compression = config['execution']['intermediate-compression']
+    if not compression in ['gzip', 'fast', 'bgzf', 'none', 'pipe']:
+        bail("ERROR: Invalid intermediate-compression '{}'; choose one of 'gzip', 'fast', 'bgzf', 'none' or 'pipe'.".format(compression))
+    if compression == 'pipe' and not (config['execution']['fused-trimming'] and int(config['tools']['bismark']['chunks']) > 1):
+        bail("ERROR: execution:intermediate-compression 'pipe' requires execution:fused-trimming and aligning in chunks (tools:bismark:chunks > 1).")
+
+    # Check the size selection of the reduced reference.
+    rrbs = config['general']['rrbs']
+    if not 0 < int(rrbs['min-fragment']) <= int(rrbs['max-fragment']):
+        bail("ERROR: general:rrbs:min-fragment must be a positive number no larger than general:rrbs:max-fragment.")
+
+    # The fused alignment stage runs Bismark on the whole sample.
+    if config['execution']['fused-alignment'] and int(config['tools']['bismark']['chunks']) > 1:
+        bail("ERROR: execution:fused-alignment cannot be combined with aligning in chunks (tools:bismark:chunks > 1).")
+    # It does not lift alignments to the reduced reference back to the genome.
+    if config['execution']['fused-alignment'] and config['general']['rrbs']['reduced-reference']:
+        bail("ERROR: execution:fused-alignment cannot be combined with general:rrbs:reduced-reference.")
+
     # Check for a genome fasta file
     fasta = glob(os.path.join(config['locations']['genome-dir'], '*.fasta'))
     fa    = glob(os.path.join(config['locations']['genome-dir'], '*.fa'))
 
+    # Samples given as aligned bam files and RRBS samples aligned to the
+    # reduced reference do not need the bisulfite genome.
+    reads = [sample for sample in config['SAMPLES'] if needs_genome_index(sample)]
+
     # Check if we have permission to write to the reference-genome directory ourselves
     # if not, then check if the ref genome has already been converted
-    if (not os.access(config['locations']['genome-dir'], os.W_OK) and
+    if (reads and
+        not config['locations']['index-cache'] and
+        not os.access(config['locations']['genome-dir'], os.W_OK) and
         not os.path.isdir(os.path.join(config['locations']['genome-dir'], 'Bisulfite_Genome'))):
         bail("ERROR: reference genome has not been bisulfite-converted, and PiGx does not have permission to write to that directory. Please either (a) provide Bisulfite_Genome conversion directory yourself, or (b) enable write permission in {} so that PiGx can do so on its own.".format(config['locations']['genome-dir']))
 
     if not len(fasta) + len(fa) == 1 :
         bail("ERROR: Missing (or ambiguous) reference genome: The number of files ending in either '.fasta' or '.fa' in the following genome directory does not equal one: {}".format(config['locations']['genome-dir']))
 
+    # Link a bisulfite genome that is already in the shared index cache,
+    # so that the genome preparation rule does not have to run.
+    cache = config['locations']['index-cache']
+    if cache and reads:
+        sys.path.insert(0, DIR_scripts)
+        import indexCache
+        try:
+            os.makedirs(cache, exist_ok=True)
+        except OSError:
+            pass
+        if not os.access(cache, os.W_OK):
+            bail("ERROR: The index cache directory {} cannot be written to.".format(cache))
+        try:
+            key = indexCache.cache_key(genome_fasta(), cache, tool('bismark'), tool('bowtie2'),
+                                       toolArgs('bismark-genome-preparation'))
+        except (OSError, subprocess.CalledProcessError) as e:
+            bail("ERROR: Could not compute the index cache key of the reference genome: {}".format(e))
+        entry = os.path.join(cache, key)
+        if indexCache.entry_complete(entry) and not os.path.islink(GENOMEPATH.rstrip('/')):
+            indexCache.link_index(entry, os.path.join(GENOMEPATH, "Bisulfite_Genome"))
+
@@ -0,0 +1,177 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# indexCache.py - a bisulfite genome index cache that is shared between
+# pipeline runs.
+#
+# Every cache entry is a directory named after a hash of the reference
+# FASTA contents, the Bismark and Bowtie2 versions and the arguments
+# passed to bismark_genome_preparation.  It holds a link to the FASTA
+# file and the "Bisulfite_Genome" directory built from it.  Entries are
+# built while holding an exclusive lock, so that concurrent pipelines
+# wait for a single build instead of starting their own.
+#
+#   key:   print the cache key of a reference genome
+#   build: build the cache entry unless it exists and link it
+
+import argparse
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+COMPLETE = ".complete"
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def fasta_digest(fasta, cache):
+    """Return the SHA-256 digest of FASTA.  Hashing a large genome takes
+a while, so digests are remembered in CACHE as long as the size and
+modification time of the file do not change."""
+    fasta = os.path.realpath(fasta)
+    stat = os.stat(fasta)
+    stamp = "{}\t{}".format(stat.st_size, int(stat.st_mtime))
+    memo_dir = os.path.join(cache, "digests")
+    memo = os.path.join(memo_dir, hashlib.sha1(fasta.encode()).hexdigest())
+    if os.path.exists(memo):
+        with open(memo, 'r') as f:
+            saved_stamp, _, digest = f.read().strip().rpartition("\t")
+        if saved_stamp == stamp:
+            return digest
+
+    sha = hashlib.sha256()
+    with open(fasta, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    os.makedirs(memo_dir, exist_ok=True)
+    with open(memo + ".tmp", 'w') as f:
+        f.write("{}\t{}\n".format(stamp, digest))
+    os.replace(memo + ".tmp", memo)
+    return digest
+
+
+def tool_version(executable):
+    """Return the lines of "EXECUTABLE --version" that mention the
+version."""
+    out = subprocess.check_output([executable, '--version'],
+                                  stderr=subprocess.STDOUT,
+                                  universal_newlines=True)
+    lines = [line.strip() for line in out.splitlines() if 'ersion' in line]
+    return "\n".join(lines) if lines else out.strip()
+
+
+def cache_key(fasta, cache, bismark, bowtie2, args):
+    sha = hashlib.sha256()
+    for part in [fasta_digest(fasta, cache), tool_version(bismark),
+                 tool_version(bowtie2), " ".join(args.split())]:
+        sha.update(part.encode())
+        sha.update(b"\0")
+    return sha.hexdigest()[:24]
+
+
+def entry_complete(entry):
+    return os.path.exists(os.path.join(entry, COMPLETE))
+
+
+def link_index(entry, link):
+    """Point LINK at the Bisulfite_Genome directory of ENTRY, replacing
+an outdated link or an (empty) directory left behind by snakemake."""
+    target = os.path.join(os.path.abspath(entry), "Bisulfite_Genome")
+    if os.path.islink(link):
+        if os.readlink(link) == target:
+            return
+        os.remove(link)
+    elif os.path.isdir(link):
+        shutil.rmtree(link)
+    try:
+        os.symlink(target, link)
+    except FileExistsError:
+        # Another pipeline linked the same entry at the same time.
+        pass
+
+
+def build(cache, key, fasta, command, link):
+    entry = os.path.join(cache, key)
+    os.makedirs(cache, exist_ok=True)
+    with open(os.path.join(cache, key + ".lock"), 'w') as lock:
+        if not entry_complete(entry):
+            log("Waiting for the lock on {} ...".format(entry))
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if entry_complete(entry):
+                log("Using cached bisulfite genome {}.".format(entry))
+            else:
+                # Remove the remains of a build that did not finish.
+                shutil.rmtree(entry, ignore_errors=True)
+                os.makedirs(entry)
+                os.symlink(os.path.realpath(fasta),
+                           os.path.join(entry, os.path.basename(fasta)))
+                cmd = " ".join(command + [entry])
+                log("Running: " + cmd)
+                ret = subprocess.call(cmd, shell=True)
+                if ret != 0:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    sys.exit("Genome preparation failed with exit status {}.".format(ret))
+                open(os.path.join(entry, COMPLETE), 'w').close()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    if link:
+        link_index(entry, link)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared cache of bisulfite genome indexes.")
+    sub = parser.add_subparsers(dest='command')
+
+    for name, text in [('key', "print the cache key of a genome"),
+                       ('build', "build a cache entry unless it exists")]:
+        p = sub.add_parser(name, help=text)
+        p.add_argument('--cache', required=True, help="cache directory")
+        p.add_argument('--fasta', required=True, help="reference genome FASTA file")
+        p.add_argument('--bismark', default='bismark', help="bismark executable")
+        p.add_argument('--bowtie2', default='bowtie2', help="bowtie2 executable")
+        p.add_argument('--args', default='', help="arguments to bismark_genome_preparation")
+        if name == 'build':
+            p.add_argument('--link', default=None,
+                           help="symlink to create for the Bisulfite_Genome directory")
+            p.add_argument('prepare', nargs=argparse.REMAINDER,
+                           help="genome preparation command (after --), without the genome folder")
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    key = cache_key(args.fasta, args.cache, args.bismark, args.bowtie2, args.args)
+    if args.command == 'key':
+        print(key)
+    else:
+        prepare = args.prepare[1:] if args.prepare[:1] == ['--'] else args.prepare
+        if not prepare:
+            parser.error("missing genome preparation command")
+        build(args.cache, key, args.fasta, prepare, args.link)
+
+
+if __name__ == '__main__':
+    main()
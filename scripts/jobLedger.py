@@ -0,0 +1,293 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# jobLedger.py - record the resources used by the commands of the
+# pipeline.
+#
+# Every command built by nice() runs under "jobLedger.py run", which
+# waits for the command and appends one JSON line to the ledger:
+#
+#   rule, stage       the rule and the output directory of the job
+#   outputs           the output files of the job
+#   input_files       the number and total size of the input files
+#   input_bytes
+#   start, end        time stamps (seconds since the epoch)
+#   wall_s            elapsed time
+#   user_s, sys_s     CPU time of the command and its children
+#   max_rss_mb        peak resident memory of the largest process
+#   read_bytes        bytes read from and written to block devices
+#   write_bytes
+#   status            exit status of the command
+#   host, command     where and which executable ran
+#
+# Only the processes started by the command and waited for are
+# measured.  A pipeline is therefore run with --shell, as a whole in a
+# shell of its own, rather than only its first command.
+#
+# Jobs staged to node-local scratch (scripts/scratchStage.py) run with
+# their files renamed; they are recorded under their own names, which
+# scratchStage.py passes in $PIGX_STAGED.
+#
+# The ledger is only ever appended to, so it keeps the history of all
+# runs in an output directory.  Lines are written with a single call in
+# append mode and do not interleave when jobs finish at the same time.
+#
+# fit_resources() learns the memory and cores of a rule from the jobs
+# in the ledger, which lets the pipeline size its requests to the input
+# of each job.
+#
+#   run:     run a command and record it
+#   summary: print the slowest rules and stages of the ledger
+#   model:   print the resource model learned for each rule
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# ru_inblock and ru_oublock count blocks of 512 bytes
+BLOCK_SIZE = 512
+
+
+def stage_of(outputs):
+    """Return the top-level directory of the first output, relative to
+the working directory, e.g. "04_mapping"."""
+    if not outputs:
+        return ""
+    path = os.path.relpath(outputs[0])
+    return path.split(os.sep)[0] if os.sep in path else ""
+
+
+def unstaged(paths):
+    """Return PATHS with the files staged to scratch replaced by the
+files they stand for."""
+    names = json.loads(os.environ.get('PIGX_STAGED') or '{}')
+    return [names.get(path, path) for path in paths]
+
+
+def executable(command):
+    """Return the name of the program run by COMMAND, looking through
+an invocation of "bash -c" and "nice -N"."""
+    if os.path.basename(command[0]) == 'bash' and '-c' in command:
+        command = command[command.index('-c') + 1].split() or command
+    if os.path.basename(command[0]) == 'nice' and len(command) > 2 and command[1].startswith('-'):
+        command = command[2:]
+    return os.path.basename(command[0])
+
+
+def append(ledger, record):
+    line = (json.dumps(record, sort_keys=True) + "\n").encode()
+    fd = os.open(ledger, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def run(ledger, rule, inputs, outputs, command):
+    """Run COMMAND, record its resource use in LEDGER and return its exit
+status."""
+    sizes = [os.path.getsize(f) for f in inputs if os.path.isfile(f)]
+    start = time.time()
+    child = subprocess.Popen(command)
+
+    # Pass termination requests (e.g. from the cluster scheduler) on.
+    def forward(signum, frame):
+        child.send_signal(signum)
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, forward)
+
+    while True:
+        try:
+            pid, status, usage = os.wait4(child.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    end = time.time()
+    status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+    outputs = unstaged(outputs)
+
+    record = {
+        'rule': rule,
+        'stage': stage_of(outputs),
+        'outputs': outputs,
+        'input_files': len(sizes),
+        'input_bytes': sum(sizes),
+        'start': round(start, 3),
+        'end': round(end, 3),
+        'wall_s': round(end - start, 3),
+        'user_s': round(usage.ru_utime, 3),
+        'sys_s': round(usage.ru_stime, 3),
+        'max_rss_mb': round(usage.ru_maxrss / 1024.0, 1),   # KB on Linux
+        'read_bytes': usage.ru_inblock * BLOCK_SIZE,
+        'write_bytes': usage.ru_oublock * BLOCK_SIZE,
+        'status': status,
+        'host': socket.gethostname(),
+        'command': executable(command),
+    }
+    try:
+        append(ledger, record)
+    except OSError as e:
+        # A full disk or a missing directory must not fail the job.
+        print("Could not write to the job ledger {}: {}".format(ledger, e), file=sys.stderr)
+    return status
+
+
+def read_ledger(ledger, since=0):
+    """Return the records of LEDGER of jobs that started at SINCE or
+later."""
+    records = []
+    if not os.path.exists(ledger):
+        return records
+    with open(ledger, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue   # a line cut short by a crash
+            if record.get('start', 0) >= since:
+                records.append(record)
+    return records
+
+
+def fit_resources(records, rule, minimum=3):
+    """Learn the resources of RULE from the successful jobs among
+RECORDS.  Returns None with fewer than MINIMUM jobs, otherwise a dict:
+
+  intercept_mb, slope_mb_per_gb  a least-squares line of the peak RSS
+                                 over the input size in gigabytes
+  residual_mb                    the largest amount by which a job
+                                 exceeded the line
+  parallelism                    the largest number of cores a job kept
+                                 busy on average (CPU time / wall time)
+"""
+    jobs = [r for r in records if r['rule'] == rule and r['status'] == 0]
+    if len(jobs) < minimum:
+        return None
+    xs = [r['input_bytes'] / 1024.0**3 for r in jobs]
+    ys = [r['max_rss_mb'] for r in jobs]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    sxx = sum((x - mx)**2 for x in xs)
+    slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx if sxx > 0 else 0.0
+    # Memory does not shrink with growing input.
+    slope = max(0.0, slope)
+    intercept = my - slope * mx
+    residual = max(0.0, max(y - (intercept + slope * x) for x, y in zip(xs, ys)))
+    # Very short jobs say little about their use of cores.
+    timed = [r for r in jobs if r['wall_s'] >= 1] or jobs
+    parallelism = max((r['user_s'] + r['sys_s']) / max(r['wall_s'], 0.001) for r in timed)
+    return {'jobs': len(jobs),
+            'intercept_mb': intercept,
+            'slope_mb_per_gb': slope,
+            'residual_mb': residual,
+            'parallelism': parallelism}
+
+
+def predict_memory(model, input_bytes):
+    """Return the peak RSS (in MB) MODEL predicts for INPUT_BYTES of
+input."""
+    return model['intercept_mb'] + model['slope_mb_per_gb'] * input_bytes / 1024.0**3 \
+        + model['residual_mb']
+
+
+def totals(records, key):
+    """Sum up the records grouped by KEY, slowest first."""
+    groups = {}
+    for record in records:
+        total = groups.setdefault(record.get(key) or "-", {'jobs': 0, 'wall_s': 0.0, 'max_wall_s': 0.0,
+                                                           'cpu_s': 0.0, 'max_rss_mb': 0.0,
+                                                           'input_bytes': 0, 'failed': 0})
+        total['jobs'] += 1
+        total['wall_s'] += record['wall_s']
+        total['max_wall_s'] = max(total['max_wall_s'], record['wall_s'])
+        total['cpu_s'] += record['user_s'] + record['sys_s']
+        total['max_rss_mb'] = max(total['max_rss_mb'], record['max_rss_mb'])
+        total['input_bytes'] += record['input_bytes']
+        total['failed'] += record['status'] != 0
+    return sorted(groups.items(), key=lambda item: item[1]['wall_s'], reverse=True)
+
+
+def summary(ledger, since=0, top=10, out=sys.stdout):
+    """Print the TOP rules and the stages that took the most time in the
+jobs of LEDGER that started at SINCE or later."""
+    records = read_ledger(ledger, since)
+    if not records:
+        return
+    wall = max(r['end'] for r in records) - min(r['start'] for r in records)
+    out.write("Resource use of {} jobs over {:.0f}s (ledger: {}):\n".format(len(records), wall, ledger))
+    for key, title, limit in [('rule', "Slowest rules", top), ('stage', "Stages", None)]:
+        out.write("\n{}:\n".format(title))
+        out.write("  {:<32} {:>5} {:>11} {:>11} {:>11} {:>10} {:>10}\n".format(
+            key, "jobs", "wall (s)", "max (s)", "CPU (s)", "RSS (MB)", "input (MB)"))
+        for name, t in totals(records, key)[:limit]:
+            out.write("  {:<32} {:>5} {:>11.1f} {:>11.1f} {:>11.1f} {:>10.0f} {:>10.0f}{}\n".format(
+                name, t['jobs'], t['wall_s'], t['max_wall_s'], t['cpu_s'], t['max_rss_mb'],
+                t['input_bytes'] / 1024.0**2,
+                "  ({} failed)".format(t['failed']) if t['failed'] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ledger of the resources used by pipeline jobs.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('run', help="run a command and record its resource use")
+    p.add_argument('--ledger', required=True, help="JSON lines file to append to")
+    p.add_argument('--rule', required=True, help="name of the rule")
+    p.add_argument('--inputs', nargs='*', default=[], help="input files of the job")
+    p.add_argument('--outputs', nargs='*', default=[], help="output files of the job")
+    p.add_argument('--shell', action='store_true',
+                   help="run the command with bash, e.g. a pipeline, and fail if any part of it fails")
+    p.add_argument('cmd', nargs=argparse.REMAINDER, help="command to run (after --)")
+
+    p = sub.add_parser('summary', help="print the slowest rules and stages")
+    p.add_argument('--ledger', required=True, help="JSON lines file to read")
+    p.add_argument('--since', type=float, default=0, help="only jobs started at this time or later")
+    p.add_argument('--top', type=int, default=10, help="number of rules to show")
+
+    p = sub.add_parser('model', help="print the resource model of every rule")
+    p.add_argument('--ledger', required=True, nargs='+', help="JSON lines files to read")
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if not cmd:
+            parser.error("missing command")
+        if args.shell:
+            cmd = ['bash', '-o', 'pipefail', '-c', " ".join(cmd)]
+        sys.exit(run(args.ledger, args.rule, args.inputs, args.outputs, cmd))
+    elif args.command == 'summary':
+        summary(args.ledger, args.since, args.top)
+    elif args.command == 'model':
+        records = [r for ledger in args.ledger for r in read_ledger(ledger)]
+        print("rule\tjobs\tintercept_mb\tslope_mb_per_gb\tresidual_mb\tparallelism")
+        for rule in sorted(set(r['rule'] for r in records)):
+            model = fit_resources(records, rule, minimum=1)
+            if model:
+                print("{}\t{jobs}\t{intercept_mb:.0f}\t{slope_mb_per_gb:.0f}\t{residual_mb:.0f}"
+                      "\t{parallelism:.2f}".format(rule, **model))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
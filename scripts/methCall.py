@@ -0,0 +1,249 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# methCall.py - extract CpG methylation calls from a coordinate-sorted
+# Bismark BAM file and write them in methylKit's tabular ("amp")
+# format, i.e. the same "_CpG.txt" file that processBismarkAln writes.
+#
+# The BAM file is streamed through "samtools view" one chromosome at a
+# time.  Chromosomes are processed in parallel worker processes and
+# each worker only keeps the counts for positions that can still be
+# covered by upcoming reads, so memory use is bounded by the batch size
+# rather than by the size of the genome.
+#
+# With --store the calls are also written to a methylation store (see
+# scripts/methylStore.py) with the exact read counts, which the table
+# only holds as percentages.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from multiprocessing import Pool
+
+from methylStore import write_store
+
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+CPG_CALL_RE = re.compile(r'[Zz]')
+
+# Skip unmapped, secondary, QC-failed and supplementary alignments.
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x800
+
+HEADER = "chrBase\tchr\tbase\tstrand\tcoverage\tfreqC\tfreqT\n"
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def reference_length(cigar):
+    """Return the number of reference bases covered by CIGAR."""
+    return sum(int(n) for n, op in CIGAR_RE.findall(cigar) if op in 'MDN=X')
+
+
+def aligned_blocks(pos, cigar):
+    """Yield (query offset, reference position, length) for every block
+of CIGAR that is aligned to the reference, starting at POS."""
+    qpos = 0
+    rpos = pos
+    for n, op in CIGAR_RE.findall(cigar):
+        n = int(n)
+        if op in 'M=X':
+            yield qpos, rpos, n
+            qpos += n
+            rpos += n
+        elif op in 'IS':
+            qpos += n
+        elif op in 'DN':
+            rpos += n
+
+
+def parse_tags(fields):
+    tags = {}
+    for field in fields:
+        if field[:2] in ('XM', 'XG', 'MC'):
+            tags[field[:2]] = field[5:]
+    return tags
+
+
+def count_batch(lines, counts, minqual):
+    """Add the CpG calls of all alignments in LINES to COUNTS.  Return
+the leftmost start position of the last alignment in the batch."""
+    last_start = 0
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        flag = int(fields[1])
+        if flag & SKIP_FLAGS:
+            continue
+        pos = int(fields[3])
+        last_start = pos
+        tags = parse_tags(fields[11:])
+        xm = tags.get('XM')
+        if not xm or 'Z' not in xm and 'z' not in xm:
+            continue
+        minus = 1 if tags.get('XG') == 'GA' else 0
+        qual = fields[10]
+        check_qual = minqual > 0 and qual != '*'
+        cigar = fields[5]
+
+        # Do not count bases twice where the second mate overlaps its
+        # first mate.  The MC tag is added by "samtools fixmate".
+        skip_from = skip_to = 0
+        if flag & 0x1 and flag & 0x80 and fields[6] == '=' and 'MC' in tags:
+            skip_from = int(fields[7])
+            skip_to = skip_from + reference_length(tags['MC']) - 1
+
+        for qoff, roff, length in aligned_blocks(pos, cigar):
+            for match in CPG_CALL_RE.finditer(xm, qoff, qoff + length):
+                q = match.start()
+                if check_qual and ord(qual[q]) - 33 < minqual:
+                    continue
+                rpos = roff + q - qoff
+                if skip_from <= rpos <= skip_to:
+                    continue
+                key = rpos * 2 + minus
+                entry = counts.get(key)
+                if entry is None:
+                    entry = counts[key] = [0, 0]
+                if match.group() == 'Z':
+                    entry[0] += 1
+                else:
+                    entry[1] += 1
+    return last_start
+
+
+def flush(counts, upto, chrom, mincov, out):
+    """Write and forget all sites in COUNTS located before UPTO, as
+"position strand numCs numTs" lines."""
+    done = sorted(key for key in counts if key < upto * 2)
+    for key in done:
+        numCs, numTs = counts.pop(key)
+        if numCs + numTs < mincov:
+            continue
+        out.write("%d\t%s\t%d\t%d\n" % (key >> 1, '-' if key & 1 else '+', numCs, numTs))
+
+
+def merge_calls(order, tmpfiles, out):
+    """Yield the sites of the chromosomes in ORDER from their TMPFILES
+as (chromosome, position, strand, numCs, numTs), and write them to OUT
+in methylKit format."""
+    for chrom in order:
+        with open(tmpfiles[chrom], 'r') as part:
+            for line in part:
+                base, strand, numCs, numTs = line.split('\t')
+                base, numCs, numTs = int(base), int(numCs), int(numTs)
+                coverage = numCs + numTs
+                out.write("%s.%d\t%s\t%d\t%s\t%d\t%.2f\t%.2f\n" %
+                          (chrom, base, chrom, base, 'F' if strand == '+' else 'R',
+                           coverage, 100.0 * numCs / coverage, 100.0 * numTs / coverage))
+                yield chrom, base, strand, numCs, numTs
+
+
+def call_chromosome(job):
+    """Extract the calls for a single chromosome into a temporary file."""
+    samtools, bam, chrom, mincov, minqual, batch_size, outfile = job
+    proc = subprocess.Popen([samtools, 'view', bam, chrom],
+                            stdout=subprocess.PIPE, universal_newlines=True,
+                            bufsize=1 << 20)
+    counts = {}
+    reads = 0
+    with open(outfile, 'w') as out:
+        while True:
+            lines = proc.stdout.readlines(batch_size * 256)
+            if not lines:
+                break
+            reads += len(lines)
+            last_start = count_batch(lines, counts, minqual)
+            # The input is sorted by position, so no upcoming read can
+            # contribute to a site left of the current start position.
+            flush(counts, last_start, chrom, mincov, out)
+        flush(counts, sys.maxsize >> 2, chrom, mincov, out)
+    if proc.wait() != 0:
+        raise RuntimeError("samtools view failed for %s:%s" % (bam, chrom))
+    return chrom, reads, outfile
+
+
+def bam_chromosomes(samtools, bam):
+    """Return the chromosomes of the indexed BAM file that have at least
+one mapped read, in header order."""
+    out = subprocess.check_output([samtools, 'idxstats', bam],
+                                  universal_newlines=True)
+    chroms = []
+    for line in out.splitlines():
+        name, length, mapped, unmapped = line.split('\t')
+        if name != '*' and int(mapped) > 0:
+            chroms.append((name, int(length)))
+    return chroms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract CpG methylation calls from a sorted Bismark BAM file.")
+    parser.add_argument('--inBam', required=True, help="coordinate-sorted and indexed BAM file")
+    parser.add_argument('--callFile', required=True, help="output file in methylKit tabular format")
+    parser.add_argument('--store', default=None,
+                        help="prefix of a methylation store to write the calls to as well")
+    parser.add_argument('--mincov', type=int, default=10, help="minimum coverage (default: 10)")
+    parser.add_argument('--minqual', type=int, default=20, help="minimum base quality (default: 20)")
+    parser.add_argument('--cores', type=int, default=1, help="number of chromosomes processed in parallel")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=100000,
+                        help="approximate number of alignments held in memory per worker")
+    parser.add_argument('--chroms', default=None,
+                        help="comma-separated list of chromosomes to restrict the calls to")
+    parser.add_argument('--samtools', default='samtools', help="samtools executable")
+    args = parser.parse_args()
+
+    chroms = bam_chromosomes(args.samtools, args.inBam)
+    if args.chroms is not None:
+        selected = set(filter(None, args.chroms.split(',')))
+        chroms = [c for c in chroms if c[0] in selected]
+
+    order = [name for name, length in chroms]
+    tmpfiles = {}
+    jobs = [(args.samtools, args.inBam, name, args.mincov, args.minqual,
+             args.batch_size, "{}.{}.tmp".format(args.callFile, idx))
+            for idx, (name, length) in enumerate(chroms)]
+    # Start with the longest chromosomes to keep all workers busy.
+    jobs.sort(key=lambda job: -dict(chroms)[job[2]])
+
+    log("Extracting CpG calls from {} on {} chromosome(s) using {} core(s).".format(
+        args.inBam, len(jobs), args.cores))
+    try:
+        with Pool(max(1, args.cores)) as pool:
+            for chrom, reads, tmpfile in pool.imap_unordered(call_chromosome, jobs):
+                tmpfiles[chrom] = tmpfile
+                log("  {}: {} alignments".format(chrom, reads))
+
+        with open(args.callFile, 'w') as out:
+            out.write(HEADER)
+            calls = merge_calls(order, tmpfiles, out)
+            if args.store:
+                write_store(calls, args.store, args.callFile)
+            else:
+                for call in calls:
+                    pass
+    finally:
+        for job in jobs:
+            if os.path.exists(job[-1]):
+                os.remove(job[-1])
+    log("Wrote methylation calls to {}.".format(args.callFile))
+    if args.store:
+        log("Wrote methylation store {}.".format(args.store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# methylStore.py - a columnar, chromosome-indexed store of the CpG
+# methylation calls of one sample.
+#
+# A store "X_methylStore" consists of two files:
+#
+#   X_methylStore.bin  four little-endian columns of N entries each,
+#                      one after the other:
+#                        positions  int32
+#                        numCs      int32
+#                        numTs      int32
+#                        strand     uint8 (0 = "+", 1 = "-")
+#   X_methylStore.idx  a tab-separated index; the first line is
+#                      "#pigx-methylstore <version> <N>", followed by
+#                      one "chromosome offset count" line per chromosome.
+#
+# Sites are sorted by position within each chromosome, so a chromosome
+# or region can be read by seeking into the columns without loading the
+# whole sample.  scripts/methylStore.R reads stores from R.
+#
+# The native methylation caller (scripts/methCall.py) writes its store
+# itself from the read counts.  The methylKit table only holds the
+# percentage of methylated reads, rounded to two decimals, from which
+# "write" recovers the counts as methylKit does when it reads the table.
+#
+#   write: convert a methylKit "_CpG.txt" table into a store
+#   merge: join the stores of chromosome shards into a single store
+#   query: print the sites of a chromosome or region
+
+import argparse
+import mmap
+import os
+import shutil
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+VERSION = 1
+MAGIC = "#pigx-methylstore"
+
+# (name, array typecode, item size) in the order stored in the file
+COLUMNS = [('positions', 'i', 4), ('numCs', 'i', 4), ('numTs', 'i', 4), ('strand', 'B', 1)]
+
+
+def read_calls(callfile):
+    """Yield (chromosome, position, strand, numCs, numTs) for the sites
+of the methylKit "amp" table CALLFILE."""
+    with open(callfile, 'r') as f:
+        next(f, None)   # header
+        for line in f:
+            fields = line.split('\t')
+            coverage = int(fields[4])
+            numCs = int(round(coverage * float(fields[5]) / 100))
+            yield (fields[1], int(fields[2]), '+' if fields[3] == 'F' else '-',
+                   numCs, coverage - numCs)
+
+
+def read_stores(stores):
+    """Yield the sites of the STORES, one after the other, as
+read_calls does."""
+    for name in stores:
+        store = MethylStore(name)
+        try:
+            for chrom in sorted(store.chroms, key=lambda c: store.chroms[c][0]):
+                for position, strand, numCs, numTs in store.fetch(chrom):
+                    yield chrom, position, strand, numCs, numTs
+        finally:
+            store.close()
+
+
+def write_store(calls, store, source="the calls", batch_size=1000000):
+    """Write the sites CALLS, given as by read_calls, into the store
+STORE.  The columns are written to temporary files in a single pass
+over the sites, holding at most BATCH_SIZE sites in memory, and then
+joined.  SOURCE names the sites in error messages."""
+    chroms = []
+    seen = set()
+    total = 0
+    last = 0
+    parts = [store + ".bin." + name for name, typecode, size in COLUMNS]
+    outs = [open(part, 'wb') for part in parts]
+    try:
+        columns = [array(typecode) for name, typecode, size in COLUMNS]
+        for chrom, position, strand, numCs, numTs in calls:
+            if not chroms or chroms[-1][0] != chrom:
+                if chrom in seen:
+                    raise Exception("{}: the sites of {} are not contiguous.".format(source, chrom))
+                seen.add(chrom)
+                chroms.append([chrom, total, 0])
+            elif position < last:
+                raise Exception("{}: the sites of {} are not sorted by position.".format(source, chrom))
+            last = position
+            chroms[-1][2] += 1
+            total += 1
+            columns[0].append(position)
+            columns[1].append(numCs)
+            columns[2].append(numTs)
+            columns[3].append(0 if strand == '+' else 1)
+            if len(columns[0]) >= batch_size:
+                for values, out in zip(columns, outs):
+                    write_array(values, out)
+                columns = [array(typecode) for name, typecode, size in COLUMNS]
+        for values, out in zip(columns, outs):
+            write_array(values, out)
+        for out in outs:
+            out.close()
+
+        with open(store + ".bin", 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out, 1 << 20)
+    finally:
+        for out in outs:
+            out.close()
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+
+    with open(store + ".idx", 'w') as idx:
+        idx.write("{}\t{}\t{}\n".format(MAGIC, VERSION, total))
+        for chrom, offset, count in chroms:
+            idx.write("{}\t{}\t{}\n".format(chrom, offset, count))
+
+
+def write_array(values, out):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    values.tofile(out)
+
+
+def read_index(store):
+    """Return the number of sites and a dict mapping each chromosome to
+its (offset, count) in the store."""
+    chroms = {}
+    with open(store + ".idx", 'r') as f:
+        magic, version, total = f.readline().rstrip('\n').split('\t')
+        if magic != MAGIC or int(version) != VERSION:
+            raise Exception("{} is not a methylation store of version {}.".format(store, VERSION))
+        for line in f:
+            chrom, offset, count = line.rstrip('\n').split('\t')
+            chroms[chrom] = (int(offset), int(count))
+    return int(total), chroms
+
+
+class MethylStore(object):
+    """Memory-mapped read access to a store."""
+
+    def __init__(self, store):
+        self.total, self.chroms = read_index(store)
+        self.file = open(store + ".bin", 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.total else None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def column(self, name, offset, count):
+        start = 0
+        for cname, typecode, size in COLUMNS:
+            if cname == name:
+                break
+            start += size * self.total
+        start += offset * size
+        if sys.byteorder == 'little':
+            return memoryview(self.map)[start:start + count * size].cast(typecode)
+        values = array(typecode, self.map[start:start + count * size])
+        values.byteswap()
+        return values
+
+    def fetch(self, chrom, start=None, end=None):
+        """Yield (position, strand, numCs, numTs) for the sites of CHROM,
+optionally restricted to positions START to END (1-based, inclusive)."""
+        if chrom not in self.chroms:
+            return
+        offset, count = self.chroms[chrom]
+        positions = self.column('positions', offset, count)
+        lo = 0 if start is None else bisect_left(positions, start)
+        hi = count if end is None else bisect_right(positions, end)
+        if lo >= hi:
+            return
+        numCs = self.column('numCs', offset + lo, hi - lo)
+        numTs = self.column('numTs', offset + lo, hi - lo)
+        strand = self.column('strand', offset + lo, hi - lo)
+        for i in range(hi - lo):
+            yield positions[lo + i], '-' if strand[i] else '+', numCs[i], numTs[i]
+
+
+def parse_region(region):
+    """Parse "chr", "chr:start-end" or "chr:start" into a tuple."""
+    chrom, _, span = region.partition(':')
+    if not span:
+        return chrom, None, None
+    start, _, end = span.replace(',', '').partition('-')
+    return chrom, int(start), int(end) if end else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar store of CpG methylation calls.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('write', help="convert a methylKit CpG table into a store")
+    p.add_argument('--callFile', required=True, help="methylation calls in methylKit tabular format")
+    p.add_argument('--store', required=True, help="store prefix (without .bin/.idx)")
+
+    p = sub.add_parser('merge', help="join the stores of chromosome shards into a single store")
+    p.add_argument('--store', required=True, help="store prefix (without .bin/.idx)")
+    p.add_argument('shards', nargs='+', help="prefixes of the stores to join, in order")
+
+    p = sub.add_parser('query', help="print the sites of chromosomes or regions")
+    p.add_argument('--store', required=True, help="store prefix (without .bin/.idx)")
+    p.add_argument('regions', nargs='*', help="chr, chr:start or chr:start-end; all chromosomes by default")
+
+    args = parser.parse_args()
+    if args.command == 'write':
+        write_store(read_calls(args.callFile), args.store, args.callFile)
+    elif args.command == 'merge':
+        write_store(read_stores(args.shards), args.store, " ".join(args.shards))
+    elif args.command == 'query':
+        store = MethylStore(args.store)
+        try:
+            regions = [parse_region(r) for r in args.regions] or \
+                      [(chrom, None, None) for chrom in sorted(store.chroms, key=lambda c: store.chroms[c][0])]
+            out = sys.stdout
+            out.write("chr\tstart\tstrand\tnumCs\tnumTs\n")
+            for chrom, start, end in regions:
+                for pos, strand, numCs, numTs in store.fetch(chrom, start, end):
+                    out.write("{}\t{}\t{}\t{}\t{}\n".format(chrom, pos, strand, numCs, numTs))
+        finally:
+            store.close()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# readChunks.py - helpers for aligning a sample in several read chunks.
+#
+#   split:         distribute the reads of one or two (paired) fastq
+#                  files over a number of chunk files
+#   merge-reports: combine the Bismark reports of all chunks into one
+
+import argparse
+import gzip
+import io
+import re
+import sys
+from itertools import islice
+
+
+def open_fastq(filename, mode):
+    """Open FILENAME, which is gzipped if its name ends in ".gz"."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode, compresslevel=1) if 'w' in mode else gzip.open(filename, mode)
+    return io.open(filename, mode)
+
+
+def split_fastq(inputs, outputs, block_size):
+    """Distribute the reads of the fastq files INPUTS over OUTPUTS.
+OUTPUTS holds one list of chunk files per input file.  Reads are dealt
+out in blocks of BLOCK_SIZE reads, round-robin, and all inputs advance
+in lockstep so that mates end up in the same chunk.  Inputs may be
+named pipes, as they are read only once."""
+    nchunks = len(outputs[0])
+    readers = [open_fastq(f, 'rb') for f in inputs]
+    writers = [[open_fastq(f, 'wb') for f in files] for files in outputs]
+    try:
+        chunk = 0
+        while True:
+            blocks = [list(islice(reader, 4 * block_size)) for reader in readers]
+            if not blocks[0]:
+                break
+            if len(set(len(block) for block in blocks)) != 1:
+                raise Exception("Paired fastq files have different numbers of reads.")
+            for block, files in zip(blocks, writers):
+                files[chunk].writelines(block)
+            chunk = (chunk + 1) % nchunks
+    finally:
+        for f in readers:
+            f.close()
+        for files in writers:
+            for f in files:
+                f.close()
+
+
+# Percentages in Bismark reports and the counts they are derived from.
+PERCENTAGES = {
+    'Mapping efficiency': (
+        ['Number of alignments with a unique best hit from the different alignments',
+         'Number of paired-end alignments with a unique best hit'],
+        ['Sequences analysed in total', 'Sequence pairs analysed in total'])
+}
+for context in ['CpG', 'CHG', 'CHH', 'Unknown (CN or CHN)']:
+    PERCENTAGES["C methylated in {} context".format(context)] = (
+        ["Total methylated C's in {} context".format(context)],
+        ["Total methylated C's in {} context".format(context),
+         "Total unmethylated C's in {} context".format(context)])
+
+LINE_RE = re.compile(r'^([^\t]+):\t(\S+)(.*)$')
+
+
+def merge_reports(reports, output):
+    """Write a Bismark report to OUTPUT in which all counts are the sums
+of the counts in REPORTS and all percentages are recomputed."""
+    totals = {}
+    for report in reports:
+        with open(report, 'r') as f:
+            for line in f:
+                m = LINE_RE.match(line.rstrip('\n'))
+                if m and m.group(2).isdigit():
+                    totals[m.group(1)] = totals.get(m.group(1), 0) + int(m.group(2))
+
+    def total(keys):
+        return sum(totals.get(key, 0) for key in keys)
+
+    with open(reports[0], 'r') as template, open(output, 'w') as out:
+        for line in template:
+            m = LINE_RE.match(line.rstrip('\n'))
+            if m and m.group(2).isdigit():
+                line = "{}:\t{}{}\n".format(m.group(1), totals[m.group(1)], m.group(3))
+            elif m and m.group(1) in PERCENTAGES:
+                numerator, denominator = PERCENTAGES[m.group(1)]
+                if total(denominator) > 0:
+                    line = "{}:\t{:.1f}%\n".format(m.group(1), 100.0 * total(numerator) / total(denominator))
+            out.write(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split reads into chunks and merge chunked Bismark reports.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('split', help="split fastq files into chunks")
+    p.add_argument('--input', action='append', required=True,
+                   help="fastq file (gzipped if it ends in .gz); give twice for paired-end data")
+    p.add_argument('--output', action='append', required=True,
+                   help="comma-separated chunk files, once per --input")
+    p.add_argument('--block-size', dest='block_size', type=int, default=100000,
+                   help="number of consecutive reads written to the same chunk")
+
+    p = sub.add_parser('merge-reports', help="merge Bismark reports")
+    p.add_argument('--output', required=True, help="merged report")
+    p.add_argument('reports', nargs='+', help="reports of all chunks")
+
+    args = parser.parse_args()
+    if args.command == 'split':
+        outputs = [files.split(',') for files in args.output]
+        if len(outputs) != len(args.input) or len(set(map(len, outputs))) != 1:
+            sys.exit("Need the same number of chunk files for every input file.")
+        split_fastq(args.input, outputs, args.block_size)
+    elif args.command == 'merge-reports':
+        merge_reports(args.reports, args.output)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# reducedReference.py - align RRBS reads to a reduced reference genome.
+#
+# RRBS reads only come from the fragments of an MspI (C^CGG) digest that
+# pass the size selection of the library.  The reduced reference keeps
+# these fragments, with a few bases of padding on either side, and
+# drops the rest of the genome, which makes the bisulfite index and the
+# alignment much smaller.
+#
+# The kept regions of a chromosome are joined into one sequence of the
+# same name, separated by runs of N that no read can align across.
+# The regions file maps every region back to the genome:
+#
+#   chromosome  start in the reduced sequence  start in the genome  length
+#
+# Alignments to the reduced reference are lifted back to genome
+# coordinates, so that everything downstream of the alignment works on
+# the genome as before.
+#
+#   digest: write the reduced reference of a genome FASTA file
+#   lift:   rewrite a SAM stream from reduced to genome coordinates
+
+import argparse
+import bisect
+import sys
+
+SITE = "CCGG"   # MspI cuts C^CGG
+PADDING = 10    # bases kept on either side of a fragment
+SPACER = 200    # Ns between the regions of a chromosome
+LINE_WIDTH = 60
+
+
+def read_fasta(fasta):
+    """Yield (name, sequence) for every sequence of FASTA, one at a time."""
+    name, parts = None, []
+    with open(fasta, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, "".join(parts)
+                name, parts = line[1:].split()[0], []
+            elif line:
+                parts.append(line)
+    if name is not None:
+        yield name, "".join(parts)
+
+
+def fragment_regions(seq, min_size, max_size):
+    """Return the (start, end) regions of SEQ that hold the fragments of
+an MspI digest of MIN_SIZE to MAX_SIZE bases, padded and merged where
+they overlap or are closer than the spacer."""
+    upper = seq.upper()
+    cuts = []
+    pos = upper.find(SITE)
+    while pos >= 0:
+        cuts.append(pos + 1)
+        pos = upper.find(SITE, pos + 1)
+    regions = []
+    for start, end in zip(cuts, cuts[1:]):
+        if not min_size <= end - start <= max_size:
+            continue
+        start = max(0, start - PADDING)
+        end = min(len(seq), end + PADDING)
+        if regions and start - regions[-1][1] < SPACER:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def digest(fasta, output, regions_file, seqlengths_file, min_size, max_size):
+    """Write the reduced reference of FASTA to OUTPUT, the map of its
+regions to REGIONS_FILE and the lengths of all chromosomes of the genome
+to SEQLENGTHS_FILE."""
+    genome_bases = 0
+    reduced_bases = 0
+    with open(output, 'w') as out, open(regions_file, 'w') as regions_out, \
+         open(seqlengths_file, 'w') as lengths_out:
+        for name, seq in read_fasta(fasta):
+            lengths_out.write("{}\t{}\n".format(name, len(seq)))
+            genome_bases += len(seq)
+            regions = fragment_regions(seq, min_size, max_size)
+            if not regions:
+                continue
+            parts = []
+            offset = 0
+            for start, end in regions:
+                if parts:
+                    parts.append("N" * SPACER)
+                    offset += SPACER
+                regions_out.write("{}\t{}\t{}\t{}\n".format(name, offset, start, end - start))
+                parts.append(seq[start:end])
+                offset += end - start
+            reduced = "".join(parts)
+            reduced_bases += len(reduced)
+            out.write(">{}\n".format(name))
+            for start in range(0, len(reduced), LINE_WIDTH):
+                out.write(reduced[start:start + LINE_WIDTH] + "\n")
+    if reduced_bases == 0:
+        raise Exception("The MspI digest of {} yields no fragments of {} to {} bp.".format(fasta, min_size, max_size))
+    print("Reduced reference: {} of {} bases ({:.1%}).".format(
+        reduced_bases, genome_bases, reduced_bases / float(genome_bases)), file=sys.stderr)
+
+
+def read_regions(regions_file):
+    """Return a dict of chromosome names to two sorted lists: the starts
+of the regions in the reduced sequence and the offsets that lift them
+to the genome."""
+    regions = {}
+    with open(regions_file, 'r') as f:
+        for line in f:
+            name, reduced_start, genome_start, length = line.split("\t")
+            starts, offsets = regions.setdefault(name, ([], []))
+            starts.append(int(reduced_start))
+            offsets.append(int(genome_start) - int(reduced_start))
+    return regions
+
+
+def lift_position(regions, name, pos):
+    """Return the 1-based genome position of the 1-based position POS on
+the reduced sequence NAME.  A position in a spacer is lifted with the
+region that follows it."""
+    if pos == 0 or name not in regions:
+        return pos
+    starts, offsets = regions[name]
+    idx = bisect.bisect_right(starts, pos - 1) - 1
+    if idx < 0:
+        idx = 0
+    elif idx + 1 < len(starts) and pos - 1 - starts[idx] >= starts[idx + 1] - starts[idx] - SPACER:
+        idx += 1
+    return max(1, pos + offsets[idx])
+
+
+def lift(regions_file, seqlengths_file, instream, outstream):
+    """Rewrite the SAM records of INSTREAM from reduced to genome
+coordinates; the @SQ lines are replaced with the chromosomes of the
+genome."""
+    regions = read_regions(regions_file)
+    with open(seqlengths_file, 'r') as f:
+        seqlengths = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    in_header = True
+    for line in instream:
+        if line.startswith('@'):
+            if not line.startswith('@SQ\t'):
+                outstream.write(line)
+            continue
+        if in_header:
+            for name, length in seqlengths:
+                outstream.write("@SQ\tSN:{}\tLN:{}\n".format(name, length))
+            outstream.write("@PG\tID:reducedReference\tPN:reducedReference.py\n")
+            in_header = False
+        fields = line.split("\t", 9)
+        name = fields[2]
+        fields[3] = str(lift_position(regions, name, int(fields[3])))
+        mate = name if fields[6] == "=" else fields[6]
+        fields[7] = str(lift_position(regions, mate, int(fields[7])))
+        outstream.write("\t".join(fields))
+    if in_header:
+        for name, length in seqlengths:
+            outstream.write("@SQ\tSN:{}\tLN:{}\n".format(name, length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reduced reference genomes for RRBS data.")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('digest', help="write the reduced reference of a genome")
+    p.add_argument('--fasta', required=True, help="genome FASTA file")
+    p.add_argument('--output', required=True, help="FASTA file of the reduced reference")
+    p.add_argument('--regions', required=True, help="map of the regions to the genome")
+    p.add_argument('--seqlengths', required=True, help="tab-separated chromosome lengths of the genome")
+    p.add_argument('--min-size', dest='min_size', type=int, default=40, help="smallest fragment")
+    p.add_argument('--max-size', dest='max_size', type=int, default=220, help="largest fragment")
+
+    p = sub.add_parser('lift', help="lift SAM records on standard input to genome coordinates")
+    p.add_argument('--regions', required=True, help="map of the regions to the genome")
+    p.add_argument('--seqlengths', required=True, help="tab-separated chromosome lengths of the genome")
+
+    args = parser.parse_args()
+    if args.command == 'digest':
+        digest(args.fasta, args.output, args.regions, args.seqlengths, args.min_size, args.max_size)
+    elif args.command == 'lift':
+        lift(args.regions, args.seqlengths, sys.stdin, sys.stdout)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
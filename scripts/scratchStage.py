@@ -0,0 +1,148 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# scratchStage.py - run a job in a directory on node-local scratch.
+#
+# A fresh directory is made below the scratch root (for example
+# "$TMPDIR", which is expanded on the node the job runs on).  Every
+# occurrence of an output file in the command is replaced by a file of
+# the same name in that directory, and so is every input file given
+# with --inputs, which is copied there first.  The command runs with
+# $PIGX_SCRATCH set to the directory and $TMPDIR to a "tmp" directory
+# inside it, so that the temporary files of the tools stay on the node.
+# $PIGX_STAGED maps the staged files back to their own names, so that
+# the job ledger records the files and the stage of the job rather than
+# the scratch directory.
+#
+# When the command succeeds, the outputs are copied next to their final
+# names and renamed, so that a final name only ever holds a complete
+# file.  Files left at the top of the scratch directory are moved to the
+# directory given with --collect.  The scratch directory is removed in
+# any case, also when the job is killed.
+#
+# Usage: scratchStage.py --root ROOT --outputs FILE... [options] -- COMMAND
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def substitute(command, paths):
+    """Replace the file names in COMMAND by the files they are staged to,
+as given by the dict PATHS.  Only whole words are replaced."""
+    for path in sorted(paths, key=len, reverse=True):
+        command = re.sub(r"(?<![\w./-])" + re.escape(path) + r"(?![\w./-])",
+                         lambda m: paths[path], command)
+    return command
+
+
+def move_atomically(source, target):
+    """Move SOURCE to TARGET such that TARGET appears complete or not
+at all, also across file systems."""
+    fd, partial = tempfile.mkstemp(prefix='.' + os.path.basename(target) + '.',
+                                   suffix='.partial', dir=os.path.dirname(target) or '.')
+    os.close(fd)
+    try:
+        shutil.move(source, partial)
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a job in a directory on node-local scratch.")
+    parser.add_argument('--root', required=True,
+                        help="directory to make the scratch directory in; environment variables are expanded")
+    parser.add_argument('--outputs', nargs='+', required=True, help="output files of the job")
+    parser.add_argument('--inputs', nargs='*', default=[], help="input files to copy to scratch")
+    parser.add_argument('--collect', default=None,
+                        help="directory to move the other files of the scratch directory to")
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="shell command (after --)")
+    args = parser.parse_args()
+
+    command = " ".join(args.command[1:] if args.command[:1] == ['--'] else args.command)
+    if not command:
+        parser.error("missing command")
+
+    root = os.path.expandvars(args.root)
+    if not root or not os.path.isdir(root):
+        raise Exception("The scratch directory {} ({}) does not exist.".format(root, args.root))
+
+    names = [os.path.basename(path) for path in args.outputs + args.inputs]
+    if len(set(names)) < len(names):
+        raise Exception("The staged files do not have distinct names: {}".format(" ".join(names)))
+
+    signal.signal(signal.SIGTERM, terminate)
+    scratch = tempfile.mkdtemp(prefix='pigx.', dir=root)
+    child = None
+    status = 1
+    try:
+        staged = {path: os.path.join(scratch, os.path.basename(path))
+                  for path in args.outputs + args.inputs}
+        for path in args.inputs:
+            log("Copying {} to {}".format(path, staged[path]))
+            shutil.copyfile(path, staged[path])
+
+        env = dict(os.environ, PIGX_SCRATCH=scratch, TMPDIR=os.path.join(scratch, 'tmp'),
+                   PIGX_STAGED=json.dumps({staged[path]: path for path in staged}))
+        os.mkdir(env['TMPDIR'])
+        command = substitute(command, staged)
+        log("Running in {}: {}".format(scratch, command))
+        # The command runs in a process group of its own, so that all
+        # processes of a pipeline are stopped with it.
+        child = subprocess.Popen(['bash', '-c', command], env=env, start_new_session=True)
+        status = child.wait()
+        child = None
+        if status < 0:
+            status = 128 - status
+
+        if status != 0:
+            log("The command failed with exit status {}.".format(status))
+        else:
+            for path in args.outputs:
+                if os.path.lexists(staged[path]):
+                    move_atomically(staged[path], path)
+            if args.collect:
+                inputs = set(staged[path] for path in args.inputs)
+                for entry in os.scandir(scratch):
+                    if entry.is_file() and entry.path not in inputs:
+                        move_atomically(entry.path, os.path.join(args.collect, entry.name))
+    finally:
+        if child is not None and child.poll() is None:
+            os.killpg(child.pid, signal.SIGTERM)
+            child.wait()
+        shutil.rmtree(scratch, ignore_errors=True)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
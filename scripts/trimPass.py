@@ -0,0 +1,354 @@
+# PiGx BSseq Pipeline.
+#
+# This file is part of the PiGx BSseq Pipeline.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# trimPass.py - trim the reads of a sample and check their quality in
+# a single pass over the input.
+#
+# The reads are decompressed once and streamed through cutadapt, which
+# removes adapters and low-quality ends with the defaults of Trim
+# Galore.  On their way in and out the reads are summarised (number,
+# lengths, base composition and base qualities), and the trimmed reads
+# are compressed by several threads at once:
+#
+#   input.fq.gz -> pigz -dc -> [raw stats] -> cutadapt -> [trimmed stats]
+#               -> pigz -p N -> output.fq.gz
+#
+# The trimmed reads are compressed with default-level gzip ("gzip"),
+# fast gzip ("fast"), block gzip ("bgzf") or not at all ("none"), which
+# also allows writing to a named pipe.
+#
+# Paired reads pass cutadapt interleaved, so that both mates are trimmed
+# and filtered together.
+
+import argparse
+import json
+import queue
+import subprocess
+import sys
+import threading
+from collections import Counter
+
+# Read blocks of this many bytes from the pipes.
+BLOCK_SIZE = 1 << 22
+
+# Blocks waiting to be written to each output
+QUEUE_SIZE = 4
+
+# Phred+33 qualities
+QUAL_OFFSET = 33
+MAX_QUAL = 45
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def records(stream, lines_per_record=4):
+    """Yield the lines of STREAM in lists that hold whole records of
+LINES_PER_RECORD lines."""
+    rest = b""
+    while True:
+        data = stream.read(BLOCK_SIZE)
+        if not data:
+            break
+        lines = (rest + data).split(b"\n")
+        # The last line of a block is never complete.
+        n = (len(lines) - 1) // lines_per_record * lines_per_record
+        rest = b"\n".join(lines[n:])
+        if n:
+            yield lines[:n]
+    if rest.strip():
+        raise Exception("The fastq stream ends with an incomplete record.")
+
+
+def interleave(first, second):
+    """Return the lines of the records of FIRST and SECOND in turns."""
+    lines = [None] * (len(first) + len(second))
+    for k in range(4):
+        lines[k::8] = first[k::4]
+        lines[4 + k::8] = second[k::4]
+    return lines
+
+
+def deinterleave(lines):
+    """Split interleaved LINES into the lines of the first and of the
+second mates."""
+    first = [None] * (len(lines) // 2)
+    second = [None] * (len(lines) // 2)
+    for k in range(4):
+        first[k::4] = lines[k::8]
+        second[k::4] = lines[4 + k::8]
+    return first, second
+
+
+def paired_records(first, second):
+    """Yield blocks of FIRST and SECOND interleaved, checking that both
+streams have the same number of records."""
+    readers = [records(first), records(second)]
+    pending = [[], []]
+    done = [False, False]
+    while True:
+        for idx in [0, 1]:
+            if not pending[idx] and not done[idx]:
+                block = next(readers[idx], None)
+                if block is None:
+                    done[idx] = True
+                else:
+                    pending[idx] = block
+        if not pending[0] and not pending[1]:
+            return
+        if not pending[0] or not pending[1]:
+            raise Exception("The paired fastq files have different numbers of reads.")
+        n = min(len(pending[0]), len(pending[1]))
+        yield interleave(pending[0][:n], pending[1][:n])
+        pending = [pending[0][n:], pending[1][n:]]
+
+
+class Writer(threading.Thread):
+    """Write blocks to a file in a thread of its own.  The mates of
+paired reads must not wait for each other: a reader of two named pipes
+may want the second mate while the first one is still being written."""
+
+    def __init__(self, out):
+        threading.Thread.__init__(self, daemon=True)
+        self.out = out
+        self.blocks = queue.Queue(QUEUE_SIZE)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    self.out.write(block)
+                except Exception as e:
+                    # Keep taking blocks so that the producer does not block.
+                    self.error = e
+        try:
+            self.out.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def write(self, block):
+        self.blocks.put(block)
+
+    def close(self):
+        self.blocks.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+
+class ReadStats:
+    """Summary statistics of the reads of a fastq file."""
+
+    def __init__(self, name):
+        self.name = name
+        self.reads = 0
+        self.bases = 0
+        self.gc = 0
+        self.n = 0
+        self.lengths = Counter()
+        self.read_quality = Counter()
+        self.base_quality = Counter()
+
+    def update(self, lines):
+        seqs = lines[1::4]
+        quals = lines[3::4]
+        self.reads += len(seqs)
+        self.lengths.update(map(len, seqs))
+        bases = b"".join(seqs)
+        self.bases += len(bases)
+        self.gc += bases.count(b"G") + bases.count(b"C")
+        self.n += bases.count(b"N")
+        qualities = b"".join(quals)
+        for q in range(MAX_QUAL + 1):
+            count = qualities.count(bytes([q + QUAL_OFFSET]))
+            if count:
+                self.base_quality[q] += count
+        self.read_quality.update(s // l - QUAL_OFFSET
+                                 for s, l in zip(map(sum, quals), map(len, quals)) if l)
+
+    def as_dict(self):
+        def percent(count, total):
+            return round(100.0 * count / total, 2) if total else 0.0
+        return {
+            'file': self.name,
+            'reads': self.reads,
+            'bases': self.bases,
+            'min_length': min(self.lengths) if self.lengths else 0,
+            'max_length': max(self.lengths) if self.lengths else 0,
+            'mean_length': round(float(self.bases) / self.reads, 2) if self.reads else 0.0,
+            'gc_percent': percent(self.gc, self.bases),
+            'n_percent': percent(self.n, self.bases),
+            'q20_percent': percent(sum(c for q, c in self.base_quality.items() if q >= 20), self.bases),
+            'q30_percent': percent(sum(c for q, c in self.base_quality.items() if q >= 30), self.bases),
+            'length_histogram': dict(sorted(self.lengths.items())),
+            'read_quality_histogram': dict(sorted(self.read_quality.items())),
+            'base_quality_histogram': dict(sorted(self.base_quality.items()))
+        }
+
+
+def write_stats(filename, sample, stats):
+    with open(filename, 'w') as f:
+        json.dump({'sample': sample, 'files': [s.as_dict() for s in stats]}, f, indent=1)
+
+
+def cutadapt_command(cutadapt, paired, threads, quality, adapter, stringency, min_length, args):
+    """Return the cutadapt command line that trims like Trim Galore and
+reads from and writes to standard input and output."""
+    command = [cutadapt, "--cores={}".format(threads),
+               "--quality-cutoff={}".format(quality),
+               "--adapter={}".format(adapter),
+               "--overlap={}".format(stringency),
+               "--error-rate=0.1",
+               "--minimum-length={}".format(min_length)]
+    if paired:
+        command += ["--interleaved", "-A", adapter]
+    return command + args + ["-"]
+
+
+def compress_command(compression, pigz, bgzip, threads):
+    """Return the command that compresses standard input to standard
+output as set by COMPRESSION, or None for uncompressed output."""
+    if compression == 'gzip':
+        return [pigz, "-p", str(threads), "-6", "-c"]
+    elif compression == 'fast':
+        return [pigz, "-p", str(threads), "-1", "-c"]
+    elif compression == 'bgzf':
+        return [bgzip, "-@", str(threads), "-c"]
+    return None
+
+
+def trim(sample, inputs, outputs, raw_stats, trimmed_stats, cutadapt, cutadapt_args, pigz, bgzip,
+         threads, compression, quality, adapter, stringency, min_length):
+    paired = len(inputs) == 2
+    raw = [ReadStats(f) for f in inputs]
+    trimmed = [ReadStats(f) for f in outputs]
+
+    readers = [subprocess.Popen([pigz, "-dc", f], stdout=subprocess.PIPE) for f in inputs]
+    trimmer = subprocess.Popen(cutadapt_command(cutadapt, paired, threads, quality, adapter,
+                                                stringency, min_length, cutadapt_args),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    outfiles = [open(f, 'wb') for f in outputs]
+    compress = compress_command(compression, pigz, bgzip, threads)
+    if compress:
+        writers = [subprocess.Popen(compress, stdin=subprocess.PIPE, stdout=out) for out in outfiles]
+        sinks = [Writer(writer.stdin) for writer in writers]
+    else:
+        writers = []
+        sinks = [Writer(out) for out in outfiles]
+
+    # The raw reads are fed to cutadapt by a thread of their own while
+    # the trimmed reads are collected here.
+    failure = []
+    def feed():
+        try:
+            if paired:
+                for lines in paired_records(readers[0].stdout, readers[1].stdout):
+                    first, second = deinterleave(lines)
+                    raw[0].update(first)
+                    raw[1].update(second)
+                    trimmer.stdin.write(b"\n".join(lines) + b"\n")
+            else:
+                for lines in records(readers[0].stdout):
+                    raw[0].update(lines)
+                    trimmer.stdin.write(b"\n".join(lines) + b"\n")
+        except Exception as e:
+            failure.append(e)
+        finally:
+            try:
+                trimmer.stdin.close()
+            except OSError:
+                pass
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    try:
+        for lines in records(trimmer.stdout, 8 if paired else 4):
+            mates = deinterleave(lines) if paired else [lines]
+            for stats, sink, mate in zip(trimmed, sinks, mates):
+                stats.update(mate)
+                sink.write(b"\n".join(mate) + b"\n")
+    except Exception:
+        # Unblock the feeding thread.
+        trimmer.kill()
+        raise
+    finally:
+        feeder.join()
+        for sink in sinks:
+            sink.close()
+
+    commands = readers + [trimmer] + writers
+    status = [p.wait() for p in commands]
+    for out in outfiles:
+        out.close()
+    if failure:
+        raise failure[0]
+    for p, s in zip(commands, status):
+        if s != 0:
+            raise Exception("Command failed with exit status {}: {}".format(s, " ".join(p.args)))
+
+    write_stats(raw_stats, sample, raw)
+    write_stats(trimmed_stats, sample, trimmed)
+    kept = trimmed[0].reads
+    log("{}: kept {} of {} {} after trimming.".format(
+        sample, kept, raw[0].reads, "read pairs" if paired else "reads"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trim reads and check their quality in a single pass.")
+    parser.add_argument('--sample', required=True, help="name of the sample")
+    parser.add_argument('--input', action='append', required=True,
+                        help="gzipped fastq file; give twice for paired-end data")
+    parser.add_argument('--output', action='append', required=True,
+                        help="trimmed gzipped fastq file, once per --input")
+    parser.add_argument('--raw-stats', dest='raw_stats', required=True,
+                        help="JSON file of the statistics of the raw reads")
+    parser.add_argument('--trimmed-stats', dest='trimmed_stats', required=True,
+                        help="JSON file of the statistics of the trimmed reads")
+    parser.add_argument('--cutadapt', default='cutadapt', help="cutadapt executable")
+    parser.add_argument('--cutadapt-args', dest='cutadapt_args', default="",
+                        help="additional arguments to cutadapt")
+    parser.add_argument('--pigz', default='pigz', help="pigz executable")
+    parser.add_argument('--bgzip', default='bgzip', help="bgzip executable")
+    parser.add_argument('--compression', choices=['gzip', 'fast', 'bgzf', 'none'], default='gzip',
+                        help="compression of the trimmed reads")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="threads of cutadapt and of every compressor")
+    parser.add_argument('--quality', type=int, default=20,
+                        help="trim low-quality ends below this Phred score")
+    parser.add_argument('--adapter', default="AGATCGGAAGAGC", help="adapter sequence")
+    parser.add_argument('--stringency', type=int, default=1,
+                        help="minimum overlap with the adapter that is trimmed")
+    parser.add_argument('--length', type=int, default=20,
+                        help="discard reads (and their mates) shorter than this")
+    args = parser.parse_args()
+
+    if len(args.input) not in [1, 2] or len(args.output) != len(args.input):
+        sys.exit("Need one or two input files and as many output files.")
+    trim(args.sample, args.input, args.output, args.raw_stats, args.trimmed_stats,
+         args.cutadapt, args.cutadapt_args.split(), args.pigz, args.bgzip, args.threads,
+         args.compression,
+         args.quality, args.adapter, args.stringency, args.length)
+
+
+if __name__ == '__main__':
+    main()